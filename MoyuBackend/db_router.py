@@ -0,0 +1,170 @@
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from MoyuBackend.metrics import get_view_label
+
+'''
+    主库和只读副本的路由。DATABASES中有settings.DATABASE_REPLICA_ALIAS这个别名时启用副本，否则所有读写都在default。
+    DatabaseRoutingMiddleware按视图决定读库：DATABASE_REPLICA_VIEW_LIST中的只读分析和列表接口(视图标签与/api/metrics/相同)
+    读副本，其他接口和所有写入都在主库。同一请求中写过主库之后、以及处于事务中时，读取留在主库。
+    读自己的写：一个请求写过主库后，这个用户(JWT中的用户id，匿名时为IP)在DATABASE_STICKY_SECONDS秒内的请求都读主库，
+    标记保存在默认缓存中，多进程部署时需使用文件或数据库缓存。
+    持久连接(CONN_MAX_AGE)在每个请求开始前检查：空闲超过DATABASE_HEALTH_CHECK_INTERVAL秒的连接先ping一次，
+    已断开的连接关闭，由Django重新连接。副本连接失败时在DATABASE_REPLICA_RETRY_SECONDS秒内改读主库。
+'''
+
+# 当前请求的路由状态，没有经过中间件(命令、后台任务)时为None，全部使用default
+routing_state = ContextVar('routing_state', default=None)
+
+# 副本别名 -> 恢复尝试的时间(time.monotonic)
+replica_down_dic = {}
+
+
+class RoutingState:
+    def __init__(self):
+        # 读取使用的副本别名，None表示读主库
+        self.alias = None
+        self.is_written = False
+
+
+def get_replica_alias():
+    alias = getattr(settings, 'DATABASE_REPLICA_ALIAS', None)
+    if alias and alias != DEFAULT_DB_ALIAS and alias in settings.DATABASES:
+        return alias
+    return None
+
+
+def get_client_key(request):
+    # 不查询数据库，直接从JWT中取用户id；没有有效的JWT时按IP区分
+    header = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(header) == 2 and header[0] in api_settings.AUTH_HEADER_TYPES:
+        try:
+            return 'user:%s' % AccessToken(header[1])[api_settings.USER_ID_CLAIM]
+        except (TokenError, KeyError):
+            pass
+    return 'ip:%s' % request.META.get('REMOTE_ADDR', '')
+
+
+def get_sticky_key(request):
+    return 'db_sticky:%s' % get_client_key(request)
+
+
+def mark_sticky(request):
+    cache.set(get_sticky_key(request), 1, getattr(settings, 'DATABASE_STICKY_SECONDS', 10))
+
+
+def is_sticky(request):
+    return cache.get(get_sticky_key(request)) is not None
+
+
+def is_replica_available(alias):
+    if replica_down_dic.get(alias, 0) > time.monotonic():
+        return False
+    try:
+        connections[alias].ensure_connection()
+    except DatabaseError:
+        replica_down_dic[alias] = time.monotonic() + getattr(settings, 'DATABASE_REPLICA_RETRY_SECONDS', 30)
+        return False
+    replica_down_dic.pop(alias, None)
+    return True
+
+
+def check_connection_list():
+    '''
+        检查空闲过久的持久连接，已断开的关闭。Django 3.2的close_old_connections只处理超时和出过错的连接，
+        数据库端主动断开(例如MySQL的wait_timeout)的连接要到下一次执行SQL时才报错。
+    '''
+    now = time.monotonic()
+    interval = getattr(settings, 'DATABASE_HEALTH_CHECK_INTERVAL', 30)
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block:
+            continue
+        if now - getattr(connection, 'health_check_time', 0) < interval:
+            continue
+        if not connection.is_usable():
+            connection.close()
+        connection.health_check_time = now
+
+
+def touch_connection_list():
+    # 刚用过的连接是可用的，下一次请求不需要再检查
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is not None and not connection.errors_occurred:
+            connection.health_check_time = now
+
+
+def iter_with_state(streaming_content, state):
+    # 流式响应在中间件返回之后才读取数据，每次取下一块时恢复请求的路由状态
+    iterator = iter(streaming_content)
+    while True:
+        token = routing_state.set(state)
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            routing_state.reset(token)
+        yield chunk
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = routing_state.get()
+        if state is None or state.alias is None or state.is_written:
+            return DEFAULT_DB_ALIAS
+        # 事务中(例如select_for_update之后)的读取必须和写入在同一个连接上
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return state.alias
+
+    def db_for_write(self, model, **hints):
+        state = routing_state.get()
+        if state is not None:
+            state.is_written = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # 副本和主库是同一份数据
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # 副本的表结构由复制同步，不单独迁移
+        return db != get_replica_alias()
+
+
+class DatabaseRoutingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        check_connection_list()
+        state = RoutingState()
+        request.db_routing_state = state
+        token = routing_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            routing_state.reset(token)
+        if state.is_written:
+            mark_sticky(request)
+        if response.streaming and state.alias is not None:
+            response.streaming_content = iter_with_state(response.streaming_content, state)
+        touch_connection_list()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        alias = get_replica_alias()
+        if alias is None or get_view_label(request) not in getattr(settings, 'DATABASE_REPLICA_VIEW_LIST', []):
+            return None
+        if not is_sticky(request) and is_replica_available(alias):
+            request.db_routing_state.alias = alias
+        return None
@@ -0,0 +1,182 @@
+import re
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+
+'''
+    请求监控。MetricsMiddleware给每个请求在所有数据库连接上挂一个execute_wrapper，
+    记录SQL条数和耗时，不依赖DEBUG下的connection.queries；请求结束后按视图汇总到进程内的MetricsRegistry。
+    视图标签为 <basename>-<action>(例如questionnaire-report、answersheet-create)，非DRF视图使用url名称。
+    同一SQL模板(参数已分离，IN列表折叠为一个占位符)在一个请求中执行超过METRICS_N_PLUS_ONE_THRESHOLD次时记为N+1。
+    /api/metrics/ 以Prometheus文本格式输出(仅管理员)。计数保存在各个进程内，多进程部署时按进程分别抓取。
+'''
+
+LATENCY_BUCKET_LIST = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# N+1记录的SQL模板数量上限，避免标签无限增长
+N_PLUS_ONE_TEMPLATE_LIMIT = 200
+TEMPLATE_MAX_LENGTH = 200
+
+IN_LIST_PATTERN = re.compile(r'\(\s*%s(?:\s*,\s*%s)+\s*\)')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+# 查询的列名很长且不区分查询，模板中省略，保留FROM之后的部分
+SELECT_COLUMN_PATTERN = re.compile(r'^SELECT (?:DISTINCT )?.*? FROM ', re.DOTALL)
+
+
+def get_n_plus_one_threshold():
+    return getattr(settings, 'METRICS_N_PLUS_ONE_THRESHOLD', 10)
+
+
+def get_sql_template(sql):
+    sql = SELECT_COLUMN_PATTERN.sub('SELECT ... FROM ', sql)
+    return WHITESPACE_PATTERN.sub(' ', IN_LIST_PATTERN.sub('(%s)', sql)).strip()[:TEMPLATE_MAX_LENGTH]
+
+
+class ViewMetrics:
+    def __init__(self):
+        self.bucket_num_list = [0] * len(LATENCY_BUCKET_LIST)
+        self.request_num = 0
+        self.duration_sum = 0.0
+        self.status_num_dic = {}
+        self.query_num = 0
+        self.query_duration_sum = 0.0
+        self.n_plus_one_num = 0
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.view_dic = {}
+        # (视图, SQL模板) -> 一个请求中重复的最大次数
+        self.n_plus_one_dic = {}
+
+    def observe(self, view, status_code, duration, query_num, query_duration, repeated_dic):
+        with self.lock:
+            metrics = self.view_dic.get(view)
+            if metrics is None:
+                metrics = self.view_dic[view] = ViewMetrics()
+            metrics.request_num += 1
+            metrics.duration_sum += duration
+            for index, bound in enumerate(LATENCY_BUCKET_LIST):
+                if duration <= bound:
+                    metrics.bucket_num_list[index] += 1
+            status_class = '%dxx' % (status_code // 100)
+            metrics.status_num_dic[status_class] = metrics.status_num_dic.get(status_class, 0) + 1
+            metrics.query_num += query_num
+            metrics.query_duration_sum += query_duration
+            if repeated_dic:
+                metrics.n_plus_one_num += 1
+            for template, num in repeated_dic.items():
+                key = (view, template)
+                if key in self.n_plus_one_dic or len(self.n_plus_one_dic) < N_PLUS_ONE_TEMPLATE_LIMIT:
+                    self.n_plus_one_dic[key] = max(self.n_plus_one_dic.get(key, 0), num)
+
+    def render(self):
+        line_list = [
+            '# HELP moyu_request_duration_seconds Request latency by view.',
+            '# TYPE moyu_request_duration_seconds histogram',
+        ]
+        with self.lock:
+            view_list = sorted(self.view_dic.items())
+            for view, metrics in view_list:
+                label = format_label(view=view)
+                for bound, num in zip(LATENCY_BUCKET_LIST, metrics.bucket_num_list):
+                    line_list.append('moyu_request_duration_seconds_bucket{%s,le="%s"} %d' % (label, bound, num))
+                line_list.append('moyu_request_duration_seconds_bucket{%s,le="+Inf"} %d'
+                                 % (label, metrics.request_num))
+                line_list.append('moyu_request_duration_seconds_sum{%s} %f' % (label, metrics.duration_sum))
+                line_list.append('moyu_request_duration_seconds_count{%s} %d' % (label, metrics.request_num))
+
+            line_list.append('# HELP moyu_requests_total Requests by view and status class.')
+            line_list.append('# TYPE moyu_requests_total counter')
+            for view, metrics in view_list:
+                for status_class, num in sorted(metrics.status_num_dic.items()):
+                    line_list.append('moyu_requests_total{%s} %d' % (format_label(view=view, status=status_class), num))
+
+            for name, help_text, attr, value_format in [
+                ('moyu_sql_queries_total', 'SQL statements executed by view.', 'query_num', '%d'),
+                ('moyu_sql_duration_seconds_total', 'Time spent in SQL by view.', 'query_duration_sum', '%f'),
+                ('moyu_n_plus_one_requests_total', 'Requests repeating one SQL template over the threshold.',
+                 'n_plus_one_num', '%d'),
+            ]:
+                line_list.append('# HELP %s %s' % (name, help_text))
+                line_list.append('# TYPE %s counter' % name)
+                for view, metrics in view_list:
+                    line_list.append(('%s{%s} ' + value_format) % (name, format_label(view=view),
+                                                                  getattr(metrics, attr)))
+
+            line_list.append('# HELP moyu_n_plus_one_max_repeat Most repetitions of one SQL template in a request.')
+            line_list.append('# TYPE moyu_n_plus_one_max_repeat gauge')
+            for (view, template), num in sorted(self.n_plus_one_dic.items()):
+                line_list.append('moyu_n_plus_one_max_repeat{%s} %d' % (format_label(view=view, sql=template), num))
+        return '\n'.join(line_list) + '\n'
+
+
+def format_label(**label_dic):
+    return ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' '))
+                    for name, value in label_dic.items())
+
+
+registry = MetricsRegistry()
+
+
+class QueryRecorder:
+    # 作为execute_wrapper记录一个请求中执行的SQL
+    def __init__(self):
+        self.query_num = 0
+        self.duration = 0.0
+        self.template_num_dic = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.query_num += 1
+            template = get_sql_template(sql)
+            self.template_num_dic[template] = self.template_num_dic.get(template, 0) + 1
+
+    def get_repeated_dic(self):
+        threshold = get_n_plus_one_threshold()
+        return {template: num for template, num in self.template_num_dic.items() if num > threshold}
+
+
+def get_view_label(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    view_func = match.func
+    actions = getattr(view_func, 'actions', None)
+    basename = getattr(view_func, 'initkwargs', {}).get('basename')
+    if actions and basename:
+        return '%s-%s' % (basename, actions.get(request.method.lower(), request.method.lower()))
+    return match.url_name or match.view_name or 'unnamed'
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(recorder))
+            response = self.get_response(request)
+        # 流式响应在返回之后才真正生成内容，这里记录的是生成响应头之前的耗时
+        registry.observe(get_view_label(request), response.status_code, time.perf_counter() - start,
+                         recorder.query_num, recorder.duration, recorder.get_repeated_dic())
+        return response
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def metrics_view(request):
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
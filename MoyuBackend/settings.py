@@ -46,6 +46,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # 放在最前面，统计整个请求的耗时和SQL，见MoyuBackend/metrics.py
+    'MoyuBackend.metrics.MetricsMiddleware',
+    # 分析和列表接口读副本，见MoyuBackend/db_router.py
+    'MoyuBackend.db_router.DatabaseRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -87,13 +91,66 @@ DATABASES = {
         'PASSWORD': '123456',
         'HOST': '127.0.0.1',
         'PORT': '3306',
+        # 持久连接，每个线程保留一个，空闲的连接在请求开始前检查
+        'CONN_MAX_AGE': 60,
         'OPTIONS': {
             'autocommit': True,
         },
-    }
+    },
+    # 只读副本，配置后报告、导出、交叉分析和列表接口从副本读取：
+    # 'replica': {
+    #     'ENGINE': 'django.db.backends.mysql',
+    #     'NAME': 'moyu',
+    #     'USER': 'moyu_readonly',
+    #     'PASSWORD': '123456',
+    #     'HOST': '127.0.0.2',
+    #     'PORT': '3306',
+    #     'CONN_MAX_AGE': 60,
+    #     'TEST': {'MIRROR': 'default'},
+    # },
+    # 本地用两个SQLite文件代替主库和副本时，先migrate主库，再用 python manage.py sync_replica 复制到副本文件
 }
+DATABASE_ROUTERS = ['MoyuBackend.db_router.PrimaryReplicaRouter']
+# DATABASES中没有这个别名时所有读写都在default
+DATABASE_REPLICA_ALIAS = 'replica'
+# 读副本的视图，标签为 <basename>-<action>，与/api/metrics/相同
+DATABASE_REPLICA_VIEW_LIST = [
+    'questionnaire-report',
+    'questionnaire-export_xls',
+    'questionnaire-cross_analysis',
+    'questionnaire-sign_up_detail',
+    'questionnaire-timeline',
+    'questionnaire-list',
+    'question-list',
+    'option-list',
+    'answersheet-list',
+    'questionoptionlogicrelation-list',
+    'questionnairetemplate-list',
+    'backgroundjob-list',
+]
+# 写入后这么多秒内同一用户的请求读主库(读自己的写)
+DATABASE_STICKY_SECONDS = 10
+# 副本连接失败后这么多秒内改读主库
+DATABASE_REPLICA_RETRY_SECONDS = 30
+# 持久连接空闲超过这么多秒时，请求开始前先检查连接是否可用
+DATABASE_HEALTH_CHECK_INTERVAL = 30
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
+# 缓存。默认使用进程内存；多进程部署时可换成下面两种之一，都不需要额外的服务：
+#   文件缓存  'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/var/tmp/moyu_cache'
+#   数据库表  'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'moyu_cache'
+#            (需先执行 python manage.py createcachetable)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'moyu',
+    }
+}
+
+# 已发布问卷题目列表的缓存，见questionnaire/definition_cache.py
+QUESTIONNAIRE_CACHE_ALIAS = 'default'
+QUESTIONNAIRE_CACHE_TIMEOUT = 60 * 60
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -150,6 +207,9 @@ STATICFILES_DIRS = [
 STATIC_ROOT = os.path.join(BASE_DIR, 'collected_static')
 STATIC_URL = '/static/'
 
+# 一个请求中同一SQL模板执行超过这个次数时记为N+1
+METRICS_N_PLUS_ONE_THRESHOLD = 10
+
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
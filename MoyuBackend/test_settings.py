@@ -0,0 +1,18 @@
+from MoyuBackend.settings import *  # noqa
+
+'''
+    测试使用的配置：主库和只读副本都是SQLite，副本在测试中镜像主库(TEST.MIRROR)，与数据库复制后的效果相同。
+    python manage.py test --settings=MoyuBackend.test_settings
+'''
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),  # noqa
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db_replica.sqlite3'),  # noqa
+        'TEST': {'MIRROR': 'default'},
+    },
+}
@@ -8,8 +8,9 @@ from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )
 
+from MoyuBackend.metrics import metrics_view
 from questionnaire.views import QuestionnaireViewSet, QuestionViewSet, OptionViewSet, AnswerSheetViewSet, \
-    QuestionOptionLogicRelationViewSet
+    QuestionOptionLogicRelationViewSet, BackgroundJobViewSet, QuestionnaireTemplateViewSet
 from user_info.views import UserViewSet
 
 router = DefaultRouter()
@@ -19,6 +20,8 @@ router.register(r'question', QuestionViewSet)
 router.register(r'option', OptionViewSet)
 router.register(r'answer', AnswerSheetViewSet)
 router.register(r'question_option_logic_relation', QuestionOptionLogicRelationViewSet)
+router.register(r'job', BackgroundJobViewSet)
+router.register(r'template', QuestionnaireTemplateViewSet)
 
 
 urlpatterns = [
@@ -28,6 +31,7 @@ urlpatterns = [
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),  # rest_framewor
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('api/metrics/', metrics_view, name='metrics'),  # Prometheus格式的请求监控数据，仅管理员
 
 
 ]
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from questionnaire.models import Questionnaire, Question, AnswerSheet, Option, AnswerDetail, QuestionOptionLogicRelation
+from questionnaire.models import Questionnaire, Question, AnswerSheet, Option, AnswerDetail, QuestionOptionLogicRelation, \
+    BackgroundJob, QuestionnaireTemplate, AnswerRollup
 
 
 # Register your models here.
@@ -33,9 +34,26 @@ class QuestionOptionLogicRelationAdmin(admin.ModelAdmin):
     list_display = ('question', 'option')
 
 
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'questionnaire', 'type', 'status', 'create_date', 'finish_date')
+    list_filter = ('type', 'status')
+
+
+class AnswerRollupAdmin(admin.ModelAdmin):
+    list_display = ('questionnaire', 'bucket', 'answer_count', 'duration_sum')
+
+
+class QuestionnaireTemplateAdmin(admin.ModelAdmin):
+    list_display = ('id', 'title', 'author', 'type', 'create_date')
+    search_fields = ('title',)
+
+
 admin.site.register(Questionnaire, QuestionnaireAdmin)
 admin.site.register(Question, QuestionAdmin)
 admin.site.register(Option, OptionAdmin)
 admin.site.register(AnswerSheet, AnswerSheetAdmin)
 admin.site.register(AnswerDetail, AnswerDetailAdmin)
 admin.site.register(QuestionOptionLogicRelation, QuestionOptionLogicRelationAdmin)
+admin.site.register(BackgroundJob, BackgroundJobAdmin)
+admin.site.register(QuestionnaireTemplate, QuestionnaireTemplateAdmin)
+admin.site.register(AnswerRollup, AnswerRollupAdmin)
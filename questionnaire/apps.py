@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class QuestionaireConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'questionnaire'
+
+    def ready(self):
+        # 注册维护搜索索引的信号
+        import questionnaire.search  # noqa: F401
@@ -0,0 +1,384 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from questionnaire.models import Questionnaire, Option, AnswerSheet, AnswerDetail
+
+'''
+    答卷归档。不再收集答卷的问卷可以把答卷和作答明细打包成一个按列存放的文件(MEDIA_ROOT/archive下)，
+    之后从在线表中删除，报告、导出和交叉分析通过mmap直接读取该文件，不再查询数据库中的答卷。
+    问卷的is_archived为True时以归档文件为准；计数字段保留归档前的值，reconcile按归档文件校正。
+
+    文件格式(小端)：
+        文件头    magic, 答卷数, 作答明细数, 字符串数, 最大答卷id
+        答卷列    id, respondent, once_respondent, started_time, modified_time, ip, cname  (每列答卷数个元素)
+        detail_offset  答卷数+1个元素，第i张答卷的作答明细为 [detail_offset[i], detail_offset[i+1])
+        明细列    id, sheet, question, option, content  (每列明细数个元素，sheet为答卷在文件中的下标)
+        string_offset  字符串数+1个元素
+        字符串池  所有字符串的utf-8编码依次相连，相同的字符串只存一份
+    答卷按(提交时间, id)排列，作答明细按(所属答卷, id)排列，导出时按顺序读即可。
+    用户id为0表示没有答卷人，字符串下标为-1表示None，时间为UTC起的微秒数。每一列都按8字节对齐。
+'''
+
+ARCHIVE_DIR = 'archive'
+ARCHIVE_MAGIC = b'QAR1'
+ARCHIVE_CHUNK_SIZE = 5000
+
+HEADER = struct.Struct('<4s4xQQQQ')
+
+SHEET_COLUMN_LIST = [('id', 'q'), ('respondent', 'q'), ('once_respondent', 'q'),
+                     ('started_time', 'q'), ('modified_time', 'q'), ('ip', 'i'), ('cname', 'i')]
+DETAIL_COLUMN_LIST = [('detail_id', 'q'), ('sheet', 'i'), ('question', 'q'), ('option', 'q'), ('content', 'i')]
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class ArchiveMissing(Exception):
+    # 问卷标记为已归档，但归档文件不存在(被误删或没有随MEDIA_ROOT迁移)
+    pass
+
+
+def get_layout(sheet_num, detail_num, string_num):
+    # [(列名, 类型, 元素个数), ...]，写入和读取共用
+    return [(name, code, sheet_num) for name, code in SHEET_COLUMN_LIST] + \
+        [('detail_offset', 'q', sheet_num + 1)] + \
+        [(name, code, detail_num) for name, code in DETAIL_COLUMN_LIST] + \
+        [('string_offset', 'q', string_num + 1)]
+
+
+def get_archive_path(questionnaire_id):
+    return os.path.join(settings.MEDIA_ROOT, ARCHIVE_DIR, 'questionnaire_%s.qar' % questionnaire_id)
+
+
+def to_microsecond(value):
+    return (value - EPOCH) // MICROSECOND
+
+
+def to_datetime(value):
+    return EPOCH + timedelta(microseconds=value)
+
+
+def align(offset):
+    return (offset + 7) & ~7
+
+
+class StringPool:
+    def __init__(self):
+        self.index_dic = {}
+        self.offset = array('q', [0])
+        self.blob = bytearray()
+
+    def add(self, value):
+        if value is None:
+            return -1
+        index = self.index_dic.get(value)
+        if index is None:
+            index = self.index_dic[value] = len(self.index_dic)
+            self.blob += value.encode('utf-8')
+            self.offset.append(len(self.blob))
+        return index
+
+
+def write_archive(questionnaire_id):
+    '''
+        把问卷在线表中的答卷写成归档文件，返回 (答卷数, 作答明细数)。
+        先写临时文件再改名，已有的归档文件在写完之前保持不变。
+    '''
+    column_dic = {name: array(code) for name, code, length in get_layout(0, 0, 0)}
+    column_dic['detail_offset'].append(0)
+    pool = StringPool()
+    sheet_index_dic = {}
+    sheet_row_list = AnswerSheet.objects.filter(questionnaire_id=questionnaire_id) \
+        .order_by('modified_time', 'id') \
+        .values_list('id', 'respondent_id', 'once_respondent_id', 'started_time', 'modified_time', 'ip', 'cname') \
+        .iterator(chunk_size=ARCHIVE_CHUNK_SIZE)
+    for sheet_id, respondent_id, once_respondent_id, started_time, modified_time, ip, cname in sheet_row_list:
+        sheet_index_dic[sheet_id] = len(sheet_index_dic)
+        column_dic['id'].append(sheet_id)
+        column_dic['respondent'].append(respondent_id or 0)
+        column_dic['once_respondent'].append(once_respondent_id or 0)
+        column_dic['started_time'].append(to_microsecond(started_time))
+        column_dic['modified_time'].append(to_microsecond(modified_time))
+        column_dic['ip'].append(pool.add(ip))
+        column_dic['cname'].append(pool.add(cname))
+
+    # 作答明细与答卷同序读出，每张答卷的明细在文件中连续存放
+    detail_num_list = [0] * len(sheet_index_dic)
+    detail_row_list = AnswerDetail.objects.filter(sheet__questionnaire_id=questionnaire_id) \
+        .order_by('sheet__modified_time', 'sheet_id', 'id') \
+        .values_list('id', 'sheet_id', 'question_id', 'option_id', 'content') \
+        .iterator(chunk_size=ARCHIVE_CHUNK_SIZE)
+    for detail_id, sheet_id, question_id, option_id, content in detail_row_list:
+        sheet_index = sheet_index_dic.get(sheet_id)
+        if sheet_index is None:
+            continue
+        detail_num_list[sheet_index] += 1
+        column_dic['detail_id'].append(detail_id)
+        column_dic['sheet'].append(sheet_index)
+        column_dic['question'].append(question_id)
+        column_dic['option'].append(option_id)
+        column_dic['content'].append(pool.add(content))
+    for detail_num in detail_num_list:
+        column_dic['detail_offset'].append(column_dic['detail_offset'][-1] + detail_num)
+    column_dic['string_offset'] = pool.offset
+
+    sheet_num, detail_num = len(column_dic['id']), len(column_dic['detail_id'])
+    path = get_archive_path(questionnaire_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(HEADER.pack(ARCHIVE_MAGIC, sheet_num, detail_num, len(pool.index_dic),
+                             max(column_dic['id'], default=0)))
+        for name, code, length in get_layout(sheet_num, detail_num, len(pool.index_dic)):
+            column = column_dic[name]
+            if sys.byteorder != 'little':
+                column.byteswap()
+            fp.write(column.tobytes())
+            fp.write(b'\0' * (align(fp.tell()) - fp.tell()))
+        fp.write(pool.blob)
+    os.replace(path + '.tmp', path)
+    return sheet_num, detail_num
+
+
+def remove_archive(questionnaire_id):
+    path = get_archive_path(questionnaire_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class AnswerArchive:
+    '''
+        只读打开的归档文件。每一列是映射到文件上的memoryview，按需从页缓存读取，不整体载入内存。
+        用完后调用close()，或作为上下文管理器使用。
+    '''
+
+    def __init__(self, questionnaire_id):
+        try:
+            self.fp = open(get_archive_path(questionnaire_id), 'rb')
+        except FileNotFoundError:
+            raise ArchiveMissing(questionnaire_id) from None
+        self.buffer = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.buffer)
+        magic, self.sheet_num, self.detail_num, string_num, self.max_sheet_id = HEADER.unpack_from(self.view)
+        if magic != ARCHIVE_MAGIC:
+            self.close()
+            raise ValueError('不是答卷归档文件')
+        self.column_dic = {}
+        offset = HEADER.size
+        for name, code, length in get_layout(self.sheet_num, self.detail_num, string_num):
+            end = offset + length * array(code).itemsize
+            self.column_dic[name] = self.load_column(self.view[offset:end], code)
+            offset = align(end)
+        self.string_blob = self.view[offset:]
+        self.string_cache = {}
+
+    @staticmethod
+    def load_column(view, code):
+        if sys.byteorder == 'little':
+            return view.cast(code)
+        column = array(code, view)
+        column.byteswap()
+        return column
+
+    def __getitem__(self, name):
+        return self.column_dic[name]
+
+    def __len__(self):
+        return self.sheet_num
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # 先释放所有引用文件内容的memoryview，mmap才能关闭
+        for column in getattr(self, 'column_dic', {}).values():
+            if isinstance(column, memoryview):
+                column.release()
+        if hasattr(self, 'string_blob'):
+            self.string_blob.release()
+        self.view.release()
+        self.buffer.close()
+        self.fp.close()
+
+    def get_string(self, index):
+        if index < 0:
+            return None
+        value = self.string_cache.get(index)
+        if value is None:
+            string_offset = self.column_dic['string_offset']
+            value = str(self.string_blob[string_offset[index]:string_offset[index + 1]], 'utf-8')
+            self.string_cache[index] = value
+        return value
+
+    def get_answer_stamp(self):
+        # 与在线表的答卷版本格式相同，归档前后生成的任务结果可以继续复用
+        return '%d-%d' % (self.sheet_num, self.max_sheet_id)
+
+
+def is_archived(questionnaire_id):
+    return Questionnaire.objects.filter(pk=questionnaire_id, is_archived=True).exists()
+
+
+def check_archive(questionnaire_id):
+    # 流式导出在响应开始之前检查，读取过程中才发现文件不存在时已经无法返回错误
+    if is_archived(questionnaire_id) and not os.path.exists(get_archive_path(questionnaire_id)):
+        raise ArchiveMissing(questionnaire_id)
+
+
+def has_answer_sheet(questionnaire):
+    if questionnaire.is_archived:
+        with AnswerArchive(questionnaire.id) as archive:
+            return archive.sheet_num > 0
+    return AnswerSheet.objects.filter(questionnaire_id=questionnaire.id).exists()
+
+
+def get_username_dic(user_id_list):
+    # 答卷人的当前用户名，按块查询
+    user_id_list = sorted(set(user_id_list) - {0})
+    username_dic = {}
+    for start in range(0, len(user_id_list), ARCHIVE_CHUNK_SIZE):
+        username_dic.update(get_user_model().objects.filter(id__in=user_id_list[start:start + ARCHIVE_CHUNK_SIZE])
+                            .values_list('id', 'username'))
+    return username_dic
+
+
+def get_option_question_dic(questionnaire_id):
+    # 现存的选项 -> 所属题目。题目或选项删除后，在线表中的明细会级联删除，读取归档时同样跳过
+    return dict(Option.objects.filter(question__questionnaire_id=questionnaire_id).values_list('id', 'question_id'))
+
+
+def iter_detail_index(archive, option_question_dic):
+    option_column, question_column = archive['option'], archive['question']
+    for index in range(archive.detail_num):
+        if option_question_dic.get(option_column[index]) == question_column[index]:
+            yield index
+
+
+def iter_archive_detail(questionnaire_id):
+    '''
+        按作答明细id的顺序产出与在线表联表查询相同的行：
+        (明细id, 填空内容, 答卷id, 题目id, 选项id, 答卷ip, 提交时间, 答卷人id, 答卷人用户名)
+    '''
+    option_question_dic = get_option_question_dic(questionnaire_id)
+    with AnswerArchive(questionnaire_id) as archive:
+        username_dic = get_username_dic(archive['respondent'])
+        index_list = sorted(iter_detail_index(archive, option_question_dic), key=archive['detail_id'].__getitem__)
+        for index in index_list:
+            sheet_index = archive['sheet'][index]
+            respondent_id = archive['respondent'][sheet_index] or None
+            yield (archive['detail_id'][index], archive.get_string(archive['content'][index]),
+                   archive['id'][sheet_index], archive['question'][index], archive['option'][index],
+                   archive.get_string(archive['ip'][sheet_index]),
+                   to_datetime(archive['modified_time'][sheet_index]),
+                   respondent_id, username_dic.get(respondent_id))
+
+
+def iter_archive_sheet_chunk(questionnaire_id, chunk_size=ARCHIVE_CHUNK_SIZE):
+    # 与export.iter_sheet_chunk的产出格式相同，答卷在文件中已按(提交时间, id)排好
+    with AnswerArchive(questionnaire_id) as archive:
+        detail_offset = archive['detail_offset']
+        for start in range(0, archive.sheet_num, chunk_size):
+            end = min(start + chunk_size, archive.sheet_num)
+            username_dic = get_username_dic(archive['respondent'][start:end])
+            chunk = []
+            for sheet_index in range(start, end):
+                detail_list = [(archive['option'][index], archive.get_string(archive['content'][index]))
+                               for index in range(detail_offset[sheet_index], detail_offset[sheet_index + 1])]
+                chunk.append(((archive['id'][sheet_index], username_dic.get(archive['respondent'][sheet_index]),
+                               to_datetime(archive['modified_time'][sheet_index])), detail_list))
+            yield chunk
+
+
+def iter_archive_triple(questionnaire_id, question_id_set):
+    # 交叉分析用的(答卷id, 题目id, 选项id)
+    option_question_dic = get_option_question_dic(questionnaire_id)
+    with AnswerArchive(questionnaire_id) as archive:
+        sheet_id_column = archive['id']
+        for sheet_index, question_id, option_id in zip(archive['sheet'], archive['question'], archive['option']):
+            if question_id in question_id_set and option_question_dic.get(option_id) == question_id:
+                yield sheet_id_column[sheet_index], question_id, option_id
+
+
+def iter_archive_sheet_time(questionnaire_id):
+    # 每张答卷的(开始答题时间, 提交时间)
+    with AnswerArchive(questionnaire_id) as archive:
+        for started_time, modified_time in zip(archive['started_time'], archive['modified_time']):
+            yield to_datetime(started_time), to_datetime(modified_time)
+
+
+def count_archive(questionnaire_id):
+    '''
+        按归档文件计算计数：(答卷数, {题目id: 回答了该题的答卷数}, {选项id: 作答明细数})
+    '''
+    option_question_dic = get_option_question_dic(questionnaire_id)
+    question_sheet_set = set()
+    option_num_dic = {}
+    with AnswerArchive(questionnaire_id) as archive:
+        for index in iter_detail_index(archive, option_question_dic):
+            question_sheet_set.add((archive['question'][index], archive['sheet'][index]))
+            option_id = archive['option'][index]
+            option_num_dic[option_id] = option_num_dic.get(option_id, 0) + 1
+        sheet_num = archive.sheet_num
+    question_num_dic = {}
+    for question_id, sheet_index in question_sheet_set:
+        question_num_dic[question_id] = question_num_dic.get(question_id, 0) + 1
+    return sheet_num, question_num_dic, option_num_dic
+
+
+def get_archive_answer_stamp(questionnaire_id):
+    with AnswerArchive(questionnaire_id) as archive:
+        return archive.get_answer_stamp()
+
+
+def count_archive_row(questionnaire_id):
+    with AnswerArchive(questionnaire_id) as archive:
+        return archive.sheet_num + archive.detail_num
+
+
+def get_archived_respondent_set(questionnaire_id):
+    with AnswerArchive(questionnaire_id) as archive:
+        return set(archive['respondent']) - {0}
+
+
+def iter_restore_chunk(questionnaire_id, chunk_size=ARCHIVE_CHUNK_SIZE):
+    '''
+        把归档文件中的答卷按原id写回在线表，每段一条批量INSERT，返回这一段的行数。
+        已删除的用户按SET_NULL处理，已删除的题目和选项的作答明细按级联删除处理，不再写回。
+    '''
+    option_question_dic = get_option_question_dic(questionnaire_id)
+    with AnswerArchive(questionnaire_id) as archive:
+        user_id_set = set(get_username_dic(archive['respondent'])) | \
+            set(get_username_dic(archive['once_respondent']))
+        for start in range(0, archive.sheet_num, chunk_size):
+            end = min(start + chunk_size, archive.sheet_num)
+            AnswerSheet.objects.bulk_create([
+                AnswerSheet(id=archive['id'][index], questionnaire_id=questionnaire_id,
+                            respondent_id=archive['respondent'][index] if archive['respondent'][index] in user_id_set
+                            else None,
+                            once_respondent_id=archive['once_respondent'][index]
+                            if archive['once_respondent'][index] in user_id_set else None,
+                            started_time=to_datetime(archive['started_time'][index]),
+                            modified_time=to_datetime(archive['modified_time'][index]),
+                            ip=archive.get_string(archive['ip'][index]),
+                            cname=archive.get_string(archive['cname'][index]))
+                for index in range(start, end)
+            ])
+            yield end - start
+        index_list = list(iter_detail_index(archive, option_question_dic))
+        for start in range(0, len(index_list), chunk_size):
+            AnswerDetail.objects.bulk_create([
+                AnswerDetail(id=archive['detail_id'][index], sheet_id=archive['id'][archive['sheet'][index]],
+                             question_id=archive['question'][index], option_id=archive['option'][index],
+                             content=archive.get_string(archive['content'][index]))
+                for index in index_list[start:start + chunk_size]
+            ])
+            yield len(index_list[start:start + chunk_size])
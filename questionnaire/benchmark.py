@@ -0,0 +1,189 @@
+import json
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from questionnaire.logic import get_logic_graph
+from questionnaire.models import Question, Option, AnswerSheet, AnswerDetail
+from questionnaire.ordering import ORDER_FIELD_LIST
+
+'''
+    接口性能测试。通过测试客户端调用热点接口，每个场景先冷启动运行一次(缓存为空)，再计时运行repeat次；
+    另外单独运行一次，统计SQL条数(CaptureQueriesContext)和峰值内存(tracemalloc)，统计本身不影响计时。
+    结果保存为JSON，可以与之前提交生成的结果对比。提交答卷的场景结束后通过接口删除新增的答卷，数据保持不变。
+'''
+
+CHOICE_QUESTION_TYPE_LIST = ['single-choice', 'multiple-choice', 'scoring']
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def consume(response):
+    # 流式响应在读取内容时才真正生成，计时需要包括这一部分
+    if response.streaming:
+        return sum(len(chunk) for chunk in response.streaming_content)
+    return len(response.content)
+
+
+class EndpointBenchmark:
+    '''
+        scenario_dic: 场景名 -> (请求函数, 期望的状态码)
+    '''
+
+    def __init__(self, questionnaire, repeat=5):
+        self.questionnaire = questionnaire
+        self.repeat = repeat
+        self.client = APIClient()
+        self.client.force_authenticate(questionnaire.author)
+        # 提交答卷使用匿名用户，不受“只允许回答一次”的限制
+        self.anonymous_client = APIClient()
+        self.question_list = list(Question.objects.filter(questionnaire_id=questionnaire.id)
+                                  .order_by(*ORDER_FIELD_LIST))
+        self.answer_body = self.get_answer_body()
+        choice_id_list = [question.id for question in self.question_list
+                          if question.type in CHOICE_QUESTION_TYPE_LIST]
+        self.cross_body = {'question_x_list': choice_id_list[:2], 'question_y_list': choice_id_list[2:4]}
+        self.scenario_dic = {
+            'detail': (self.request_detail, 200),
+            'fill_or_preview': (self.request_fill_or_preview, 200),
+            'answer-create': (self.request_answer_create, 201),
+            'report': (self.request_report, 200),
+            'cross-analysis': (self.request_cross_analysis, 200),
+            'export-csv': (self.request_export_csv, 200),
+            'export-xlsx': (self.request_export_xlsx, 200),
+        }
+
+    def get_answer_body(self):
+        # 每道题选第一个选项，填空题和定位题填写内容；按逻辑关联没有显示的题目不作答
+        first_option_dic = {}
+        for option_id, question_id in Option.objects.filter(question__questionnaire_id=self.questionnaire.id) \
+                .order_by('question_id', *ORDER_FIELD_LIST).values_list('id', 'question_id'):
+            first_option_dic.setdefault(question_id, option_id)
+        reachable_set = get_logic_graph(self.questionnaire).get_reachable_question_set(set(first_option_dic.values()))
+        answer_list = []
+        for question in self.question_list:
+            if question.id not in first_option_dic or question.id not in reachable_set:
+                continue
+            content = '' if question.type in CHOICE_QUESTION_TYPE_LIST else '性能测试'
+            answer_list.append({'question': question.id, 'option': first_option_dic[question.id], 'content': content})
+        return {'questionnaire': self.questionnaire.id, 'answer_list': answer_list}
+
+    def get_url(self, path=''):
+        return '/api/questionnaire/%d/%s' % (self.questionnaire.id, path)
+
+    def request_detail(self):
+        return self.client.get(self.get_url())
+
+    def request_fill_or_preview(self):
+        return self.client.get(self.get_url('fill_or_preview/'))
+
+    def request_answer_create(self):
+        return self.anonymous_client.post('/api/answer/', self.answer_body, format='json')
+
+    def request_report(self):
+        return self.client.get(self.get_url('report/'))
+
+    def request_cross_analysis(self):
+        return self.client.put(self.get_url('cross-analysis/'), self.cross_body, format='json')
+
+    def request_export_csv(self):
+        return self.client.get(self.get_url('export-xls/'), {'file_type': 'csv'})
+
+    def request_export_xlsx(self):
+        return self.client.get(self.get_url('export-xls/'), {'file_type': 'xlsx'})
+
+    def call(self, name):
+        request, status_code = self.scenario_dic[name]
+        start = time.perf_counter()
+        response = request()
+        size = consume(response)
+        elapsed = time.perf_counter() - start
+        if response.status_code != status_code:
+            raise RuntimeError('%s返回%d：%s' % (name, response.status_code, response.content[:200]))
+        return elapsed, size
+
+    def run_scenario(self, name):
+        cold, size = self.call(name)
+        elapsed_list = [self.call(name)[0] for _ in range(self.repeat)]
+
+        tracemalloc.start()
+        try:
+            with CaptureQueriesContext(connection) as context:
+                self.call(name)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        elapsed_list.sort()
+        return {
+            'cold_ms': round(cold * 1000, 2),
+            'min_ms': round(elapsed_list[0] * 1000, 2),
+            'median_ms': round(statistics.median(elapsed_list) * 1000, 2),
+            'p95_ms': round(elapsed_list[min(len(elapsed_list) - 1, int(len(elapsed_list) * 0.95))] * 1000, 2),
+            'max_ms': round(elapsed_list[-1] * 1000, 2),
+            'query_count': len(context.captured_queries),
+            'peak_memory_kb': round(peak_memory / 1024, 1),
+            'response_kb': round(size / 1024, 1),
+        }
+
+    def remove_created_sheet(self, last_sheet_id):
+        # 通过接口删除，计数同时减去
+        for sheet_id in AnswerSheet.objects.filter(questionnaire_id=self.questionnaire.id, id__gt=last_sheet_id) \
+                .values_list('id', flat=True):
+            self.client.delete('/api/answer/%d/' % sheet_id)
+
+    def run(self, name_list=None):
+        last_sheet_id = AnswerSheet.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        result_dic = {}
+        try:
+            for name in name_list or self.scenario_dic:
+                result_dic[name] = self.run_scenario(name)
+        finally:
+            self.remove_created_sheet(last_sheet_id)
+        return {
+            'create_date': timezone.now().isoformat(),
+            'commit': get_commit(),
+            'database': connection.vendor,
+            'repeat': self.repeat,
+            'dataset': {
+                'questionnaire': self.questionnaire.id,
+                'type': self.questionnaire.type,
+                'question_count': len(self.question_list),
+                'answer_count': self.questionnaire.answer_count,
+                'detail_count': AnswerDetail.objects.filter(sheet__questionnaire_id=self.questionnaire.id).count(),
+            },
+            'scenario_dic': result_dic,
+        }
+
+
+def load_result(path):
+    with open(path, encoding='utf-8') as fp:
+        return json.load(fp)
+
+
+def compare_result(result, previous):
+    '''
+        与之前的结果对比，返回 [(场景, 之前的中位数, 现在的中位数, 比值, 之前的SQL条数, 现在的SQL条数), ...]
+    '''
+    row_list = []
+    for name, scenario in result['scenario_dic'].items():
+        previous_scenario = previous.get('scenario_dic', {}).get(name)
+        if previous_scenario is None:
+            continue
+        ratio = scenario['median_ms'] / previous_scenario['median_ms'] if previous_scenario['median_ms'] else 0
+        row_list.append((name, previous_scenario['median_ms'], scenario['median_ms'], ratio,
+                         previous_scenario['query_count'], scenario['query_count']))
+    return row_list
@@ -0,0 +1,123 @@
+from django.db import transaction
+from django.utils import timezone
+
+from questionnaire.models import Question, Option, QuestionOptionLogicRelation
+from questionnaire.ordering import get_rank_after, renumber
+
+'''
+    问卷和题目的复制。每一层(题目、选项、逻辑关联)一条批量INSERT，查询数量与题目数量无关。
+    MySQL的bulk_create不返回主键，新行的id按插入顺序从数据库读回：新行的上级(问卷/题目)都是刚创建的，
+    按上级过滤、按id排序读出的就是本次插入的行，与插入顺序一一对应，由此得到旧id到新id的映射。
+'''
+
+BULK_BATCH_SIZE = 500
+
+
+def bulk_create_id_list(model, new_list, parent_field, parent_id_list, exclude_id_list=()):
+    '''
+        批量插入new_list，按插入顺序返回新行的id。
+        parent_id_list中的上级必须是本次新建的，其下只有本次插入的行；
+        上级已有的行需要通过exclude_id_list排除。
+    '''
+    if not new_list:
+        return []
+    model.objects.bulk_create(new_list, batch_size=BULK_BATCH_SIZE)
+    queryset = model.objects.filter(**{parent_field + '__in': parent_id_list})
+    if exclude_id_list:
+        queryset = queryset.exclude(id__in=exclude_id_list)
+    return list(queryset.order_by('id').values_list('id', flat=True))
+
+
+def bulk_create_mapped(model, old_list, new_list, parent_field, parent_id_list):
+    # 批量插入new_list(与old_list一一对应)，返回 {旧id: 新id}
+    new_id_list = bulk_create_id_list(model, new_list, parent_field, parent_id_list)
+    return {old.id: new_id for old, new_id in zip(old_list, new_id_list)}
+
+
+def copy_option_list(option_list, question_id_dic):
+    # 选项按所属题目的新id分组后依次插入，保证读回的顺序与插入顺序一致
+    option_list = sorted(option_list, key=lambda option: (question_id_dic[option.question_id], option.id))
+    new_option_list = []
+    for option in option_list:
+        new_option = Option(**{field.attname: getattr(option, field.attname)
+                               for field in Option._meta.concrete_fields if not field.primary_key})
+        new_option.question_id = question_id_dic[option.question_id]
+        new_option.answer_count = 0
+        new_option_list.append(new_option)
+    return bulk_create_mapped(Option, option_list, new_option_list, 'question_id', list(question_id_dic.values()))
+
+
+def copy_relation_list(relation_list, question_id_dic, option_id_dic):
+    # 关联的题目或选项如果也被复制了，指向复制出的新对象，否则保持原来的指向
+    QuestionOptionLogicRelation.objects.bulk_create([
+        QuestionOptionLogicRelation(question_id=question_id_dic.get(relation.question_id, relation.question_id),
+                                    option_id=option_id_dic.get(relation.option_id, relation.option_id))
+        for relation in relation_list
+    ], batch_size=BULK_BATCH_SIZE)
+
+
+@transaction.atomic
+def clone_questionnaire(questionnaire):
+    '''
+        复制问卷、题目、选项和逻辑关联。新问卷处于关闭状态，分享时间置空，作答计数清零，归档和清除标记清除。
+    '''
+    old_id = questionnaire.id
+    question_list = list(Question.objects.filter(questionnaire_id=old_id).order_by('id'))
+    option_list = list(Option.objects.filter(question__questionnaire_id=old_id))
+    relation_list = list(QuestionOptionLogicRelation.objects.filter(question__questionnaire_id=old_id,
+                                                                    option__question__questionnaire_id=old_id))
+
+    questionnaire.pk = None
+    questionnaire.create_date = timezone.now()
+    questionnaire.first_shared_date = None
+    questionnaire.last_shared_date = None
+    questionnaire.modify_date = timezone.now()
+    questionnaire.status = 'closed'
+    questionnaire.title = questionnaire.title + '_副本'
+    questionnaire.answer_count = 0
+    questionnaire.question_count = len(question_list)
+    # 答卷不复制，副本没有归档文件，也不处于清除状态
+    questionnaire.is_archived = False
+    questionnaire.is_purging = False
+    questionnaire.save()
+
+    new_question_list = []
+    for question in question_list:
+        new_question = Question(**{field.attname: getattr(question, field.attname)
+                                   for field in Question._meta.concrete_fields if not field.primary_key})
+        new_question.questionnaire_id = questionnaire.id
+        new_question.answer_count = 0
+        new_question_list.append(new_question)
+    question_id_dic = bulk_create_mapped(Question, question_list, new_question_list,
+                                         'questionnaire_id', [questionnaire.id])
+    option_id_dic = copy_option_list(option_list, question_id_dic)
+    copy_relation_list(relation_list, question_id_dic, option_id_dic)
+    return questionnaire
+
+
+@transaction.atomic
+def clone_question(question):
+    '''
+        在原题目下方复制一道题目及其选项。
+        以该题目为目标的逻辑关联(显示条件)和由其选项出发的逻辑关联都会复制，选项指向新选项。
+    '''
+    old_id = question.id
+    option_list = list(Option.objects.filter(question_id=old_id))
+    relation_list = list(QuestionOptionLogicRelation.objects.filter(question_id=old_id)) + \
+        list(QuestionOptionLogicRelation.objects.filter(option__question_id=old_id).exclude(question_id=old_id))
+
+    # 新题目的排序键取原题目与下一题之间的值，其余题目不需要移动
+    rank = get_rank_after(Question, question)
+    question.pk = None
+    question.rank = rank
+    question.modify_date = timezone.now()
+    question.answer_count = 0
+    question.save()
+    # 新题目和它后面的题目位置都后移一位
+    renumber(Question, question.questionnaire_id)
+    question.refresh_from_db(fields=['ordering'])
+
+    question_id_dic = {old_id: question.id}
+    option_id_dic = copy_option_list(option_list, question_id_dic)
+    copy_relation_list(relation_list, question_id_dic, option_id_dic)
+    return question
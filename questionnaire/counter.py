@@ -0,0 +1,137 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from questionnaire.archive import count_archive
+from questionnaire.models import Questionnaire, Question, Option, AnswerSheet, AnswerDetail
+from questionnaire.rollup import add_sheet_rollup, reset_rollup
+
+'''
+    维护问卷、题目、选项上的冗余计数：
+        Questionnaire.answer_count   答卷数
+        Questionnaire.question_count 题目数
+        Question.answer_count        回答了该题的答卷数
+        Option.answer_count          选择了该选项的作答明细数
+        AnswerRollup                 每小时的答卷数和答题用时，见rollup.py
+    所有更新都是 F() 表达式或子查询，在调用方的事务中执行。
+    提交答卷的计数在提交事务完成后(on_commit)用一个短事务更新，热点的问卷行不随提交答卷的事务一起加锁；
+    提交成功而计数没有更新(进程在两者之间退出)时，可以用reconcile_counters校正。
+    答卷已归档的问卷在线表中没有作答明细，需要重新计算时按归档文件计算。
+'''
+
+
+def add_option_count(option_num_dic, sign=1):
+    # 按次数分组，同样次数的选项一条UPDATE
+    group_dic = {}
+    for option_id, num in option_num_dic.items():
+        group_dic.setdefault(num, []).append(option_id)
+    for num, option_id_list in group_dic.items():
+        Option.objects.filter(pk__in=option_id_list).update(answer_count=F('answer_count') + sign * num)
+
+
+def add_sheet_count(answer_sheet, detail_list, sign=1):
+    '''
+        提交(sign=1)或删除(sign=-1)一张答卷后更新计数。detail_list为[(题目id, 选项id), ...]。
+    '''
+    question_id_list = {question_id for question_id, option_id in detail_list}
+    if question_id_list:
+        Question.objects.filter(pk__in=question_id_list).update(answer_count=F('answer_count') + sign)
+    add_option_count(Counter(option_id for question_id, option_id in detail_list), sign)
+    add_sheet_rollup(answer_sheet, sign)
+    # 问卷行最后更新，尽量缩短热点行的锁持有时间
+    Questionnaire.objects.filter(pk=answer_sheet.questionnaire_id).update(answer_count=F('answer_count') + sign)
+
+
+def schedule_sheet_count(answer_sheet, detail_list):
+    # 提交事务回滚时不更新
+    def callback():
+        with transaction.atomic():
+            add_sheet_count(answer_sheet, detail_list)
+    transaction.on_commit(callback)
+
+
+def remove_sheet_count(answer_sheet):
+    detail_list = list(AnswerDetail.objects.filter(sheet=answer_sheet).values_list('question_id', 'option_id'))
+    add_sheet_count(answer_sheet, detail_list, sign=-1)
+
+
+def reset_answer_count(questionnaire_id):
+    # 问卷的全部答卷被删除
+    Option.objects.filter(question__questionnaire_id=questionnaire_id).update(answer_count=0)
+    Question.objects.filter(questionnaire_id=questionnaire_id).update(answer_count=0)
+    Questionnaire.objects.filter(pk=questionnaire_id).update(answer_count=0)
+    reset_rollup(questionnaire_id)
+
+
+def refresh_question_count(questionnaire_id):
+    # 题目增删之后用一条带子查询的UPDATE重新计算题目数
+    question_num = Question.objects.filter(questionnaire_id=OuterRef('pk')).order_by() \
+        .values('questionnaire_id').annotate(num=Count('id')).values('num')
+    Questionnaire.objects.filter(pk=questionnaire_id) \
+        .update(question_count=Coalesce(Subquery(question_num), 0))
+
+
+def refresh_archived_answer_count(question_id_list):
+    # 题目所属问卷的答卷已归档时，按归档文件校正整个问卷的计数，返回这些题目的id
+    archived_dic = dict(Question.objects.filter(pk__in=question_id_list, questionnaire__is_archived=True)
+                        .values_list('id', 'questionnaire_id'))
+    for questionnaire_id in set(archived_dic.values()):
+        reconcile(questionnaire_id)
+    return set(archived_dic)
+
+
+def refresh_question_answer_count(question_id):
+    # 删除选项会级联删除作答明细，题目的答题人数需要重新计算
+    if refresh_archived_answer_count([question_id]):
+        return
+    answer_num = AnswerDetail.objects.filter(question_id=question_id).values('sheet_id').distinct().count()
+    Question.objects.filter(pk=question_id).update(answer_count=answer_num)
+
+
+def refresh_question_list_answer_count(question_id_list):
+    # 批量删除选项之后，受影响题目的答题人数用一条带子查询的UPDATE重新计算
+    question_id_list = set(question_id_list) - refresh_archived_answer_count(question_id_list)
+    answer_num = AnswerDetail.objects.filter(question_id=OuterRef('pk')).order_by() \
+        .values('question_id').annotate(num=Count('sheet_id', distinct=True)).values('num')
+    Question.objects.filter(pk__in=question_id_list).update(answer_count=Coalesce(Subquery(answer_num), 0))
+
+
+def reconcile(questionnaire_id):
+    '''
+        按原始数据重新计算一个问卷的所有计数，返回被校正的行数。
+    '''
+    fixed = 0
+    if Questionnaire.objects.filter(pk=questionnaire_id, is_archived=True).exists():
+        answer_num, question_answer_num_dic, option_answer_num_dic = count_archive(questionnaire_id)
+    else:
+        answer_num = AnswerSheet.objects.filter(questionnaire_id=questionnaire_id).count()
+        question_answer_num_dic = dict(
+            AnswerDetail.objects.filter(question__questionnaire_id=questionnaire_id).order_by()
+            .values('question_id').annotate(num=Count('sheet_id', distinct=True)).values_list('question_id', 'num')
+        )
+        option_answer_num_dic = dict(
+            AnswerDetail.objects.filter(option__question__questionnaire_id=questionnaire_id).order_by()
+            .values('option_id').annotate(num=Count('id')).values_list('option_id', 'num')
+        )
+    question_num = Question.objects.filter(questionnaire_id=questionnaire_id).count()
+    fixed += Questionnaire.objects.filter(pk=questionnaire_id) \
+        .exclude(answer_count=answer_num, question_count=question_num) \
+        .update(answer_count=answer_num, question_count=question_num)
+
+    question_list = [question for question in
+                     Question.objects.filter(questionnaire_id=questionnaire_id).only('id', 'answer_count')
+                     if question.answer_count != question_answer_num_dic.get(question.id, 0)]
+    for question in question_list:
+        question.answer_count = question_answer_num_dic.get(question.id, 0)
+    Question.objects.bulk_update(question_list, ['answer_count'], batch_size=500)
+
+    option_list = [option for option in
+                   Option.objects.filter(question__questionnaire_id=questionnaire_id).only('id', 'answer_count')
+                   if option.answer_count != option_answer_num_dic.get(option.id, 0)]
+    for option in option_list:
+        option.answer_count = option_answer_num_dic.get(option.id, 0)
+    Option.objects.bulk_update(option_list, ['answer_count'], batch_size=500)
+
+    return fixed + len(question_list) + len(option_list)
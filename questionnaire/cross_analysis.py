@@ -0,0 +1,116 @@
+from collections import Counter, defaultdict
+
+from django.db.models import Prefetch
+
+from questionnaire.archive import is_archived, iter_archive_triple
+from questionnaire.models import AnswerDetail, Question, Option
+from questionnaire.ordering import ORDER_FIELD_LIST
+from questionnaire.serializers import QuestionBaseSerializer, OptionBaseSerializer
+
+
+class CrossTable:
+    '''
+        交叉分析。所选题目的(答卷, 题目, 选项)三元组只查询一次(答卷已归档时读归档文件)，之后全部在内存里计算：
+        每道题按答卷对齐成一列，元素为(所选选项下标, 该题作答明细数)；
+        两列zip后按作答模式计数，再把选项对编码为 x下标 * len(y选项) + y下标 累加到计数矩阵。
+    '''
+
+    def __init__(self, questionnaire_id, question_x_list, question_y_list):
+        self.question_x_list = [int(pk) for pk in question_x_list]
+        self.question_y_list = [int(pk) for pk in question_y_list]
+        question_id_list = set(self.question_x_list) | set(self.question_y_list)
+
+        self.question_dic = {}
+        self.option_list_dic = {}
+        self.option_data_dic = {}
+        option_position_dic = {}
+        for question in Question.objects.filter(id__in=question_id_list).prefetch_related(
+                Prefetch('option_list', queryset=Option.objects.order_by(*ORDER_FIELD_LIST))):
+            option_list = list(question.option_list.all())
+            self.question_dic[question.id] = QuestionBaseSerializer(question).data
+            self.option_list_dic[question.id] = option_list
+            self.option_data_dic[question.id] = OptionBaseSerializer(option_list, many=True).data
+            for index, option in enumerate(option_list):
+                option_position_dic[option.id] = (question.id, index)
+
+        # 按答卷收集每道题选中的选项下标和作答明细数
+        sheet_index_dic = {}
+        sheet_option_dic = []
+        sheet_detail_num_dic = []
+        if is_archived(questionnaire_id):
+            triple_list = iter_archive_triple(questionnaire_id, question_id_list)
+        else:
+            triple_list = AnswerDetail.objects.filter(sheet__questionnaire_id=questionnaire_id,
+                                                      question_id__in=question_id_list) \
+                .order_by().values_list('sheet_id', 'question_id', 'option_id')
+        for sheet_id, question_id, option_id in triple_list:
+            sheet_index = sheet_index_dic.get(sheet_id)
+            if sheet_index is None:
+                sheet_index = sheet_index_dic[sheet_id] = len(sheet_option_dic)
+                sheet_option_dic.append(defaultdict(list))
+                sheet_detail_num_dic.append(defaultdict(int))
+            sheet_detail_num_dic[sheet_index][question_id] += 1
+            position = option_position_dic.get(option_id)
+            if position is not None:
+                sheet_option_dic[sheet_index][position[0]].append(position[1])
+
+        self.column_dic = {}
+        for question_id in question_id_list:
+            self.column_dic[question_id] = [
+                (tuple(option_dic.get(question_id, ())), detail_num_dic.get(question_id, 0))
+                for option_dic, detail_num_dic in zip(sheet_option_dic, sheet_detail_num_dic)
+            ]
+
+    def get_question(self, pk):
+        if pk not in self.question_dic:
+            raise Question.DoesNotExist('Question matching query does not exist.')
+        return self.question_dic[pk]
+
+    def count(self, pk_x, pk_y):
+        '''
+            返回 (x_num, pair_num)：x_num[i]为选了x第i个选项且回答了y的答卷数，
+            pair_num[i * len(y) + j]为同时选了x第i个和y第j个选项的答卷数。
+        '''
+        width = len(self.option_list_dic[pk_y])
+        x_num = [0] * len(self.option_list_dic[pk_x])
+        pair_num = [0] * (len(x_num) * width)
+        pattern_counter = Counter(zip(self.column_dic[pk_x], self.column_dic[pk_y]))
+        for ((x_index_list, x_detail_num), (y_index_list, y_detail_num)), sheet_num in pattern_counter.items():
+            if not x_index_list or not y_detail_num:
+                continue
+            for x_index in x_index_list:
+                x_num[x_index] += y_detail_num * sheet_num
+                base = x_index * width
+                for y_index in y_index_list:
+                    pair_num[base + y_index] += sheet_num
+        return x_num, pair_num
+
+    def build_table(self, pk_x, pk_y):
+        table = {
+            'question_x': self.get_question(pk_x),
+            'question_y': self.get_question(pk_y),
+        }
+        x_num, pair_num = self.count(pk_x, pk_y)
+        width = len(self.option_list_dic[pk_y])
+        option_x_list = table['option_x_list'] = []
+        for x_index, option_x_data in enumerate(self.option_data_dic[pk_x]):
+            option_x = dict(option_x_data)
+            option_x_list.append(option_x)
+            option_x['option_y_list'] = []
+            option_x['num'] = x_num[x_index]
+            for y_index, option_y_data in enumerate(self.option_data_dic[pk_y]):
+                option_y = dict(option_y_data)
+                option_x['option_y_list'].append(option_y)
+                option_y['num'] = pair_num[x_index * width + y_index]
+                if option_x['num'] != 0:
+                    option_y['percent'] = int(option_y['num'] / option_x['num'] * 100 * 100) / 100
+                else:
+                    option_y['percent'] = 0
+
+                option_y['percent_string'] = format(option_y['percent'], '.2f') + "%"
+        return table
+
+    def build(self):
+        return {'table_list': [self.build_table(pk_x, pk_y)
+                               for pk_x in self.question_x_list
+                               for pk_y in self.question_y_list]}
@@ -0,0 +1,195 @@
+import random
+import uuid
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from questionnaire.clone import BULK_BATCH_SIZE, bulk_create_id_list
+from questionnaire.counter import reconcile
+from questionnaire.models import Questionnaire, Question, Option, AnswerSheet, AnswerDetail, \
+    QuestionOptionLogicRelation
+from questionnaire.ordering import RANK_GAP
+from questionnaire.rollup import rebuild_rollup
+
+'''
+    生成测试数据：用户、各种类型的问卷、各种类型的题目、逻辑关联和答卷，全部批量插入。
+    答卷按逻辑关联作答(显示条件都没有被选中的题目不作答)，提交时间分布在最近若干天内。
+    生成后按原始数据重新计算冗余计数和时间线汇总，数据与通过接口提交的答卷一致。
+'''
+
+SHEET_CHUNK_SIZE = 1000
+
+QUESTIONNAIRE_TYPE_LIST = [choice[0] for choice in Questionnaire.TYPE_IN_CHOICES]
+QUESTION_TYPE_LIST = [choice[0] for choice in Question.TYPE_IN_CHOICES]
+# 填空题和定位题只有一个小空，作答内容写在这个选项上
+CONTENT_QUESTION_TYPE_LIST = ['completion', 'position']
+
+WORD_LIST = ['满意', '一般', '不满意', '学习', '生活', '食堂', '宿舍', '课程', '老师', '同学', '运动', '图书馆',
+             '交通', '活动', '社团', '考试', '作业', '实验', '比赛', '志愿']
+
+
+class DataGenerator:
+    '''
+        按给定规模生成数据，random_seed相同时生成的内容相同。
+    '''
+
+    def __init__(self, user_num=100, questionnaire_num=2, question_num=20, option_num=4, sheet_num=1000,
+                 logic_rate=0.2, anonymous_rate=0.3, day_num=30, random_seed=0, stdout=None):
+        self.user_num = user_num
+        self.questionnaire_num = questionnaire_num
+        self.question_num = question_num
+        self.option_num = option_num
+        self.sheet_num = sheet_num
+        self.logic_rate = logic_rate
+        self.anonymous_rate = anonymous_rate
+        self.day_num = day_num
+        self.random = random.Random(random_seed)
+        self.stdout = stdout
+        self.tag = uuid.uuid4().hex[:6]
+        self.now = timezone.now()
+
+    def log(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    def get_text(self, word_num=3):
+        return ''.join(self.random.choice(WORD_LIST) for _ in range(word_num))
+
+    def create_user_list(self):
+        # 密码哈希很慢，所有用户共用一个
+        password = make_password('moyu123456')
+        prefix = 'gen_%s_' % self.tag
+        User.objects.bulk_create([User(username='%s%d' % (prefix, index), password=password)
+                                  for index in range(self.user_num)], batch_size=BULK_BATCH_SIZE)
+        return list(User.objects.filter(username__startswith=prefix).order_by('id').values_list('id', flat=True))
+
+    def run(self):
+        '''
+            返回生成的问卷id列表。
+        '''
+        user_id_list = self.create_user_list()
+        self.log('用户：%d' % len(user_id_list))
+        questionnaire_id_list = []
+        for questionnaire_type in QUESTIONNAIRE_TYPE_LIST:
+            for index in range(self.questionnaire_num):
+                questionnaire_id, question_plan_list = self.create_questionnaire(questionnaire_type,
+                                                                                 self.random.choice(user_id_list))
+                detail_num = self.create_sheet_list(questionnaire_id, question_plan_list, user_id_list)
+                reconcile(questionnaire_id)
+                rebuild_rollup(questionnaire_id)
+                questionnaire_id_list.append(questionnaire_id)
+                self.log('问卷%d(%s)：%d张答卷，%d条作答明细' % (questionnaire_id, questionnaire_type,
+                                                        self.sheet_num, detail_num))
+        return questionnaire_id_list
+
+    @transaction.atomic
+    def create_questionnaire(self, questionnaire_type, author_id):
+        shared_date = self.now - timedelta(days=self.day_num)
+        questionnaire = Questionnaire.objects.create(
+            title=self.get_text(), content=self.get_text(8), author_id=author_id, type=questionnaire_type,
+            status='shared', first_shared_date=shared_date, last_shared_date=shared_date,
+            is_show_result=questionnaire_type == 'vote',
+        )
+        question_list = []
+        for index in range(self.question_num):
+            question_type = QUESTION_TYPE_LIST[index % len(QUESTION_TYPE_LIST)]
+            question_list.append(Question(
+                questionnaire_id=questionnaire.id, title=self.get_text(), type=question_type,
+                ordering=index + 1, rank=(index + 1) * RANK_GAP,
+                is_must_answer=self.random.random() < 0.5,
+                is_scoring=questionnaire_type == 'exam' and question_type != 'position',
+                question_score=5 if questionnaire_type == 'exam' else 0,
+            ))
+        question_id_list = bulk_create_id_list(Question, question_list, 'questionnaire_id', [questionnaire.id])
+
+        option_list = []
+        for question, question_id in zip(question_list, question_id_list):
+            option_num = 1 if question.type in CONTENT_QUESTION_TYPE_LIST else self.option_num
+            answer_index = self.random.randrange(option_num)
+            for index in range(option_num):
+                option_list.append(Option(
+                    question_id=question_id, title=self.get_text(2), ordering=index + 1, rank=(index + 1) * RANK_GAP,
+                    is_answer_choice=question.is_scoring and index == answer_index,
+                    answer=self.get_text(1) if question.is_scoring and question.type == 'completion' else '',
+                ))
+        bulk_create_id_list(Option, option_list, 'question_id', question_id_list)
+
+        # 显示条件只指向前面题目的选项，不会形成循环
+        option_id_list_dic = {}
+        for option_id, question_id in Option.objects.filter(question_id__in=question_id_list) \
+                .order_by('id').values_list('id', 'question_id'):
+            option_id_list_dic.setdefault(question_id, []).append(option_id)
+        relation_list = []
+        for index, question_id in enumerate(question_id_list[1:], 1):
+            if self.random.random() < self.logic_rate:
+                condition_question_id = question_id_list[self.random.randrange(index)]
+                relation_list.append(QuestionOptionLogicRelation(
+                    question_id=question_id, option_id=self.random.choice(option_id_list_dic[condition_question_id])))
+        QuestionOptionLogicRelation.objects.bulk_create(relation_list, batch_size=BULK_BATCH_SIZE)
+
+        # 作答时用到的题目信息：[(题目id, 题目类型, [选项id, ...], [显示条件的选项id, ...]), ...]
+        question_plan_list = [
+            (question_id, question.type, option_id_list_dic[question_id],
+             [relation.option_id for relation in relation_list if relation.question_id == question_id])
+            for question, question_id in zip(question_list, question_id_list)
+        ]
+        return questionnaire.id, question_plan_list
+
+    def get_answer_list(self, question_plan_list):
+        # 一张答卷的 [(题目id, 选项id, 填空内容), ...]
+        answer_list = []
+        chosen_set = set()
+        for question_id, question_type, option_id_list, condition_list in question_plan_list:
+            if condition_list and chosen_set.isdisjoint(condition_list):
+                continue
+            if self.random.random() < 0.1:
+                continue
+            if question_type in CONTENT_QUESTION_TYPE_LIST:
+                answer_list.append((question_id, option_id_list[0], self.get_text(2)))
+                continue
+            if question_type == 'multiple-choice':
+                chosen_list = self.random.sample(option_id_list, self.random.randint(1, len(option_id_list)))
+            else:
+                chosen_list = [self.random.choice(option_id_list)]
+            for option_id in chosen_list:
+                chosen_set.add(option_id)
+                answer_list.append((question_id, option_id, None))
+        return answer_list
+
+    def create_sheet_list(self, questionnaire_id, question_plan_list, user_id_list):
+        '''
+            分块插入答卷和作答明细，每块答卷一条批量INSERT，读回id后插入这些答卷的作答明细。返回作答明细数。
+        '''
+        detail_num = 0
+        last_id = 0
+        for start in range(0, self.sheet_num, SHEET_CHUNK_SIZE):
+            sheet_list = []
+            answer_list_list = []
+            for index in range(start, min(start + SHEET_CHUNK_SIZE, self.sheet_num)):
+                modified_time = self.now - timedelta(seconds=self.random.randrange(self.day_num * 24 * 3600))
+                respondent_id = None if self.random.random() < self.anonymous_rate else \
+                    self.random.choice(user_id_list)
+                sheet_list.append(AnswerSheet(
+                    questionnaire_id=questionnaire_id, respondent_id=respondent_id,
+                    started_time=modified_time - timedelta(seconds=self.random.randint(30, 900)),
+                    modified_time=modified_time,
+                    ip='10.%d.%d.%d' % (self.random.randrange(256), self.random.randrange(256),
+                                        self.random.randrange(256)),
+                ))
+                answer_list_list.append(self.get_answer_list(question_plan_list))
+            with transaction.atomic():
+                AnswerSheet.objects.bulk_create(sheet_list, batch_size=BULK_BATCH_SIZE)
+                # 问卷是刚生成的，id大于上一块的答卷都是这一块插入的
+                sheet_id_list = list(AnswerSheet.objects.filter(questionnaire_id=questionnaire_id, id__gt=last_id)
+                                     .order_by('id').values_list('id', flat=True))
+                last_id = sheet_id_list[-1]
+                detail_list = [AnswerDetail(sheet_id=sheet_id, question_id=question_id, option_id=option_id,
+                                            content=content)
+                               for sheet_id, answer_list in zip(sheet_id_list, answer_list_list)
+                               for question_id, option_id, content in answer_list]
+                AnswerDetail.objects.bulk_create(detail_list, batch_size=BULK_BATCH_SIZE)
+            detail_num += len(detail_list)
+        return detail_num
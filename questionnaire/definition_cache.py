@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.core.cache import caches
+
+from questionnaire.models import Option
+from questionnaire.prefetch import get_percent, get_percent_string
+from questionnaire.version import get_version
+
+'''
+    已发布问卷的题目列表缓存。键为问卷id加版本号(问卷修改时间)，题目、选项、逻辑关联的修改都会更新版本号，
+    旧版本的缓存不再被读到，等待过期即可。作答数量和百分比随答卷变化，命中缓存后从冗余计数重新填入。
+    使用的缓存由 settings.QUESTIONNAIRE_CACHE_ALIAS 指定，可以是进程内存、文件或数据库缓存表。
+'''
+
+QUESTIONNAIRE_CACHE_TIMEOUT = 60 * 60
+
+
+def get_definition_cache():
+    return caches[getattr(settings, 'QUESTIONNAIRE_CACHE_ALIAS', 'default')]
+
+
+def get_cache_key(questionnaire):
+    return 'question_list:%d:%s' % (questionnaire.id, get_version(questionnaire))
+
+
+def fill_statistics(question_list_data, questionnaire_id):
+    # 一条查询取出选项和所属题目的计数；没有选项的题目不会有作答，计数为0
+    question_num_dic = {}
+    option_num_dic = {}
+    for option_id, option_num, question_id, question_num in Option.objects.filter(
+            question__questionnaire_id=questionnaire_id
+    ).values_list('id', 'answer_count', 'question_id', 'question__answer_count'):
+        option_num_dic[option_id] = option_num
+        question_num_dic[question_id] = question_num
+    for question_data in question_list_data:
+        question_data['answer_num'] = question_data['answer_count'] = question_num_dic.get(question_data['id'], 0)
+        option_list_data = question_data['option_list']
+        total = sum(option_num_dic.get(option_data['id'], 0) for option_data in option_list_data)
+        for option_data in option_list_data:
+            option_num = option_num_dic.get(option_data['id'], 0)
+            option_data['answer_num'] = option_data['answer_count'] = option_num
+            option_data['percent'] = get_percent(option_num, total)
+            option_data['percent_string'] = get_percent_string(option_num, total)
+
+
+def get_question_list_data(questionnaire, build):
+    '''
+        返回问卷的题目列表json，build()用于缓存未命中时生成。只缓存已发布的问卷，编辑中的问卷直接生成。
+    '''
+    if questionnaire.status != 'shared':
+        return build()
+    cache = get_definition_cache()
+    key = get_cache_key(questionnaire)
+    question_list_data = cache.get(key)
+    if question_list_data is None:
+        question_list_data = build()
+        cache.set(key, question_list_data, getattr(settings, 'QUESTIONNAIRE_CACHE_TIMEOUT',
+                                                   QUESTIONNAIRE_CACHE_TIMEOUT))
+    else:
+        fill_statistics(question_list_data, questionnaire.id)
+    return question_list_data
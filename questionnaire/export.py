@@ -0,0 +1,224 @@
+import csv
+import io
+import re
+import zipfile
+from collections import defaultdict
+from xml.sax.saxutils import escape
+
+from django.db.models import Prefetch, Q
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from questionnaire.archive import is_archived, iter_archive_sheet_chunk
+from questionnaire.models import AnswerSheet, AnswerDetail, Question, Option
+from questionnaire.ordering import ORDER_FIELD_LIST, number
+
+EXPORT_CHUNK_SIZE = 1000
+
+QUESTION_TYPE_DIC = {'multiple-choice': '多选题', 'single-choice': '单选题', 'completion': '填空题',
+                     'scoring': '评分题'}
+
+CONTENT_TYPE_DIC = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+def get_header_and_position(questionnaire_id):
+    # 表头：额外信息 + 每道题的每个选项一列
+    header = ['用户名', '提交答题时间']
+    option_pos_dic = {}
+    question_list = number(list(
+        Question.objects.filter(questionnaire_id=questionnaire_id).order_by(*ORDER_FIELD_LIST)
+        .prefetch_related(Prefetch('option_list', queryset=Option.objects.order_by(*ORDER_FIELD_LIST)))
+    ))
+    for question in question_list:
+        for option in question.option_list.all():
+            option_pos_dic[option.pk] = len(header)
+            header.append(''.join([str(question.ordering), '.',
+                                   question.title, ':', option.title, '[',
+                                   QUESTION_TYPE_DIC.get(question.type, '未知题目类型'), ']']))
+    return header, option_pos_dic
+
+
+def iter_sheet_chunk(questionnaire_id, chunk_size=EXPORT_CHUNK_SIZE):
+    '''
+        按(提交时间, id)做键集分页，每块两条查询：答卷一条，该块答卷的作答明细一条。
+        产出 [(答卷, [(选项id, 填空内容), ...]), ...]，内存只与块大小有关。答卷已归档时按顺序读归档文件。
+    '''
+    if is_archived(questionnaire_id):
+        yield from iter_archive_sheet_chunk(questionnaire_id, chunk_size)
+        return
+    answer_sheet_list = AnswerSheet.objects.filter(questionnaire_id=questionnaire_id) \
+        .order_by('modified_time', 'id')
+    last = None
+    while True:
+        queryset = answer_sheet_list
+        if last is not None:
+            queryset = queryset.filter(Q(modified_time__gt=last[0]) |
+                                       Q(modified_time=last[0], id__gt=last[1]))
+        sheet_list = list(queryset.values_list('id', 'respondent__username', 'modified_time')[:chunk_size])
+        if not sheet_list:
+            return
+        detail_dic = defaultdict(list)
+        detail_list = AnswerDetail.objects.filter(sheet_id__in=[sheet[0] for sheet in sheet_list]) \
+            .order_by('id').values_list('sheet_id', 'option_id', 'content')
+        for sheet_id, option_id, content in detail_list:
+            detail_dic[sheet_id].append((option_id, content))
+        yield [(sheet, detail_dic[sheet[0]]) for sheet in sheet_list]
+        last = (sheet_list[-1][2], sheet_list[-1][0])
+
+
+def iter_export_row(questionnaire_id, chunk_size=EXPORT_CHUNK_SIZE):
+    # 第一行为表头，之后每张答卷一行；选择题记为1，填空题记录填写内容
+    header, option_pos_dic = get_header_and_position(questionnaire_id)
+    yield header
+    for chunk in iter_sheet_chunk(questionnaire_id, chunk_size):
+        for (sheet_id, username, modified_time), detail_list in chunk:
+            row = [None] * len(header)
+            row[0] = username
+            row[1] = timezone.localtime(modified_time).strftime('%Y-%m-%d %H:%M:%S')
+            for option_id, content in detail_list:
+                position = option_pos_dic.get(option_id)
+                if position is None:
+                    continue
+                row[position] = content if content else 1
+            yield row
+
+
+def iter_csv(row_iter, rows_per_chunk=EXPORT_CHUNK_SIZE):
+    buffer = io.StringIO()
+    # 带BOM，Excel打开中文不乱码
+    buffer.write('\ufeff')
+    writer = csv.writer(buffer)
+    for index, row in enumerate(row_iter, 1):
+        writer.writerow(['' if value is None else value for value in row])
+        if index % rows_per_chunk == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+class StreamBuffer:
+    # 只能追加写入的缓冲区，zipfile会按不可seek的流写入数据描述符
+    def __init__(self):
+        self.chunk_list = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunk_list.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunk_list)
+        self.chunk_list = []
+        return data
+
+
+XLSX_NAMESPACE = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+XLSX_RELATIONSHIP = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+XLSX_PACKAGE_RELATIONSHIP = 'http://schemas.openxmlformats.org/package/2006/relationships'
+XLSX_STATIC_PART_LIST = [
+    ('[Content_Types].xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+     '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+     '<Default Extension="xml" ContentType="application/xml"/>'
+     '<Override PartName="/xl/workbook.xml" '
+     'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+     '<Override PartName="/xl/worksheets/sheet1.xml" '
+     'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+     '</Types>'),
+    ('_rels/.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Relationships xmlns="%s">'
+     '<Relationship Id="rId1" Type="%s/officeDocument" Target="xl/workbook.xml"/>'
+     '</Relationships>' % (XLSX_PACKAGE_RELATIONSHIP, XLSX_RELATIONSHIP)),
+    ('xl/workbook.xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<workbook xmlns="%s" xmlns:r="%s">'
+     '<sheets><sheet name="origin_data" sheetId="1" r:id="rId1"/></sheets>'
+     '</workbook>' % (XLSX_NAMESPACE, XLSX_RELATIONSHIP)),
+    ('xl/_rels/workbook.xml.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Relationships xmlns="%s">'
+     '<Relationship Id="rId1" Type="%s/worksheet" Target="worksheets/sheet1.xml"/>'
+     '</Relationships>' % (XLSX_PACKAGE_RELATIONSHIP, XLSX_RELATIONSHIP)),
+]
+# XML 1.0 不允许的控制字符
+XML_ILLEGAL_CHARACTER = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def get_column_letter(index):
+    letter = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letter = chr(65 + remainder) + letter
+    return letter
+
+
+def get_xlsx_row(row_num, row, column_letter_list):
+    cell_list = []
+    for index, value in enumerate(row):
+        if value is None:
+            continue
+        ref = column_letter_list[index] + str(row_num)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cell_list.append('<c r="%s"><v>%s</v></c>' % (ref, value))
+        else:
+            text = escape(XML_ILLEGAL_CHARACTER.sub('', str(value)))
+            cell_list.append('<c r="%s" t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (ref, text))
+    return '<row r="%d">%s</row>' % (row_num, ''.join(cell_list))
+
+
+def iter_xlsx(row_iter, rows_per_chunk=EXPORT_CHUNK_SIZE):
+    '''
+        流式写出xlsx：单元格使用内联字符串，不需要共享字符串表，
+        工作表以zip流的形式逐块压缩输出，内存只与块大小有关，也没有xls的65536行限制。
+    '''
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in XLSX_STATIC_PART_LIST:
+            workbook.writestr(name, content)
+        with workbook.open('xl/worksheets/sheet1.xml', mode='w', force_zip64=True) as worksheet:
+            worksheet.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                             '<worksheet xmlns="%s"><sheetData>' % XLSX_NAMESPACE).encode('utf-8'))
+            column_letter_list = []
+            for row_num, row in enumerate(row_iter, 1):
+                while len(column_letter_list) < len(row):
+                    column_letter_list.append(get_column_letter(len(column_letter_list)))
+                worksheet.write(get_xlsx_row(row_num, row, column_letter_list).encode('utf-8'))
+                if row_num % rows_per_chunk == 0:
+                    yield buffer.pop()
+            worksheet.write(b'</sheetData></worksheet>')
+    yield buffer.pop()
+
+
+EXPORT_WRITER_DIC = {
+    'csv': iter_csv,
+    'xlsx': iter_xlsx,
+}
+
+
+def iter_export(questionnaire_id, file_type):
+    return EXPORT_WRITER_DIC[file_type](iter_export_row(questionnaire_id))
+
+
+def get_export_filename(questionnaire_id, file_type):
+    return 'Questionnaire_' + str(questionnaire_id) + '.' + file_type
+
+
+def export_response(questionnaire_id, file_type):
+    response = StreamingHttpResponse(iter_export(questionnaire_id, file_type),
+                                     content_type=CONTENT_TYPE_DIC[file_type])
+    response['Content-Disposition'] = 'attachment; filename=' + get_export_filename(questionnaire_id, file_type)
+    return response
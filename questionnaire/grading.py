@@ -0,0 +1,98 @@
+from django.core.cache import cache
+
+from questionnaire.models import Question
+from questionnaire.version import get_version
+
+ANSWER_KEY_TIMEOUT = 60 * 60
+
+
+class AnswerKey:
+    '''
+        考试问卷的标准答案：参与评分的题目的类型和分数、正确选项集合、填空题参考答案。
+        按问卷版本缓存，题目或选项变化后版本号改变，自动重新生成。
+    '''
+
+    def __init__(self, questionnaire_id):
+        # 题目id -> (题型, 分数)
+        self.question_dic = {}
+        # 题目id -> [选项id, ...]
+        self.option_list_dic = {}
+        # 题目id -> {正确选项id, ...}
+        self.correct_option_dic = {}
+        # 选项id -> 参考答案
+        self.option_answer_dic = {}
+        question_list = Question.objects.filter(questionnaire_id=questionnaire_id, is_scoring=True) \
+            .prefetch_related('option_list')
+        for question in question_list:
+            self.question_dic[question.id] = (question.type, question.question_score or 0)
+            self.option_list_dic[question.id] = []
+            self.correct_option_dic[question.id] = set()
+            for option in question.option_list.all():
+                self.option_list_dic[question.id].append(option.id)
+                self.option_answer_dic[option.id] = option.answer
+                if option.is_answer_choice:
+                    self.correct_option_dic[question.id].add(option.id)
+
+    def has_scoring_question(self):
+        return bool(self.question_dic)
+
+    def is_right(self, question_id, answer_dic):
+        question_type = self.question_dic[question_id][0]
+        # 选择题：选中的选项集合必须和正确选项集合完全相同
+        if question_type == 'single-choice' or question_type == 'multiple-choice':
+            chosen = {option_id for option_id in self.option_list_dic[question_id] if str(option_id) in answer_dic}
+            return chosen == self.correct_option_dic[question_id]
+        # 填空题：每一个空都要回答，且和参考答案相同
+        if question_type == 'completion':
+            for option_id in self.option_list_dic[question_id]:
+                key = str(option_id)
+                if key not in answer_dic or self.option_answer_dic[option_id] != answer_dic[key]:
+                    return False
+        return True
+
+    def grade(self, questionnaire_data, answer_list):
+        '''
+            评判一次提交，并把结果写入序列化后的问卷数据。
+            作答按选项id建字典，每道题、每个选项只做常数次查找，总体为线性时间。
+        '''
+        answer_dic = {}
+        for answer in answer_list:
+            answer_dic.setdefault(str(answer['option']), answer.get('content', None))
+
+        questionnaire_data['total_score'] = 0
+        questionnaire_data['user_get_score'] = 0
+        questionnaire_data['total_score_question_cnt'] = 0
+        questionnaire_data['user_get_score_question_cnt'] = 0
+        for question in questionnaire_data['question_list']:
+            if question['id'] not in self.question_dic:
+                continue
+            question_type, question_score = self.question_dic[question['id']]
+            for option in question['option_list']:
+                key = str(option['id'])
+                option['is_user_answer'] = key in answer_dic
+                if option['is_user_answer']:
+                    if question_type == 'single-choice':
+                        question['answer_ordering'] = option['ordering']
+                    option['user_answer_content'] = answer_dic[key]
+
+            question['is_user_answer_right'] = self.is_right(question['id'], answer_dic)
+            question['user_get_score'] = question_score if question['is_user_answer_right'] else 0
+            questionnaire_data['total_score'] += question_score
+            questionnaire_data['total_score_question_cnt'] += 1
+            if question['is_user_answer_right']:
+                questionnaire_data['user_get_score'] += question_score
+                questionnaire_data['user_get_score_question_cnt'] += 1
+
+        total = questionnaire_data['total_score_question_cnt']
+        get_score_cnt = questionnaire_data['user_get_score_question_cnt']
+        questionnaire_data['correct_rate'] = format(get_score_cnt / total * 100, '.2f') + "%"
+        return questionnaire_data
+
+
+def get_answer_key(questionnaire):
+    key = 'answer_key:%d:%s' % (questionnaire.id, get_version(questionnaire))
+    answer_key = cache.get(key)
+    if answer_key is None:
+        answer_key = AnswerKey(questionnaire.id)
+        cache.set(key, answer_key, ANSWER_KEY_TIMEOUT)
+    return answer_key
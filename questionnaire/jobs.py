@@ -0,0 +1,272 @@
+import os
+import traceback
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from questionnaire.archive import get_archive_answer_stamp, write_archive, remove_archive, count_archive_row, \
+    iter_restore_chunk, is_archived
+from questionnaire.counter import reset_answer_count, reconcile
+from questionnaire.export import iter_export
+from questionnaire.models import BackgroundJob, AnswerSheet, AnswerDetail, Questionnaire
+from questionnaire.quota import reset_quota
+
+JOB_FILE_DIR = 'jobs'
+
+JOB_EXTENSION_DIC = {
+    'export-xlsx': 'xlsx',
+    'export-csv': 'csv',
+    'report': 'json',
+}
+
+
+def get_answer_stamp(questionnaire_id):
+    # 答卷数和最大答卷id，新增或删除答卷都会改变它。归档前后的值相同
+    if Questionnaire.objects.filter(pk=questionnaire_id, is_archived=True).exists():
+        return get_archive_answer_stamp(questionnaire_id)
+    result = AnswerSheet.objects.filter(questionnaire_id=questionnaire_id) \
+        .aggregate(num=Count('id'), max_id=Max('id'))
+    return '%d-%d' % (result['num'], result['max_id'] or 0)
+
+
+def enqueue(questionnaire, job_type, creator=None):
+    '''
+        添加后台任务。相同问卷、相同类型且答卷没有变化的任务直接复用(已完成的结果或正在排队的任务)。
+    '''
+    answer_stamp = get_answer_stamp(questionnaire.id)
+    job = BackgroundJob.objects.filter(questionnaire=questionnaire, type=job_type,
+                                       status__in=['pending', 'running', 'done'],
+                                       answer_stamp=answer_stamp).first()
+    if job is not None:
+        return job
+    return BackgroundJob.objects.create(questionnaire=questionnaire, type=job_type,
+                                        creator=creator, answer_stamp=answer_stamp)
+
+
+def claim_job(job):
+    # 条件更新抢占任务，多个worker同时运行时同一任务只会被一个worker拿到
+    claimed = BackgroundJob.objects.filter(pk=job.pk, status='pending') \
+        .update(status='running', start_date=timezone.now())
+    if claimed:
+        job.refresh_from_db()
+    return bool(claimed)
+
+
+def claim_next_job():
+    for job in BackgroundJob.objects.filter(status='pending').order_by('create_date', 'id'):
+        if claim_job(job):
+            return job
+    return None
+
+
+def get_job_path(job):
+    return os.path.join(settings.MEDIA_ROOT, job.file)
+
+
+def write_export(job, fp):
+    for chunk in iter_export(job.questionnaire_id, JOB_EXTENSION_DIC[job.type]):
+        fp.write(chunk)
+
+
+def write_report(job, fp):
+    # 延迟导入，避免与序列化器循环引用
+    from questionnaire.serializers import QuestionnaireReportSerializer
+    questionnaire = Questionnaire.objects.get(pk=job.questionnaire_id)
+    # 没有请求对象时，url字段输出相对路径
+    data = QuestionnaireReportSerializer(questionnaire, context={'request': None}).data
+    fp.write(JSONRenderer().render(data))
+
+
+JOB_HANDLER_DIC = {
+    'export-xlsx': write_export,
+    'export-csv': write_export,
+    'report': write_report,
+}
+
+
+# 清除任务：清空问卷的答卷，或彻底删除问卷。
+# 先删作答明细，再删答卷，都按id从小到大分段，每段一条DELETE并立即提交，
+# 锁只持续一段的时间，其他问卷的提交不会被长时间阻塞。清除期间问卷的is_purging为True，不接受新的答卷。
+# 数据量不超过PURGE_INLINE_LIMIT时在请求中直接执行，否则由run_jobs在后台执行并记录进度。
+# 归档答卷(先写归档文件再分段删除)和恢复归档(分段写回)也按同样的方式执行。
+
+PURGE_CHUNK_SIZE = 5000
+PURGE_INLINE_LIMIT = 10000
+
+
+def get_purge_queryset_list(questionnaire_id):
+    return [
+        AnswerDetail.objects.filter(sheet__questionnaire_id=questionnaire_id),
+        AnswerSheet.objects.filter(questionnaire_id=questionnaire_id),
+    ]
+
+
+def count_purge_row(questionnaire_id):
+    return sum(queryset.count() for queryset in get_purge_queryset_list(questionnaire_id))
+
+
+def iter_purge_chunk(questionnaire_id, chunk_size=PURGE_CHUNK_SIZE):
+    # 每删除一段返回这一段的行数
+    for queryset in get_purge_queryset_list(questionnaire_id):
+        last_id = 0
+        while True:
+            id_list = list(queryset.filter(id__gt=last_id).order_by('id')
+                           .values_list('id', flat=True)[:chunk_size])
+            if not id_list:
+                break
+            # 按主键删除：作答明细没有级联对象，是一条直接的DELETE；答卷的明细已先删除
+            queryset.model.objects.filter(id__in=id_list).delete()
+            last_id = id_list[-1]
+            yield len(id_list)
+
+
+def purge_chunk(job):
+    for num in iter_purge_chunk(job.questionnaire_id):
+        job.progress += num
+        BackgroundJob.objects.filter(pk=job.pk).update(progress=job.progress)
+
+
+def purge_answer(job):
+    purge_chunk(job)
+    with transaction.atomic():
+        reset_answer_count(job.questionnaire_id)
+        reset_quota(job.questionnaire_id)
+        Questionnaire.objects.filter(pk=job.questionnaire_id).update(is_purging=False, is_archived=False,
+                                                                      modify_date=timezone.now())
+    remove_archive(job.questionnaire_id)
+
+
+def purge_questionnaire(job):
+    purge_chunk(job)
+    # 答卷已清除，剩下的题目、选项等数据量小，随问卷级联删除。其他任务的结果文件一并删除
+    other_job_list = BackgroundJob.objects.filter(questionnaire_id=job.questionnaire_id).exclude(pk=job.pk)
+    for other_job in other_job_list:
+        if other_job.file and os.path.exists(get_job_path(other_job)):
+            os.remove(get_job_path(other_job))
+    with transaction.atomic():
+        other_job_list.delete()
+        Questionnaire.objects.filter(pk=job.questionnaire_id).delete()
+    remove_archive(job.questionnaire_id)
+    job.questionnaire_id = None
+
+
+def archive_answer(job):
+    # 归档文件写好并标记问卷之后，读取都转向归档文件，再分段删除在线表中的答卷。计数保持不变。
+    # start_purge设置is_purging之后，提交答卷会在事务最后的加锁检查中回滚(AnswerSheetViewSet.save_answer)，
+    # 写归档时在线表的答卷不会再增加，删除的都是已写入归档的答卷。
+    # 上次归档在删除阶段失败时问卷已标记为归档，在线表剩下的答卷都已在归档文件中，只需继续删除
+    if not is_archived(job.questionnaire_id):
+        write_archive(job.questionnaire_id)
+        Questionnaire.objects.filter(pk=job.questionnaire_id).update(is_archived=True, modify_date=timezone.now())
+    purge_chunk(job)
+    Questionnaire.objects.filter(pk=job.questionnaire_id).update(is_purging=False, modify_date=timezone.now())
+
+
+def restore_answer(job):
+    # 按原id分段写回在线表，写完后取消归档标记、按在线表校正计数，最后删除归档文件。
+    # 在线表中剩下的答卷(上次归档或恢复中途失败留下的)都在归档文件中，先删除再整体写回
+    for num in iter_purge_chunk(job.questionnaire_id):
+        pass
+    for num in iter_restore_chunk(job.questionnaire_id):
+        job.progress += num
+        BackgroundJob.objects.filter(pk=job.pk).update(progress=job.progress)
+    # 已删除的题目和选项的作答明细不写回，实际行数可能少于登记时的总数
+    job.total = job.progress
+    with transaction.atomic():
+        Questionnaire.objects.filter(pk=job.questionnaire_id).update(is_archived=False, is_purging=False,
+                                                                      modify_date=timezone.now())
+        reconcile(job.questionnaire_id)
+    remove_archive(job.questionnaire_id)
+
+
+PURGE_HANDLER_DIC = {
+    'purge-answer': purge_answer,
+    'purge-questionnaire': purge_questionnaire,
+    'archive-answer': archive_answer,
+    'restore-answer': restore_answer,
+}
+
+
+def start_purge(questionnaire, job_type, creator=None):
+    '''
+        登记清除任务，问卷进入清除状态。同一问卷已有未完成的清除任务时直接返回该任务。
+        检查和登记在问卷行的锁内进行，并发的请求只会登记一个任务。
+    '''
+    with transaction.atomic():
+        Questionnaire.objects.select_for_update().filter(pk=questionnaire.id).values_list('id', flat=True).get()
+        job = BackgroundJob.objects.filter(questionnaire=questionnaire, type__in=PURGE_HANDLER_DIC,
+                                           status__in=['pending', 'running']).first()
+        if job is not None:
+            return job
+        Questionnaire.objects.filter(pk=questionnaire.id).update(is_purging=True, modify_date=timezone.now())
+        job = BackgroundJob.objects.create(questionnaire=questionnaire, type=job_type, creator=creator)
+    # 计数在锁外进行，任务还没有被执行，总数稍后写入不影响进度
+    if job_type == 'restore-answer':
+        job.total = count_archive_row(questionnaire.id)
+    else:
+        job.total = count_purge_row(questionnaire.id)
+    BackgroundJob.objects.filter(pk=job.pk).update(total=job.total)
+    if job.total <= PURGE_INLINE_LIMIT and claim_job(job):
+        job = run_job(job)
+    return job
+
+
+def run_purge(job):
+    try:
+        PURGE_HANDLER_DIC[job.type](job)
+    except Exception:
+        job.status = 'failed'
+        job.message = traceback.format_exc()
+        # 解除清除状态，问卷可以照常使用，也可以重新发起同样的操作继续完成(各步骤可以重复执行)
+        Questionnaire.objects.filter(pk=job.questionnaire_id).update(is_purging=False, modify_date=timezone.now())
+    else:
+        job.status = 'done'
+    job.finish_date = timezone.now()
+    job.save()
+    return job
+
+
+def run_job(job):
+    if job.type in PURGE_HANDLER_DIC:
+        return run_purge(job)
+    if job.questionnaire_id is None:
+        # 任务执行前问卷已被删除(外键置空)，直接标记失败，否则任务会一直停在执行中
+        job.status = 'failed'
+        job.message = '问卷已被删除'
+        job.finish_date = timezone.now()
+        job.save()
+        return job
+    path = None
+    try:
+        job.answer_stamp = get_answer_stamp(job.questionnaire_id)
+        job.file = os.path.join(JOB_FILE_DIR, '%s_%d_%d.%s' % (job.type, job.questionnaire_id, job.id,
+                                                               JOB_EXTENSION_DIC[job.type]))
+        path = get_job_path(job)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fp:
+            JOB_HANDLER_DIC[job.type](job, fp)
+    except Exception:
+        job.status = 'failed'
+        job.message = traceback.format_exc()
+        job.file = ''
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+    else:
+        job.status = 'done'
+        remove_outdated_job(job)
+    job.finish_date = timezone.now()
+    job.save()
+    return job
+
+
+def remove_outdated_job(job):
+    # 同一问卷同一类型只保留最新的结果文件
+    outdated_list = BackgroundJob.objects.filter(questionnaire_id=job.questionnaire_id, type=job.type,
+                                                 status__in=['done', 'failed']).exclude(pk=job.pk)
+    for outdated in outdated_list:
+        if outdated.file and os.path.exists(get_job_path(outdated)):
+            os.remove(get_job_path(outdated))
+    outdated_list.delete()
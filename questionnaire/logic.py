@@ -0,0 +1,114 @@
+from django.core.cache import cache
+
+from questionnaire.models import Question, QuestionOptionLogicRelation
+from questionnaire.version import get_version
+
+LOGIC_GRAPH_TIMEOUT = 60 * 60
+
+
+def find_cycle_question_list(question_id_list, edge_dic):
+    '''
+        edge_dic为 {题目id: {依赖它的题目id, ...}}，返回处在环上的题目。
+        先按拓扑排序去掉不在环上游的题目，只在剩下的题目之间搜索能回到自身的题目。
+    '''
+    in_degree_dic = {question_id: 0 for question_id in question_id_list}
+    for target_set in edge_dic.values():
+        for target in target_set:
+            in_degree_dic[target] += 1
+    queue = [question_id for question_id, in_degree in in_degree_dic.items() if in_degree == 0]
+    while queue:
+        for target in edge_dic.get(queue.pop(), ()):
+            in_degree_dic[target] -= 1
+            if in_degree_dic[target] == 0:
+                queue.append(target)
+    remain_set = {question_id for question_id, in_degree in in_degree_dic.items() if in_degree > 0}
+
+    cycle_question_list = []
+    for start in question_id_list:
+        if start not in remain_set:
+            continue
+        seen_set = set()
+        stack = [target for target in edge_dic.get(start, ()) if target in remain_set]
+        while stack:
+            question_id = stack.pop()
+            if question_id == start:
+                cycle_question_list.append(start)
+                break
+            if question_id in seen_set:
+                continue
+            seen_set.add(question_id)
+            stack.extend(target for target in edge_dic.get(question_id, ()) if target in remain_set)
+    return cycle_question_list
+
+
+class LogicGraph:
+    '''
+        问卷的逻辑关联图。关联(question, option)表示选项option被选中时显示题目question，
+        一道题目有多个显示条件时满足任意一个即可；没有显示条件的题目总是显示。
+        两条查询建成，按问卷版本缓存，关联变化后版本号改变，自动重新生成。
+    '''
+
+    def __init__(self, questionnaire_id):
+        self.question_id_list = list(Question.objects.filter(questionnaire_id=questionnaire_id)
+                                     .order_by('id').values_list('id', flat=True))
+        # 题目id -> [显示条件的选项id, ...]
+        self.condition_dic = {}
+        # 选项id -> 选项所属的题目id(只记录作为显示条件的选项)
+        self.option_question_dic = {}
+        # 选项id -> [选中后显示的题目id, ...]
+        self.target_dic = {}
+        # 题目id -> [该题目中作为显示条件的选项id, ...]
+        self.question_option_dic = {}
+        for question_id, option_id, option_question_id in QuestionOptionLogicRelation.objects.filter(
+                question__questionnaire_id=questionnaire_id,
+                option__question__questionnaire_id=questionnaire_id
+        ).order_by('id').values_list('question_id', 'option_id', 'option__question_id'):
+            self.condition_dic.setdefault(question_id, []).append(option_id)
+            if option_id not in self.option_question_dic:
+                self.option_question_dic[option_id] = option_question_id
+                self.question_option_dic.setdefault(option_question_id, []).append(option_id)
+            self.target_dic.setdefault(option_id, []).append(question_id)
+
+        edge_dic = {}
+        for option_id, target_list in self.target_dic.items():
+            edge_dic.setdefault(self.option_question_dic[option_id], set()).update(target_list)
+        self.cycle_question_list = find_cycle_question_list(self.question_id_list, edge_dic)
+
+    def get_reachable_question_set(self, option_id_set):
+        # 从总是显示的题目出发，沿被选中的选项找出实际显示的题目。环上的题目没有外部入口时不会显示
+        reachable_set = {question_id for question_id in self.question_id_list if question_id not in self.condition_dic}
+        queue = list(reachable_set)
+        while queue:
+            for option_id in self.question_option_dic.get(queue.pop(), ()):
+                if option_id not in option_id_set:
+                    continue
+                for target in self.target_dic[option_id]:
+                    if target not in reachable_set:
+                        reachable_set.add(target)
+                        queue.append(target)
+        return reachable_set
+
+    def get_hidden_question_list(self, answer_list):
+        '''
+            按这次作答被逻辑隐藏、却带有作答的题目id(升序)。answer_list中每一项带有question_id和option_id。
+        '''
+        if not self.condition_dic:
+            return []
+        reachable_set = self.get_reachable_question_set({answer['option_id'] for answer in answer_list})
+        return sorted({answer['question_id'] for answer in answer_list} - reachable_set)
+
+    def to_data(self):
+        return {
+            'condition': self.condition_dic,
+            'option_question': self.option_question_dic,
+            'cycle': self.cycle_question_list,
+        }
+
+
+def get_logic_graph(questionnaire):
+    key = 'logic_graph:%d:%s' % (questionnaire.id, get_version(questionnaire))
+    logic_graph = cache.get(key)
+    if logic_graph is None:
+        logic_graph = LogicGraph(questionnaire.id)
+        cache.set(key, logic_graph, LOGIC_GRAPH_TIMEOUT)
+    return logic_graph
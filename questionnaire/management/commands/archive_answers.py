@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from questionnaire.jobs import start_purge, claim_job, run_job
+from questionnaire.models import Questionnaire
+
+
+class Command(BaseCommand):
+    help = '把长时间没有修改的未发布问卷的答卷归档到文件，并从在线表中删除'
+
+    def add_arguments(self, parser):
+        parser.add_argument('questionnaire_id', nargs='*', type=int, help='只归档指定的问卷，默认按--days挑选')
+        parser.add_argument('--days', type=int, default=30, help='超过多少天没有修改的问卷才归档')
+
+    def handle(self, *args, **options):
+        questionnaire_list = Questionnaire.objects.exclude(status='shared') \
+            .filter(is_archived=False, is_purging=False, answer_count__gt=0).order_by('id')
+        if options['questionnaire_id']:
+            questionnaire_list = questionnaire_list.filter(id__in=options['questionnaire_id'])
+        else:
+            questionnaire_list = questionnaire_list.filter(
+                modify_date__lt=timezone.now() - timedelta(days=options['days']))
+        total = 0
+        for questionnaire in questionnaire_list.iterator():
+            job = start_purge(questionnaire, 'archive-answer')
+            # 数据量大时start_purge只登记任务，这里直接执行
+            if job.status == 'pending' and claim_job(job):
+                job = run_job(job)
+            self.stdout.write('问卷%d：%s %d/%d' % (questionnaire.id, job.status, job.progress, job.total))
+            total += 1
+        self.stdout.write('共归档%d个问卷' % total)
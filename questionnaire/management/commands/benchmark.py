@@ -0,0 +1,48 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from questionnaire.benchmark import EndpointBenchmark, load_result, compare_result
+from questionnaire.models import Questionnaire
+
+
+class Command(BaseCommand):
+    help = '接口性能测试：通过测试客户端调用详情、填写、提交、报告、交叉分析和导出接口，' \
+           '记录耗时、SQL条数和峰值内存到JSON文件。数据可先用generate_data生成'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--questionnaire', type=int, help='测试的问卷id，默认为答卷最多的已发布问卷')
+        parser.add_argument('--repeat', type=int, default=5, help='每个场景计时运行的次数')
+        parser.add_argument('--scenario', action='append', help='只运行指定的场景，可以重复指定')
+        parser.add_argument('--output', default='benchmark.json', help='结果文件')
+        parser.add_argument('--compare', help='与之前的结果文件对比')
+
+    def handle(self, *args, **options):
+        if options['questionnaire']:
+            questionnaire = Questionnaire.objects.filter(pk=options['questionnaire']).first()
+        else:
+            questionnaire = Questionnaire.objects.filter(status='shared').order_by('-answer_count', 'id').first()
+        if questionnaire is None:
+            raise CommandError('没有可以测试的问卷，请先运行generate_data生成数据')
+        benchmark = EndpointBenchmark(questionnaire, options['repeat'])
+        for name in options['scenario'] or []:
+            if name not in benchmark.scenario_dic:
+                raise CommandError('没有场景%s，可选：%s' % (name, ', '.join(benchmark.scenario_dic)))
+
+        result = benchmark.run(options['scenario'])
+        with open(options['output'], 'w', encoding='utf-8') as fp:
+            json.dump(result, fp, ensure_ascii=False, indent=2)
+
+        self.stdout.write('问卷%d：%d道题，%d张答卷，%d条作答明细' % (
+            questionnaire.id, result['dataset']['question_count'], result['dataset']['answer_count'],
+            result['dataset']['detail_count']))
+        for name, scenario in result['scenario_dic'].items():
+            self.stdout.write('%-16s 中位数%9.2fms  p95%9.2fms  冷启动%9.2fms  SQL%4d条  峰值内存%10.1fKB' % (
+                name, scenario['median_ms'], scenario['p95_ms'], scenario['cold_ms'], scenario['query_count'],
+                scenario['peak_memory_kb']))
+        if options['compare']:
+            for name, previous_median, median, ratio, previous_query, query in \
+                    compare_result(result, load_result(options['compare'])):
+                self.stdout.write('%-16s %9.2fms -> %9.2fms (x%.2f)  SQL %d -> %d' % (
+                    name, previous_median, median, ratio, previous_query, query))
+        self.stdout.write('结果已保存到%s' % options['output'])
@@ -0,0 +1,42 @@
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from questionnaire.models import Questionnaire, Question, Option
+
+
+class Command(BaseCommand):
+    help = '答卷提交性能测试：创建临时问卷，通过测试客户端连续提交答卷，输出每秒提交数，结束后删除测试数据'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--questions', type=int, default=100, help='题目数')
+        parser.add_argument('--options', type=int, default=4, help='每题选项数')
+        parser.add_argument('--submissions', type=int, default=200, help='提交次数')
+
+    def handle(self, *args, **options):
+        author = User.objects.create_user(username='benchmark_' + uuid.uuid4().hex[:8])
+        try:
+            questionnaire = Questionnaire.objects.create(title='提交性能测试', content='', author=author)
+            answer_list = []
+            for ordering in range(1, options['questions'] + 1):
+                question = Question.objects.create(questionnaire=questionnaire, title='题目%d' % ordering,
+                                                   type='single-choice', ordering=ordering)
+                option_list = [Option.objects.create(question=question, title='选项%d' % i, ordering=i)
+                               for i in range(1, options['options'] + 1)]
+                answer_list.append({'question': question.id, 'option': option_list[0].id, 'content': ''})
+            body = {'questionnaire': questionnaire.id, 'answer_list': answer_list}
+
+            client = Client()
+            start = time.perf_counter()
+            for _ in range(options['submissions']):
+                response = client.post('/api/answer/', body, content_type='application/json')
+                if response.status_code != 201:
+                    raise CommandError('提交失败：%s %s' % (response.status_code, response.content[:200]))
+            elapsed = time.perf_counter() - start
+            self.stdout.write('%d 题 x %d 次提交，耗时 %.2f 秒，%.1f 次/秒' % (
+                options['questions'], options['submissions'], elapsed, options['submissions'] / elapsed))
+        finally:
+            author.delete()
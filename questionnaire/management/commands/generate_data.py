@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from questionnaire.datagen import DataGenerator
+
+
+class Command(BaseCommand):
+    help = '批量生成测试数据：用户、每种类型的问卷、每种类型的题目、逻辑关联和答卷，用于复现线上规模的负载'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='用户数')
+        parser.add_argument('--questionnaires', type=int, default=1, help='每种问卷类型生成的问卷数')
+        parser.add_argument('--questions', type=int, default=20, help='每份问卷的题目数')
+        parser.add_argument('--options', type=int, default=4, help='选择题和评分题的选项数')
+        parser.add_argument('--sheets', type=int, default=1000, help='每份问卷的答卷数')
+        parser.add_argument('--logic-rate', type=float, default=0.2, help='带显示条件的题目比例')
+        parser.add_argument('--anonymous-rate', type=float, default=0.3, help='匿名答卷比例')
+        parser.add_argument('--days', type=int, default=30, help='答卷提交时间分布在最近多少天内')
+        parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        generator = DataGenerator(user_num=options['users'], questionnaire_num=options['questionnaires'],
+                                  question_num=options['questions'], option_num=options['options'],
+                                  sheet_num=options['sheets'], logic_rate=options['logic_rate'],
+                                  anonymous_rate=options['anonymous_rate'], day_num=options['days'],
+                                  random_seed=options['seed'], stdout=self.stdout)
+        questionnaire_id_list = generator.run()
+        self.stdout.write('共生成%d份问卷，耗时%.1f秒' % (len(questionnaire_id_list), time.perf_counter() - start))
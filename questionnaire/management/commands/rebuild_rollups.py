@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from questionnaire.models import Questionnaire
+from questionnaire.rollup import rebuild_rollup
+
+
+class Command(BaseCommand):
+    help = '按答卷(已归档的问卷按归档文件)重新生成每小时的答卷数和答题用时汇总，也用于给旧数据补充汇总'
+
+    def add_arguments(self, parser):
+        parser.add_argument('questionnaire_id', nargs='*', type=int, help='只处理指定的问卷，默认全部')
+
+    def handle(self, *args, **options):
+        questionnaire_list = Questionnaire.objects.order_by('id')
+        if options['questionnaire_id']:
+            questionnaire_list = questionnaire_list.filter(id__in=options['questionnaire_id'])
+        total = 0
+        for questionnaire_id in questionnaire_list.values_list('id', flat=True).iterator():
+            total += rebuild_rollup(questionnaire_id)
+        self.stdout.write('共生成%d个时间段' % total)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from questionnaire.models import Questionnaire
+from questionnaire.search import reindex
+
+
+class Command(BaseCommand):
+    help = '重建问卷搜索索引(问卷标题、题目标题、选项标题)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('questionnaire_id', nargs='*', type=int, help='只重建指定的问卷，默认全部')
+
+    def handle(self, *args, **options):
+        questionnaire_list = Questionnaire.objects.order_by('id')
+        if options['questionnaire_id']:
+            questionnaire_list = questionnaire_list.filter(id__in=options['questionnaire_id'])
+        total = 0
+        for questionnaire_id in questionnaire_list.values_list('id', flat=True).iterator():
+            reindex(questionnaire_id)
+            total += 1
+        self.stdout.write('共重建%d个问卷的索引' % total)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from questionnaire.counter import reconcile
+from questionnaire.models import Questionnaire
+
+
+class Command(BaseCommand):
+    help = '按答卷、作答明细和题目表重新计算问卷、题目、选项上的冗余计数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('questionnaire_id', nargs='*', type=int, help='只校正指定的问卷，默认全部')
+
+    def handle(self, *args, **options):
+        questionnaire_list = Questionnaire.objects.order_by('id')
+        if options['questionnaire_id']:
+            questionnaire_list = questionnaire_list.filter(id__in=options['questionnaire_id'])
+        total = 0
+        for questionnaire_id in questionnaire_list.values_list('id', flat=True).iterator():
+            with transaction.atomic():
+                fixed = reconcile(questionnaire_id)
+            if fixed:
+                self.stdout.write('问卷%d：校正%d行' % (questionnaire_id, fixed))
+            total += fixed
+        self.stdout.write('共校正%d行' % total)
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from questionnaire.models import Questionnaire, Question, Option
+from questionnaire.ordering import renormalize
+from questionnaire.version import touch_questionnaire
+
+
+class Command(BaseCommand):
+    help = '重新编号题目和选项的排序键，并把题号写回数据库(也用于给旧数据填充排序键)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('questionnaire_id', nargs='*', type=int, help='只处理指定的问卷，默认全部')
+
+    def handle(self, *args, **options):
+        questionnaire_list = Questionnaire.objects.order_by('id')
+        if options['questionnaire_id']:
+            questionnaire_list = questionnaire_list.filter(id__in=options['questionnaire_id'])
+        total = 0
+        for questionnaire_id in questionnaire_list.values_list('id', flat=True).iterator():
+            with transaction.atomic():
+                changed = renormalize(Question, questionnaire_id)
+                for question_id in Question.objects.filter(questionnaire_id=questionnaire_id) \
+                        .values_list('id', flat=True):
+                    changed += renormalize(Option, question_id)
+                if changed:
+                    touch_questionnaire(questionnaire_id)
+            total += 1
+        self.stdout.write('共处理%d个问卷' % total)
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from questionnaire.jobs import claim_next_job, run_job
+
+
+class Command(BaseCommand):
+    help = '执行后台任务队列(导出、分析报告、清除和归档答卷)，任务保存在数据库中，不依赖外部服务'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='队列为空时退出')
+        parser.add_argument('--interval', type=float, default=2, help='队列为空时的轮询间隔(秒)')
+
+    def handle(self, *args, **options):
+        while True:
+            job = claim_next_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+                continue
+            job = run_job(job)
+            if job.status == 'failed':
+                self.stdout.write('%s %s' % (job, job.message.strip().splitlines()[-1]))
+            else:
+                self.stdout.write('%s %s' % (job, job.file or '%d/%d' % (job.progress, job.total)))
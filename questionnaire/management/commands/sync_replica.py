@@ -0,0 +1,28 @@
+import sqlite3
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from MoyuBackend.db_router import get_replica_alias
+
+
+class Command(BaseCommand):
+    help = '本地用两个SQLite文件代替主库和副本时，把主库复制到副本文件，模拟一次复制。MySQL等数据库的复制由数据库负责'
+
+    def handle(self, *args, **options):
+        alias = get_replica_alias()
+        if alias is None:
+            raise CommandError('没有配置副本(settings.DATABASE_REPLICA_ALIAS)')
+        primary = connections[DEFAULT_DB_ALIAS]
+        replica = connections[alias]
+        if primary.vendor != 'sqlite' or replica.vendor != 'sqlite':
+            raise CommandError('只支持SQLite')
+        primary.ensure_connection()
+        # 副本的持久连接先关闭，复制完成后重新打开
+        replica.close()
+        target = sqlite3.connect(replica.settings_dict['NAME'])
+        try:
+            primary.connection.backup(target)
+        finally:
+            target.close()
+        self.stdout.write('已复制到%s' % replica.settings_dict['NAME'])
@@ -28,6 +28,11 @@ class Questionnaire(models.Model):
         default='closed',
         verbose_name='问卷状态',
     )
+    # 正在分段清除答卷(清空答卷或彻底删除问卷)，清除完成前不接受新的答卷，见jobs.py
+    # 归档和恢复答卷同样按段搬移在线表中的答卷，执行期间也处于此状态
+    is_purging = models.BooleanField(default=False, editable=False, verbose_name='是否正在清除答卷')
+    # 答卷已归档到文件，在线表中不再保存该问卷的答卷，见archive.py
+    is_archived = models.BooleanField(default=False, editable=False, verbose_name='答卷是否已归档')
 
     TYPE_IN_CHOICES = [
         ('normal', '普通问卷'),
@@ -82,17 +87,27 @@ class Questionnaire(models.Model):
     # 用户填写后是否显示填写结果
     is_show_result = models.BooleanField(default=False, verbose_name="是否为填写者显示填写的统计结果")
 
+    # 冗余计数，提交答卷、删除答卷、增删题目时在事务中同步更新，reconcile_counters命令可按原始数据校正
+    answer_count = models.IntegerField(default=0, editable=False, verbose_name='答卷数')
+    question_count = models.IntegerField(default=0, editable=False, verbose_name='题目数')
+
     class Meta:
         ordering = ['-create_date']
+        # 用户问卷列表、回收站按状态过滤后按这些字段分页排序
+        indexes = [
+            models.Index(fields=['author', 'status', 'create_date']),
+            models.Index(fields=['author', 'status', 'last_shared_date']),
+            models.Index(fields=['author', 'status', 'answer_count']),
+        ]
 
     def __str__(self):
         return '_'.join([str(self.pk), self.title])
 
     def get_answer_num(self):
-        return AnswerSheet.objects.filter(questionnaire__id=self.pk).count()
+        return self.answer_count
 
     def get_question_num(self):
-        return Question.objects.filter(questionnaire__id=self.pk).count()
+        return self.question_count
 
 
 class Question(models.Model):
@@ -129,6 +144,8 @@ class Question(models.Model):
     modify_date = models.DateTimeField(auto_now=True, verbose_name='最后修改时间')
 
     ordering = models.PositiveIntegerField(verbose_name='题目序号')
+    # 稀疏排序键，题目按(rank, ordering, id)排序，见ordering.py
+    rank = models.BigIntegerField(default=0, editable=False, verbose_name='排序键')
     is_must_answer = models.BooleanField(default=False, verbose_name='是否必答')
 
     # 投票题的字段
@@ -144,8 +161,20 @@ class Question(models.Model):
     question_score = models.IntegerField(default=0, blank=True, null=True, verbose_name='题目分数')
     answer = models.TextField(blank=True, verbose_name='填空题答案')
 
+    # 冗余计数：回答了该题的答卷数
+    answer_count = models.IntegerField(default=0, editable=False, verbose_name='答题人数')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['questionnaire', 'rank']),
+        ]
+
     def get_answer_num(self):
-        return self.answer_detail_list.values("sheet").distinct().count()
+        return self.answer_count
+
+    # 该题所有选项被选择的次数之和
+    def get_answer_detail_num(self):
+        return self.option_list.aggregate(num=models.Sum('answer_count'))['num'] or 0
 
     def __str__(self):
         return '_'.join([str(self.pk), self.title])
@@ -161,6 +190,8 @@ class Option(models.Model):
     title = models.CharField(max_length=255, verbose_name='选项标题')
     content = models.TextField(verbose_name='选项备注', blank=True)
     ordering = models.PositiveIntegerField(verbose_name='选项序号')
+    # 稀疏排序键，选项按(rank, ordering, id)排序，见ordering.py
+    rank = models.BigIntegerField(default=0, editable=False, verbose_name='排序键')
 
     # 报名功能
     is_limit_answer = models.BooleanField(default=False, verbose_name='是否限制该选项选择人数')
@@ -184,11 +215,19 @@ class Option(models.Model):
                                        verbose_name='以正则表达形式式存储的字段检查正则式')
     is_must_answer = models.BooleanField(default=False, verbose_name='是否必答')
 
+    # 冗余计数：选择该选项的作答明细数
+    answer_count = models.IntegerField(default=0, editable=False, verbose_name='选择人数')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['question', 'rank']),
+        ]
+
     def __str__(self):
         return '_'.join([str(self.pk), self.title])
 
     def get_answer_num(self):
-        return AnswerDetail.objects.filter(option__id=self.pk).count()
+        return self.answer_count
 
 
 class AnswerSheet(models.Model):
@@ -210,6 +249,25 @@ class AnswerSheet(models.Model):
     modified_time = models.DateTimeField(default=timezone.now, verbose_name='回答结束时间')
     ip = models.CharField(max_length=255, blank=True, verbose_name='用户IP地址')
     cname = models.CharField(max_length=255, blank=True, verbose_name='用户地址')
+    # 问卷只允许回答一次时记录答卷人，其余情况为空。(问卷, 该字段)唯一，空值之间不冲突，
+    # 并发的重复提交由数据库拒绝
+    once_respondent = models.ForeignKey(
+        to=User,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        editable=False,
+        verbose_name='只回答一次的答卷人',
+        related_name='+'
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['questionnaire', 'respondent']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['questionnaire', 'once_respondent'], name='unique_once_respondent'),
+        ]
 
 
 class AnswerDetail(models.Model):
@@ -249,4 +307,174 @@ class QuestionOptionLogicRelation(models.Model):
     )
 
     def __str__(self):
-        return self.option.title + "逻辑关联" + self.question.title
\ No newline at end of file
+        return self.option.title + "逻辑关联" + self.question.title
+
+
+class BackgroundJob(models.Model):
+    # 彻底删除问卷的任务完成后问卷不再存在，任务记录保留，问卷置空
+    questionnaire = models.ForeignKey(
+        to='Questionnaire',
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        verbose_name='问卷',
+        related_name='job_list'
+    )
+    creator = models.ForeignKey(
+        to=User,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        verbose_name='创建者',
+        related_name='job_list'
+    )
+    TYPE_IN_CHOICES = [
+        ('export-xlsx', '导出xlsx'),
+        ('export-csv', '导出csv'),
+        ('report', '分析报告'),
+        ('purge-answer', '清空答卷'),
+        ('purge-questionnaire', '彻底删除问卷'),
+        ('archive-answer', '归档答卷'),
+        ('restore-answer', '恢复归档的答卷')
+    ]
+    type = models.CharField(
+        max_length=50,
+        choices=TYPE_IN_CHOICES,
+        verbose_name='任务类型',
+    )
+    STATUS_IN_CHOICES = [
+        ('pending', '等待执行'),
+        ('running', '正在执行'),
+        ('done', '已完成'),
+        ('failed', '执行失败')
+    ]
+    status = models.CharField(
+        max_length=50,
+        choices=STATUS_IN_CHOICES,
+        default='pending',
+        verbose_name='任务状态',
+    )
+    # 生成结果时的答卷状态(答卷数-最大答卷id)，不一致说明有新的答卷，结果需要重新生成
+    answer_stamp = models.CharField(max_length=255, blank=True, verbose_name='答卷版本')
+    file = models.CharField(max_length=255, blank=True, verbose_name='结果文件路径')
+    message = models.TextField(blank=True, verbose_name='错误信息')
+    # 清除任务的进度：已删除的行数/开始时的总行数
+    progress = models.IntegerField(default=0, verbose_name='已处理行数')
+    total = models.IntegerField(default=0, verbose_name='总行数')
+    create_date = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+    start_date = models.DateTimeField(blank=True, null=True, verbose_name='开始执行时间')
+    finish_date = models.DateTimeField(blank=True, null=True, verbose_name='完成时间')
+
+    class Meta:
+        ordering = ['-create_date']
+        indexes = [
+            models.Index(fields=['questionnaire', 'type', 'status']),
+            models.Index(fields=['status', 'create_date']),
+        ]
+
+    def __str__(self):
+        return '_'.join([str(self.pk), self.type, self.status])
+
+
+class AnswerQuota(models.Model):
+    '''
+        限额计数行。只为设置了限额的问卷/选项创建，第一次用到时按实际答卷数初始化，
+        之后通过条件更新 used = used + n WHERE used + n <= 限额 原子地占用名额。
+    '''
+    questionnaire = models.ForeignKey(
+        to='Questionnaire',
+        on_delete=models.CASCADE,
+        verbose_name='问卷',
+        related_name='quota_list'
+    )
+    # questionnaire:<问卷id> 或 option:<选项id>
+    key = models.CharField(max_length=255, unique=True, verbose_name='限额对象')
+    used = models.IntegerField(default=0, verbose_name='已使用名额')
+
+
+class AnswerRollup(models.Model):
+    '''
+        按小时汇总的答卷数和答题用时(提交时间 - 开始答题时间)。提交或删除答卷时增量更新，
+        可由rebuild_rollups命令按答卷重新生成，由rollup.py维护。
+    '''
+    questionnaire = models.ForeignKey(
+        to='Questionnaire',
+        on_delete=models.CASCADE,
+        verbose_name='问卷',
+        related_name='rollup_list'
+    )
+    # 按UTC整点对齐的时间段开始时间
+    bucket = models.DateTimeField(verbose_name='时间段')
+    answer_count = models.IntegerField(default=0, verbose_name='答卷数')
+    duration_sum = models.BigIntegerField(default=0, verbose_name='答题用时总和(毫秒)')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['questionnaire', 'bucket'], name='unique_rollup_bucket'),
+        ]
+
+
+class QuestionnaireTemplate(models.Model):
+    '''
+        用户从已有问卷保存的模板。question_list为题目蓝图(格式见template_create.py)，创建问卷时批量生成题目和选项。
+    '''
+    title = models.CharField(max_length=255, verbose_name='模板标题')
+    author = models.ForeignKey(
+        to=User,
+        on_delete=models.CASCADE,
+        verbose_name='模板作者',
+        related_name='template_list'
+    )
+    type = models.CharField(
+        max_length=50,
+        choices=Questionnaire.TYPE_IN_CHOICES,
+        default='normal',
+        verbose_name='问卷类型',
+    )
+    question_list = models.JSONField(default=list, verbose_name='题目蓝图')
+    create_date = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+    modify_date = models.DateTimeField(auto_now=True, verbose_name='最后修改时间')
+
+    class Meta:
+        ordering = ['-create_date']
+
+    def __str__(self):
+        return '_'.join([str(self.pk), self.title])
+
+
+class SearchGram(models.Model):
+    '''
+        问卷搜索的倒排索引。问卷标题、题目标题、选项标题按字切成二元组(每段文字的最后一个字单独保存)，
+        同一来源的同一个二元组合并为一行，weight为出现次数乘以来源的权重。由search.py维护。
+    '''
+    questionnaire = models.ForeignKey(
+        to='Questionnaire',
+        on_delete=models.CASCADE,
+        verbose_name='问卷',
+        related_name='search_gram_list'
+    )
+    # 冗余问卷作者，按作者搜索时只扫描该作者的索引
+    author = models.ForeignKey(
+        to=User,
+        on_delete=models.CASCADE,
+        verbose_name='问卷作者',
+        related_name='search_gram_list'
+    )
+    SOURCE_IN_CHOICES = [
+        ('title', '问卷标题'),
+        ('question', '题目标题'),
+        ('option', '选项标题')
+    ]
+    source = models.CharField(
+        max_length=50,
+        choices=SOURCE_IN_CHOICES,
+        verbose_name='来源',
+    )
+    gram = models.CharField(max_length=2, verbose_name='二元组')
+    weight = models.IntegerField(default=1, verbose_name='权重')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['author', 'gram']),
+            models.Index(fields=['source', 'gram']),
+        ]
@@ -0,0 +1,152 @@
+from collections import defaultdict
+
+from django.utils import timezone
+from rest_framework import serializers
+
+from questionnaire.clone import BULK_BATCH_SIZE, bulk_create_id_list
+from questionnaire.counter import refresh_question_count, refresh_question_list_answer_count
+from questionnaire.models import Question, Option
+from questionnaire.ordering import RANK_GAP
+
+'''
+    嵌套保存(整份问卷或整道题目)时题目和选项的批量更新。
+    一次读出现有的题目和选项，与提交的数据比较：带id的更新有变化的字段，不带id的新建，提交中没有的删除。
+    每张表至多一条批量INSERT、一条批量UPDATE和一条DELETE，查询数量与题目数量无关。
+    提交列表的顺序即为显示顺序，rank和ordering按位置重新写入。
+    部分更新(PATCH)时提交的列表只是要修改和新建的部分：不删除任何题目和选项，现有的位置不变，新建的排在最后。
+    批量操作不触发信号，调用方应在同一事务中保存问卷，由问卷的保存更新版本和搜索索引。
+'''
+
+
+def diff_instance(instance, data, changed_field_set):
+    # 把data中与instance不同的字段写入instance，返回是否有变化
+    changed = False
+    for field, value in data.items():
+        if getattr(instance, field) != value:
+            setattr(instance, field, value)
+            changed_field_set.add(field)
+            changed = True
+    return changed
+
+
+def iter_position_data(data_list, current_dic, partial):
+    # 按提交顺序给出 (id, 写入的数据)
+    if not partial:
+        for index, data in enumerate(data_list):
+            data = dict(data, ordering=index + 1, rank=(index + 1) * RANK_GAP)
+            yield data.pop('id', None), data
+        return
+    rank = max((instance.rank for instance in current_dic.values()), default=0)
+    ordering = len(current_dic)
+    for data in data_list:
+        data = dict(data)
+        data.pop('ordering', None)
+        data.pop('rank', None)
+        instance_id = data.pop('id', None)
+        if instance_id is None:
+            rank += RANK_GAP
+            ordering += 1
+            data.update(ordering=ordering, rank=rank)
+        yield instance_id, data
+
+
+def get_option_dic(queryset):
+    # {题目id: {选项id: 选项}}
+    option_dic = defaultdict(dict)
+    for option in queryset:
+        option_dic[option.question_id][option.id] = option
+    return option_dic
+
+
+def apply_option_list(option_list_data_dic, current_option_dic, partial=False):
+    '''
+        option_list_data_dic为 {题目id: 提交的选项列表}，current_option_dic为这些题目现有的选项。
+        返回删除了选项的题目id列表，这些题目的作答明细被级联删除，答题人数需要重新计算。
+    '''
+    new_list = []
+    changed_list = []
+    changed_field_set = set()
+    delete_id_list = []
+    affected_question_id_list = []
+    for question_id, option_list_data in option_list_data_dic.items():
+        current_dic = current_option_dic.get(question_id, {})
+        reserve_id_set = set()
+        for option_id, option_data in iter_position_data(option_list_data, current_dic, partial):
+            if option_id is None:
+                new_list.append(Option(question_id=question_id, **option_data))
+            elif option_id in current_dic:
+                reserve_id_set.add(option_id)
+                if diff_instance(current_dic[option_id], option_data, changed_field_set):
+                    changed_list.append(current_dic[option_id])
+            else:
+                raise serializers.ValidationError({'option_list': '选项%d不属于题目%d' % (option_id, question_id)})
+        if partial:
+            continue
+        remove_id_list = [option_id for option_id in current_dic if option_id not in reserve_id_set]
+        if remove_id_list:
+            delete_id_list.extend(remove_id_list)
+            affected_question_id_list.append(question_id)
+
+    if delete_id_list:
+        Option.objects.filter(id__in=delete_id_list).delete()
+    if changed_list:
+        Option.objects.bulk_update(changed_list, sorted(changed_field_set), batch_size=BULK_BATCH_SIZE)
+    Option.objects.bulk_create(new_list, batch_size=BULK_BATCH_SIZE)
+    return affected_question_id_list
+
+
+def apply_question_option_list(question_id, option_list_data, partial=False):
+    # 单道题目的选项嵌套保存
+    current_option_dic = get_option_dic(Option.objects.filter(question_id=question_id))
+    affected_question_id_list = apply_option_list({question_id: option_list_data}, current_option_dic, partial)
+    refresh_question_list_answer_count(affected_question_id_list)
+
+
+def apply_question_list(questionnaire_id, question_list_data, partial=False):
+    '''
+        问卷的题目嵌套保存。没有提交option_list的题目，其选项保持不变。
+    '''
+    current_dic = {question.id: question for question in Question.objects.filter(questionnaire_id=questionnaire_id)}
+    current_option_dic = get_option_dic(Option.objects.filter(question__questionnaire_id=questionnaire_id))
+
+    new_list = []
+    new_option_data_list = []
+    changed_list = []
+    changed_field_set = set()
+    option_list_data_dic = {}
+    for question_id, question_data in iter_position_data(question_list_data, current_dic, partial):
+        question_data.pop('questionnaire', None)
+        option_list_data = question_data.pop('option_list', None)
+        if question_id is None:
+            new_list.append(Question(questionnaire_id=questionnaire_id, **question_data))
+            new_option_data_list.append(option_list_data)
+            continue
+        if question_id not in current_dic:
+            raise serializers.ValidationError({'question_list': '题目%d不属于该问卷' % question_id})
+        if diff_instance(current_dic[question_id], question_data, changed_field_set):
+            changed_list.append(current_dic[question_id])
+        if option_list_data is not None:
+            option_list_data_dic[question_id] = option_list_data
+
+    reserve_id_set = {question_data.get('id') for question_data in question_list_data}
+    delete_id_list = [] if partial else \
+        [question_id for question_id in current_dic if question_id not in reserve_id_set]
+    if delete_id_list:
+        Question.objects.filter(id__in=delete_id_list).delete()
+    if changed_list:
+        # bulk_update不会自动更新auto_now字段
+        now = timezone.now()
+        for question in changed_list:
+            question.modify_date = now
+        Question.objects.bulk_update(changed_list, sorted(changed_field_set | {'modify_date'}),
+                                     batch_size=BULK_BATCH_SIZE)
+    new_id_list = bulk_create_id_list(Question, new_list, 'questionnaire_id', [questionnaire_id],
+                                      exclude_id_list=list(current_dic))
+    for question_id, option_list_data in zip(new_id_list, new_option_data_list):
+        if option_list_data:
+            option_list_data_dic[question_id] = option_list_data
+
+    affected_question_id_list = apply_option_list(option_list_data_dic, current_option_dic, partial)
+    refresh_question_list_answer_count(affected_question_id_list)
+    if delete_id_list or new_list:
+        refresh_question_count(questionnaire_id)
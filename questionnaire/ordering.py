@@ -0,0 +1,183 @@
+from django.db import transaction
+from django.db.models import Q
+
+from questionnaire.models import Question, Option
+
+'''
+    题目和选项的顺序。顺序由稀疏的排序键rank决定(相邻两项默认相差RANK_GAP)，
+    插入或移动一项时只取前后两个邻居的rank，给这一行写入两者之间的值，其余行不变。
+    相邻rank之间没有空隙时重新编号(renormalize)：rank重新拉开间距，ordering同步为连续的题号。
+
+    ordering是给用户看的题号，每次插入、移动、复制、删除之后按当前顺序写回(renumber，一条批量UPDATE，
+    只更新位置有变化的行)，逐条读取的接口和交叉分析直接使用。批量读取时仍按位置编号(number)，
+    兼容执行renormalize_ordering之前的旧数据。
+    排序一律使用ORDER_FIELD_LIST，旧数据rank都为0时按原来的ordering排序。
+'''
+
+RANK_GAP = 1024
+
+ORDER_FIELD_LIST = ['rank', 'ordering', 'id']
+
+# 模型对应的上级字段
+PARENT_FIELD_DIC = {
+    Question: 'questionnaire_id',
+    Option: 'question_id',
+}
+
+
+def number(instance_list):
+    # 已按顺序排好的题目或选项，按位置编号
+    for index, instance in enumerate(instance_list):
+        instance.ordering = index + 1
+    return instance_list
+
+
+def renumber(model, parent_id):
+    '''
+        按当前顺序把ordering写为连续的位置，只更新有变化的行，返回更新的行数。
+    '''
+    changed_list = []
+    for index, instance in enumerate(get_sibling_queryset(model, parent_id).only('id', 'ordering')):
+        if instance.ordering != index + 1:
+            instance.ordering = index + 1
+            changed_list.append(instance)
+    model.objects.bulk_update(changed_list, ['ordering'], batch_size=500)
+    return len(changed_list)
+
+
+def get_sibling_queryset(model, parent_id, exclude_id=None):
+    queryset = model.objects.filter(**{PARENT_FIELD_DIC[model]: parent_id}).order_by(*ORDER_FIELD_LIST)
+    if exclude_id is not None:
+        queryset = queryset.exclude(pk=exclude_id)
+    return queryset
+
+
+def get_before_condition(instance):
+    # 按(rank, ordering, id)排在instance之前的条件
+    return Q(rank__lt=instance.rank) | Q(rank=instance.rank, ordering__lt=instance.ordering) | \
+        Q(rank=instance.rank, ordering=instance.ordering, id__lt=instance.id)
+
+
+def get_position(model, instance):
+    # instance当前的实际位置(从1开始)
+    parent_id = getattr(instance, PARENT_FIELD_DIC[model])
+    return get_sibling_queryset(model, parent_id).filter(get_before_condition(instance)).count() + 1
+
+
+def apply_order(model, instance_list):
+    # 按instance_list的顺序写入rank和ordering，一条批量UPDATE，只更新有变化的行
+    changed_list = []
+    for index, instance in enumerate(instance_list):
+        rank, ordering = (index + 1) * RANK_GAP, index + 1
+        if instance.rank != rank or instance.ordering != ordering:
+            instance.rank, instance.ordering = rank, ordering
+            changed_list.append(instance)
+    model.objects.bulk_update(changed_list, ['rank', 'ordering'], batch_size=500)
+    return len(changed_list)
+
+
+def renormalize(model, parent_id):
+    '''
+        重新编号：rank拉开为RANK_GAP的倍数，ordering改为连续的题号。
+    '''
+    return apply_order(model, list(get_sibling_queryset(model, parent_id).only('id', 'rank', 'ordering')))
+
+
+def get_rank(model, parent_id, position=None, exclude_id=None):
+    '''
+        第position个位置(从1开始，None表示末尾)应使用的rank，exclude_id为正在移动的那一项。
+        只读取前后两个邻居；没有空隙时先重新编号再计算。
+    '''
+    for retry in range(2):
+        rank_queryset = get_sibling_queryset(model, parent_id, exclude_id).values_list('rank', flat=True)
+        if position is None:
+            before, after = rank_queryset.reverse().first(), None
+        elif position <= 1:
+            before, after = None, rank_queryset.first()
+        else:
+            neighbor_list = list(rank_queryset[position - 2:position])
+            if len(neighbor_list) == 2:
+                before, after = neighbor_list
+            else:
+                # 位置在末尾或超出末尾，放到最后
+                before, after = rank_queryset.reverse().first(), None
+        if after is None:
+            return RANK_GAP if before is None else before + RANK_GAP
+        before = before or 0
+        if after - before > 1:
+            return (before + after) // 2
+        renormalize(model, parent_id)
+    raise RuntimeError('重新编号后仍没有空隙')
+
+
+def get_moved_rank(model, instance, position):
+    # instance移动到第position个位置时应使用的rank，位置没有变化时返回None
+    if position is None or position == get_position(model, instance):
+        return None
+    return get_rank(model, getattr(instance, PARENT_FIELD_DIC[model]), position, exclude_id=instance.id)
+
+
+def get_rank_after(model, instance):
+    # 紧接在instance之后的位置应使用的rank
+    parent_id = getattr(instance, PARENT_FIELD_DIC[model])
+    for retry in range(2):
+        after = get_sibling_queryset(model, parent_id).exclude(pk=instance.pk) \
+            .exclude(get_before_condition(instance)).values_list('rank', flat=True).first()
+        if after is None:
+            return instance.rank + RANK_GAP
+        if after - instance.rank > 1:
+            return (instance.rank + after) // 2
+        renormalize(model, parent_id)
+        instance.refresh_from_db(fields=['rank', 'ordering'])
+    raise RuntimeError('重新编号后仍没有空隙')
+
+
+def move(model, parent_id, position_dic):
+    '''
+        把position_dic({id: 目标位置})中的多项一起移动，其余各项保持相对顺序。
+        在内存中排出最终顺序，给移动的项取前后邻居之间的rank，一条批量UPDATE写移动的行的rank
+        和位置变化的行的ordering；邻居之间放不下时整体重新编号。
+    '''
+    instance_list = list(get_sibling_queryset(model, parent_id).only('id', 'rank', 'ordering'))
+    instance_dic = {instance.id: instance for instance in instance_list}
+    order_list = [instance for instance in instance_list if instance.id not in position_dic]
+    for position, pk in sorted((position, pk) for pk, position in position_dic.items()):
+        order_list.insert(max(position, 1) - 1, instance_dic[pk])
+
+    # 连续移动的几项作为一段，均匀分布在这一段前后两个不动的邻居之间
+    changed_set = set()
+    index = 0
+    while index < len(order_list):
+        if order_list[index].id not in position_dic:
+            index += 1
+            continue
+        end = index
+        while end < len(order_list) and order_list[end].id in position_dic:
+            end += 1
+        before = order_list[index - 1].rank if index > 0 else 0
+        after = order_list[end].rank if end < len(order_list) else before + (end - index + 1) * RANK_GAP
+        step = (after - before) // (end - index + 1)
+        if step < 1:
+            return apply_order(model, order_list)
+        for offset, instance in enumerate(order_list[index:end]):
+            instance.rank = before + step * (offset + 1)
+            changed_set.add(instance)
+        index = end
+    for index, instance in enumerate(order_list):
+        if instance.ordering != index + 1:
+            instance.ordering = index + 1
+            changed_set.add(instance)
+    model.objects.bulk_update(list(changed_set), ['rank', 'ordering'], batch_size=500)
+    return len(changed_set)
+
+
+@transaction.atomic
+def reorder(model, parent_id, id_list):
+    '''
+        按id_list给出的完整顺序一次性重排，一条批量UPDATE。id_list必须恰好是该上级下的全部题目/选项。
+    '''
+    instance_dic = {instance.id: instance for instance in
+                    model.objects.filter(**{PARENT_FIELD_DIC[model]: parent_id}).only('id', 'rank', 'ordering')}
+    if len(id_list) != len(instance_dic) or set(id_list) != set(instance_dic):
+        raise ValueError('排序列表与现有内容不一致')
+    return apply_order(model, [instance_dic[pk] for pk in id_list])
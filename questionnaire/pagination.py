@@ -0,0 +1,159 @@
+import json
+from base64 import b64decode, b64encode
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q, IntegerField
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+'''
+    问卷列表的键集(游标)分页。
+    只有请求带了 cursor 或 page_size 参数时才分页，否则保持原来返回整个列表的行为。
+    排序沿用查询集上已有的排序字段(如 -create_date、last_shared_date、-answer_count)，再以id兜底保证顺序唯一。
+    下一页的条件是 (排序字段, id) 严格排在游标之后，配合 (author, status, 排序字段) 的联合索引，
+    翻到第几页都只扫描一页的数据。
+'''
+
+
+# 问卷列表支持的排序关键字，回收数按冗余计数排序
+SORT_FIELD_DIC = {
+    'create_date': 'create_date',
+    'last_shared_date': 'last_shared_date',
+    'answer_num': 'answer_count',
+}
+
+
+def get_sort_field(keyword):
+    # 关键字前可以带一个'-'表示倒序。只接受SORT_FIELD_DIC中的关键字，其他值返回400，不会作为字段名进入查询
+    if not isinstance(keyword, str):
+        keyword = ''
+    descending = keyword.startswith('-')
+    field = SORT_FIELD_DIC.get(keyword[1:] if descending else keyword)
+    if field is None:
+        raise ValidationError({'message': '排序关键字应为%s之一，前面加-表示倒序' % '、'.join(SORT_FIELD_DIC)})
+    return '-' + field if descending else field
+
+
+class QuestionnaireCursorPagination(BasePagination):
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 20
+    max_page_size = 100
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_ordering(self, queryset):
+        # 排序字段取查询集的第一个排序项，没有时用模型默认排序，再没有则按id
+        ordering_list = list(queryset.query.order_by) or list(queryset.model._meta.ordering) or ['pk']
+        ordering = ordering_list[0]
+        if ordering.lstrip('-') in ('id', 'pk'):
+            return None, ordering.startswith('-')
+        return ordering.lstrip('-'), ordering.startswith('-')
+
+    def encode_cursor(self, instance, reverse):
+        value = None if self.field_name is None else getattr(instance, self.field_name)
+        if value is not None and not isinstance(value, (int, str)):
+            value = value.isoformat()
+        data = json.dumps({'v': value, 'id': instance.pk, 'r': reverse})
+        return b64encode(data.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            data = json.loads(b64decode(encoded.encode('ascii')).decode('utf-8'))
+            value = data['v']
+            if value is not None and self.field_name is not None:
+                value = self.get_field(self.field_name).to_python(value)
+            return value, int(data['id']), bool(data['r'])
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound('无效的分页游标')
+
+    def get_field(self, field_name):
+        # 按注解排序(例如搜索得分)时没有对应的模型字段，注解都是整数
+        try:
+            return self.model._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            return IntegerField()
+
+    def get_after_condition(self, value, pk, descending):
+        '''
+            (排序字段, id) 严格排在 (value, pk) 之后的条件。NULL按最小值处理，与MySQL/SQLite的排序一致。
+        '''
+        pk_lookup = 'pk__lt' if descending else 'pk__gt'
+        if self.field_name is None:
+            return Q(**{pk_lookup: pk})
+        field = self.field_name
+        if value is None:
+            condition = Q(**{field + '__isnull': True, pk_lookup: pk})
+            if not descending:
+                condition |= Q(**{field + '__isnull': False})
+            return condition
+        condition = Q(**{field + ('__lt' if descending else '__gt'): value}) | Q(**{field: value, pk_lookup: pk})
+        if descending:
+            condition |= Q(**{field + '__isnull': True})
+        return condition
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params \
+                and self.page_size_query_param not in request.query_params:
+            return None
+        self.request = request
+        self.model = queryset.model
+        self.page_size = self.get_page_size(request)
+        self.field_name, self.descending = self.get_ordering(queryset)
+        cursor = self.decode_cursor(request)
+        # 向前翻页时反转排序方向取数据，取出后再反转回来
+        reverse = cursor is not None and cursor[2]
+        descending = self.descending != reverse
+
+        direction = '-' if descending else ''
+        if self.field_name is None:
+            queryset = queryset.order_by(direction + 'pk')
+        else:
+            queryset = queryset.order_by(direction + self.field_name, direction + 'pk')
+        if cursor is not None:
+            queryset = queryset.filter(self.get_after_condition(cursor[0], cursor[1], descending))
+
+        # 多取一条用来判断是否还有下一页
+        result_list = list(queryset[:self.page_size + 1])
+        has_more = len(result_list) > self.page_size
+        result_list = result_list[:self.page_size]
+        if reverse:
+            result_list.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.page = result_list
+        return result_list
+
+    def get_link(self, instance, reverse):
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(instance, reverse))
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.get_link(self.page[-1], False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+        return self.get_link(self.page[0], True)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
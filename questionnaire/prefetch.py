@@ -0,0 +1,90 @@
+from collections import defaultdict
+
+from django.db.models import Prefetch, Q
+
+from questionnaire.models import Question, Option, QuestionOptionLogicRelation
+from questionnaire.ordering import ORDER_FIELD_LIST, number
+
+
+class AnswerStatistics:
+    '''
+        作答数量统计：每个选项被选择的次数、每道题的作答明细数，以及每道题的作答人数(去重答卷)。
+        直接读取题目和选项上的冗余计数(见counter.py)，不需要查询作答明细；question_list需预取option_list。
+    '''
+
+    def __init__(self, question_list):
+        self.option_num_dic = defaultdict(int)
+        self.question_detail_num_dic = defaultdict(int)
+        self.question_answer_num_dic = defaultdict(int)
+
+        for question in question_list:
+            self.question_answer_num_dic[question.id] = question.answer_count
+            for option in question.option_list.all():
+                self.option_num_dic[option.id] = option.answer_count
+                self.question_detail_num_dic[question.id] += option.answer_count
+
+    def option_num(self, option_id):
+        return self.option_num_dic[option_id]
+
+    def question_detail_num(self, question_id):
+        return self.question_detail_num_dic[question_id]
+
+    def question_answer_num(self, question_id):
+        return self.question_answer_num_dic[question_id]
+
+
+def get_percent(option_num, total):
+    if total != 0:
+        return int(option_num / total * 100 * 100) / 100
+    else:
+        return 0
+
+
+def get_percent_string(option_num, total):
+    if total != 0:
+        return format(option_num / total * 100, '.2f') + "%"
+    else:
+        return '0.00%'
+
+
+class QuestionnaireBundle:
+    '''
+        问卷详情渲染所需的全部数据：题目(按序号)、选项、逻辑关联和作答统计。
+        查询数量固定，与题目和选项的数量无关，序列化器通过context['bundle']读取。
+    '''
+
+    def __init__(self, questionnaire):
+        self.questionnaire = questionnaire
+        # 反向外键的prefetch会回填option.question，题目序号不需要再查询；序号按读出的位置编号
+        self.question_list = number(list(
+            questionnaire.question_list.all().order_by(*ORDER_FIELD_LIST).prefetch_related(
+                Prefetch('option_list', queryset=Option.objects.order_by(*ORDER_FIELD_LIST))
+            )
+        ))
+        ordering_dic = {}
+        for question in self.question_list:
+            ordering_dic[(Question, question.id)] = question.ordering
+            for option in number(list(question.option_list.all())):
+                ordering_dic[(Option, option.id)] = option.ordering
+
+        # 题目关联的选项，以及选项关联的题目，一次查询取出
+        self.question_logic_option_dic = defaultdict(list)
+        self.option_logic_question_dic = defaultdict(list)
+        relation_list = QuestionOptionLogicRelation.objects.filter(
+            Q(question__questionnaire_id=questionnaire.id) |
+            Q(option__question__questionnaire_id=questionnaire.id)
+        ).select_related('question', 'option__question').order_by('id')
+        for relation in relation_list:
+            # 关联另取出的题目和选项也使用编号后的序号，跨问卷的关联保持数据库中的值
+            for instance in (relation.question, relation.option, relation.option.question):
+                instance.ordering = ordering_dic.get((type(instance), instance.id), instance.ordering)
+            self.question_logic_option_dic[relation.question_id].append(relation.option)
+            self.option_logic_question_dic[relation.option_id].append(relation.question)
+
+        self.statistics = AnswerStatistics(self.question_list)
+
+    def get_relate_logic_option(self, question_id):
+        return self.question_logic_option_dic.get(question_id, [])
+
+    def get_related_logic_question(self, option_id):
+        return self.option_logic_question_dic.get(option_id, [])
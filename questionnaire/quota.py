@@ -0,0 +1,107 @@
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from questionnaire.models import AnswerQuota, AnswerSheet, AnswerDetail, Option
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def get_quota_list(questionnaire, answer_list):
+    '''
+        一次提交需要占用的名额 [(key, 限额, 数量, 统计已使用数量的函数), ...]，选项按id排序
+    '''
+    quota_list = []
+    if questionnaire.is_limit_answer:
+        quota_list.append(('questionnaire:%d' % questionnaire.id, questionnaire.limit_answer_number, 1,
+                           lambda: AnswerSheet.objects.filter(questionnaire_id=questionnaire.id).count()))
+
+    option_num_dic = Counter(int(answer['option']) for answer in answer_list)
+    limit_option_list = Option.objects.filter(pk__in=option_num_dic, is_limit_answer=True) \
+        .order_by('id').values_list('id', 'limit_answer_number')
+    for option_id, limit in limit_option_list:
+        quota_list.append(('option:%d' % option_id, limit, option_num_dic[option_id],
+                           lambda option_id=option_id: AnswerDetail.objects.filter(option_id=option_id).count()))
+    return quota_list
+
+
+def create_quota(questionnaire_id, key, count_used):
+    # 在保存点内创建，并发创建违反唯一约束时说明计数行已经存在
+    try:
+        with transaction.atomic():
+            AnswerQuota.objects.create(key=key, questionnaire_id=questionnaire_id, used=count_used())
+    except IntegrityError:
+        pass
+
+
+def seed_quota(questionnaire, answer_list):
+    '''
+        在提交事务之外创建还没有的计数行，每一行单独提交，提交事务中只做条件更新
+    '''
+    quota_list = get_quota_list(questionnaire, answer_list)
+    if not quota_list:
+        return
+    exist_set = set(AnswerQuota.objects.filter(key__in=[quota[0] for quota in quota_list])
+                    .values_list('key', flat=True))
+    for key, _, _, count_used in quota_list:
+        if key not in exist_set:
+            create_quota(questionnaire.id, key, count_used)
+
+
+def take_quota(questionnaire_id, key, limit, num, count_used):
+    # 条件更新本身就是原子的，名额不足时更新0行。UPDATE读取最新提交的行，
+    # 不受可重复读快照的影响，其他事务刚创建的计数行也能更新到
+    queryset = AnswerQuota.objects.filter(key=key, used__lte=limit - num)
+    if queryset.update(used=F('used') + num):
+        return
+    if AnswerQuota.objects.select_for_update().filter(key=key).exists():
+        raise QuotaExceeded(key)
+    # 计数行在seed_quota之后被重置，在保存点内重新创建后再更新一次
+    create_quota(questionnaire_id, key, count_used)
+    if not queryset.update(used=F('used') + num):
+        raise QuotaExceeded(key)
+
+
+def acquire_quota(questionnaire, answer_list):
+    '''
+        为一次提交占用名额，名额不足时抛出QuotaExceeded，调用方需回滚事务。
+        没有设置限额的问卷和选项不会产生任何写操作，也就不会加锁；按id顺序加锁，避免并发提交互相等待形成死锁。
+    '''
+    for key, limit, num, count_used in get_quota_list(questionnaire, answer_list):
+        take_quota(questionnaire.id, key, limit, num, count_used)
+
+
+def release_quota(answer_sheet):
+    # 删除一张答卷时归还它占用的名额，需要在删除答卷的事务中、作答明细被删除之前调用。
+    # 加锁顺序与acquire_quota相同；没有计数行的问卷和选项更新0行
+    AnswerQuota.objects.filter(key='questionnaire:%d' % answer_sheet.questionnaire_id).update(used=F('used') - 1)
+    option_num_dic = Counter(AnswerDetail.objects.filter(sheet=answer_sheet).values_list('option_id', flat=True))
+    limit_option_list = Option.objects.filter(pk__in=option_num_dic, is_limit_answer=True) \
+        .order_by('id').values_list('id', flat=True)
+    for option_id in limit_option_list:
+        AnswerQuota.objects.filter(key='option:%d' % option_id).update(used=F('used') - option_num_dic[option_id])
+
+
+def get_option_limit_dic(option_queryset):
+    return {option_id: (is_limit_answer, limit_answer_number) for option_id, is_limit_answer, limit_answer_number
+            in option_queryset.values_list('id', 'is_limit_answer', 'limit_answer_number')}
+
+
+def reset_changed_option_quota(before_dic, option_queryset):
+    # 与修改前比较，只丢弃限额设置被修改和已经删除的选项的计数行
+    after_dic = get_option_limit_dic(option_queryset)
+    key_list = ['option:%d' % option_id for option_id in before_dic.keys() | after_dic.keys()
+                if before_dic.get(option_id) != after_dic.get(option_id)]
+    if key_list:
+        AnswerQuota.objects.filter(key__in=key_list).delete()
+
+
+def reset_quota(questionnaire_id, key_list=None):
+    # 限额设置被修改或答卷被清除后丢弃计数行，下次提交时按实际答卷数重新初始化。key_list为None时丢弃问卷的全部计数行
+    queryset = AnswerQuota.objects.filter(questionnaire_id=questionnaire_id)
+    if key_list is not None:
+        queryset = queryset.filter(key__in=key_list)
+    queryset.delete()
@@ -0,0 +1,65 @@
+from collections import defaultdict
+
+from django.db.models import Prefetch
+
+from questionnaire.archive import iter_archive_detail
+from questionnaire.models import AnswerDetail, Option
+from questionnaire.ordering import ORDER_FIELD_LIST, number
+from questionnaire.prefetch import AnswerStatistics
+from user_info.serializers import UserDescSerializer
+
+ANSWER_ROW_CHUNK_SIZE = 2000
+
+
+class ReportBundle:
+    '''
+        问卷分析报告的数据：题目和选项两条查询，作答数量和百分比来自题目和选项上的冗余计数，
+        每条作答明细由一条联表查询逐块读出(答卷已归档时从归档文件读出)，直接组装成AnswerDetailReportSerializer的格式。
+    '''
+
+    def __init__(self, questionnaire):
+        self.questionnaire = questionnaire
+        self.question_list = number(list(
+            questionnaire.question_list.all().order_by(*ORDER_FIELD_LIST).prefetch_related(
+                Prefetch('option_list', queryset=Option.objects.order_by(*ORDER_FIELD_LIST))
+            )
+        ))
+        for question in self.question_list:
+            number(list(question.option_list.all()))
+        self.statistics = AnswerStatistics(self.question_list)
+        self.answer_list_dic = self.load_answer_list(questionnaire.id)
+
+    def load_answer_list(self, questionnaire_id):
+        answer_list_dic = defaultdict(list)
+        anonymous = UserDescSerializer(None).data
+        if self.questionnaire.is_archived:
+            row_list = iter_archive_detail(questionnaire_id)
+        else:
+            row_list = AnswerDetail.objects.filter(option__question__questionnaire_id=questionnaire_id) \
+                .order_by('id') \
+                .values_list('id', 'content', 'sheet_id', 'question_id', 'option_id',
+                             'sheet__ip', 'sheet__modified_time',
+                             'sheet__respondent_id', 'sheet__respondent__username') \
+                .iterator(chunk_size=ANSWER_ROW_CHUNK_SIZE)
+        for (detail_id, content, sheet_id, question_id, option_id,
+             ip, modified_time, respondent_id, username) in row_list:
+            if respondent_id is None:
+                respondent = anonymous
+            else:
+                respondent = {'id': respondent_id, 'username': username}
+            answer_list_dic[option_id].append({
+                'id': detail_id,
+                'respondent': respondent,
+                'ip': ip,
+                'modified_time': modified_time,
+                # ordering为0的原因是，方便前端修改增加序号等。
+                'ordering': 0,
+                'content': content,
+                'sheet': sheet_id,
+                'question': question_id,
+                'option': option_id,
+            })
+        return answer_list_dic
+
+    def get_answer_list(self, option_id):
+        return self.answer_list_dic.get(option_id, [])
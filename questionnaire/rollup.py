@@ -0,0 +1,137 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from questionnaire.archive import iter_archive_sheet_time
+from questionnaire.models import AnswerRollup, AnswerSheet, Questionnaire
+
+'''
+    答卷时间线。AnswerRollup按(问卷, 整点)保存答卷数和答题用时总和，
+    提交答卷时对所在小时的一行做 F() 增量更新(不存在时插入)，删除答卷时减去，清空答卷时删除。
+    时间线接口只读取汇总行，按天汇总时在内存中把小时合并到本地时区的日期，耗时与时间段数量有关，与答卷数量无关。
+'''
+
+ROLLUP_CHUNK_SIZE = 2000
+
+TIMELINE_UNIT_LIST = ['hour', 'day']
+
+MILLISECOND = timedelta(milliseconds=1)
+
+
+def get_bucket(value):
+    # 所在UTC整点
+    return value.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def get_duration(started_time, modified_time):
+    # 答题用时(毫秒)，开始时间晚于提交时间的异常数据记为0
+    return max((modified_time - started_time) // MILLISECOND, 0)
+
+
+def add_sheet_rollup(answer_sheet, sign=1):
+    '''
+        提交(sign=1)或删除(sign=-1)一张答卷后更新所在小时的汇总行，在调用方的事务中执行。
+    '''
+    bucket = get_bucket(answer_sheet.modified_time)
+    duration = get_duration(answer_sheet.started_time, answer_sheet.modified_time)
+    queryset = AnswerRollup.objects.filter(questionnaire_id=answer_sheet.questionnaire_id, bucket=bucket)
+    change = {'answer_count': F('answer_count') + sign, 'duration_sum': F('duration_sum') + sign * duration}
+    if queryset.update(**change) or sign < 0:
+        return
+    # 这个小时的第一张答卷。并发插入时唯一约束冲突，在保存点内回滚后改为更新
+    try:
+        with transaction.atomic():
+            AnswerRollup.objects.create(questionnaire_id=answer_sheet.questionnaire_id, bucket=bucket,
+                                        answer_count=1, duration_sum=duration)
+    except IntegrityError:
+        queryset.update(**change)
+
+
+def reset_rollup(questionnaire_id):
+    AnswerRollup.objects.filter(questionnaire_id=questionnaire_id).delete()
+
+
+def iter_sheet_time(questionnaire_id):
+    if Questionnaire.objects.filter(pk=questionnaire_id, is_archived=True).exists():
+        return iter_archive_sheet_time(questionnaire_id)
+    return AnswerSheet.objects.filter(questionnaire_id=questionnaire_id).order_by() \
+        .values_list('started_time', 'modified_time').iterator(chunk_size=ROLLUP_CHUNK_SIZE)
+
+
+@transaction.atomic
+def rebuild_rollup(questionnaire_id):
+    '''
+        按答卷(或归档文件)重新生成问卷的汇总行，返回汇总行数。
+    '''
+    bucket_dic = {}
+    for started_time, modified_time in iter_sheet_time(questionnaire_id):
+        rollup = bucket_dic.setdefault(get_bucket(modified_time), [0, 0])
+        rollup[0] += 1
+        rollup[1] += get_duration(started_time, modified_time)
+    reset_rollup(questionnaire_id)
+    AnswerRollup.objects.bulk_create([
+        AnswerRollup(questionnaire_id=questionnaire_id, bucket=bucket, answer_count=answer_count,
+                     duration_sum=duration_sum)
+        for bucket, (answer_count, duration_sum) in bucket_dic.items()
+    ], batch_size=500)
+    return len(bucket_dic)
+
+
+def parse_time(value):
+    # 接受日期(本地时区当天0点)或日期时间，没有时区时按本地时区；格式不正确时抛出ValueError
+    if not value:
+        return None
+    result = parse_datetime(value)
+    if result is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError('时间格式不正确')
+        result = datetime(date.year, date.month, date.day)
+    if timezone.is_naive(result):
+        result = timezone.make_aware(result)
+    return result
+
+
+def get_average_duration(answer_count, duration_sum):
+    # 平均答题用时(秒)
+    if answer_count == 0:
+        return 0
+    return round(duration_sum / answer_count / 1000, 2)
+
+
+def get_timeline(questionnaire_id, unit='hour', start=None, end=None):
+    '''
+        [start, end)之间每小时或每天(本地时区)的答卷数和平均答题用时，只返回有答卷的时间段。
+    '''
+    queryset = AnswerRollup.objects.filter(questionnaire_id=questionnaire_id, answer_count__gt=0)
+    if start is not None:
+        queryset = queryset.filter(bucket__gte=start)
+    if end is not None:
+        queryset = queryset.filter(bucket__lt=end)
+    bucket_dic = {}
+    for bucket, answer_count, duration_sum in queryset.order_by('bucket') \
+            .values_list('bucket', 'answer_count', 'duration_sum'):
+        if unit == 'day':
+            bucket = timezone.localtime(bucket).replace(hour=0, minute=0, second=0, microsecond=0)
+        rollup = bucket_dic.setdefault(bucket, [0, 0])
+        rollup[0] += answer_count
+        rollup[1] += duration_sum
+
+    answer_count = sum(rollup[0] for rollup in bucket_dic.values())
+    duration_sum = sum(rollup[1] for rollup in bucket_dic.values())
+    return {
+        'unit': unit,
+        'answer_count': answer_count,
+        'average_duration': get_average_duration(answer_count, duration_sum),
+        'bucket_list': [
+            {
+                'time': timezone.localtime(bucket),
+                'answer_count': bucket_answer_count,
+                'average_duration': get_average_duration(bucket_answer_count, bucket_duration_sum),
+            }
+            for bucket, (bucket_answer_count, bucket_duration_sum) in bucket_dic.items()
+        ],
+    }
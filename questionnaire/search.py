@@ -0,0 +1,185 @@
+import re
+import unicodedata
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Q, Sum, Max, Case, When, Value, IntegerField, Exists, OuterRef, Subquery
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from questionnaire.models import Questionnaire, Question, Option, SearchGram
+
+'''
+    问卷搜索。标题大多是中文，不适合按词切分，这里按字切成二元组建立倒排索引：
+    搜索词的每个二元组都要命中，并且搜索词完整地出现在标题、题目或选项中，再按命中行的权重之和排序。单字搜索用前缀匹配二元组，
+    每段文字的最后一个字单独存一行，保证任何一个字都能被前缀匹配到。
+    问卷、题目、选项保存或删除后，在事务提交时重建该问卷的索引，同一事务中只重建一次；
+    嵌套保存题目和选项时放在一个事务中，一次请求只重建一次。
+'''
+
+SOURCE_WEIGHT_DIC = {
+    'title': 10,
+    'question': 3,
+    'option': 1,
+}
+
+WORD_RE = re.compile(r'\w+')
+
+
+def split_word(text):
+    return WORD_RE.findall(unicodedata.normalize('NFKC', text or '').lower())
+
+
+def get_index_gram_list(text):
+    gram_list = []
+    for word in split_word(text):
+        gram_list.extend(word[i:i + 2] for i in range(len(word) - 1))
+        gram_list.append(word[-1])
+    return gram_list
+
+
+def get_query_gram_list(text):
+    # 搜索词的二元组，单字的段落保留单字，用前缀匹配
+    gram_set = set()
+    for word in split_word(text):
+        if len(word) == 1:
+            gram_set.add(word)
+        else:
+            gram_set.update(word[i:i + 2] for i in range(len(word) - 1))
+    return sorted(gram_set)
+
+
+def get_gram_condition(gram):
+    if len(gram) == 1:
+        return Q(gram__startswith=gram)
+    return Q(gram=gram)
+
+
+def reindex(questionnaire_id):
+    '''
+        重建一个问卷的索引，问卷已被删除时什么都不做(索引随问卷级联删除)。
+    '''
+    questionnaire = Questionnaire.objects.filter(pk=questionnaire_id).values('author_id', 'title').first()
+    if questionnaire is None:
+        return
+    text_dic = {
+        'title': [questionnaire['title']],
+        'question': Question.objects.filter(questionnaire_id=questionnaire_id).values_list('title', flat=True),
+        'option': Option.objects.filter(question__questionnaire_id=questionnaire_id).values_list('title', flat=True),
+    }
+    gram_list = []
+    for source, text_list in text_dic.items():
+        gram_num_dic = Counter()
+        for text in text_list:
+            gram_num_dic.update(get_index_gram_list(text))
+        gram_list.extend(SearchGram(questionnaire_id=questionnaire_id, author_id=questionnaire['author_id'],
+                                    source=source, gram=gram, weight=num * SOURCE_WEIGHT_DIC[source])
+                         for gram, num in gram_num_dic.items())
+    with transaction.atomic():
+        SearchGram.objects.filter(questionnaire_id=questionnaire_id).delete()
+        SearchGram.objects.bulk_create(gram_list, batch_size=1000)
+
+
+def schedule_reindex(questionnaire_id):
+    # 事务提交后再重建：级联删除问卷时不会为正在删除的问卷写入新的索引。
+    # 同一事务中批量修改同一问卷的多行时只登记一次
+    connection = transaction.get_connection()
+    if connection.in_atomic_block and any(getattr(func, 'questionnaire_id', None) == questionnaire_id
+                                          for sids, func in connection.run_on_commit):
+        return
+
+    def callback():
+        reindex(questionnaire_id)
+    callback.questionnaire_id = questionnaire_id
+    transaction.on_commit(callback)
+
+
+def get_match_queryset(keyword, author=None, source_list=None):
+    '''
+        命中搜索词全部二元组的问卷，按得分从高到低排序，返回 questionnaire_id 和 score。
+        搜索词中没有可索引的文字时返回None。
+    '''
+    gram_list = get_query_gram_list(keyword)
+    if not gram_list:
+        return None
+    condition = Q()
+    for gram in gram_list:
+        condition |= get_gram_condition(gram)
+    gram_queryset = SearchGram.objects.filter(condition)
+    if author is not None:
+        gram_queryset = gram_queryset.filter(author=author)
+    if source_list is not None:
+        gram_queryset = gram_queryset.filter(source__in=source_list)
+    # 每个搜索二元组是否被命中，全部命中才算匹配
+    hit_list = [Max(Case(When(get_gram_condition(gram), then=Value(1)), default=Value(0),
+                         output_field=IntegerField()))
+                for gram in gram_list]
+    return gram_queryset.order_by().values('questionnaire_id') \
+        .annotate(score=Sum('weight'), hit=sum(hit_list[1:], hit_list[0])) \
+        .filter(hit=len(gram_list)) \
+        .order_by('-score', '-questionnaire_id')
+
+
+def get_exact_condition(keyword, source_list=None):
+    '''
+        二元组可能分别来自不同的文字(例如一半在标题、一半在选项)，命中全部二元组的问卷还要确认
+        搜索词的每一段完整地出现在同一段文字中。
+    '''
+    source_list = source_list or list(SOURCE_WEIGHT_DIC)
+    condition = Q()
+    for word in split_word(keyword):
+        word_condition = Q()
+        if 'title' in source_list:
+            word_condition |= Q(title__icontains=word)
+        if 'question' in source_list:
+            word_condition |= Q(Exists(Question.objects.filter(questionnaire_id=OuterRef('pk'), title__icontains=word)))
+        if 'option' in source_list:
+            word_condition |= Q(Exists(Option.objects.filter(question__questionnaire_id=OuterRef('pk'),
+                                                             title__icontains=word)))
+        condition &= word_condition
+    return condition
+
+
+def search(queryset, keyword, author=None, source_list=None):
+    '''
+        在queryset(问卷)中搜索，返回匹配的问卷，带有得分search_score，按得分从高到低排序，可以直接用游标分页。
+        搜索词中没有可索引的文字时返回None。
+    '''
+    match_queryset = get_match_queryset(keyword, author, source_list)
+    if match_queryset is None:
+        return None
+    score_queryset = match_queryset.filter(questionnaire_id=OuterRef('pk')).values('score')
+    return queryset.filter(id__in=match_queryset.values('questionnaire_id')) \
+        .filter(get_exact_condition(keyword, source_list)) \
+        .annotate(search_score=Subquery(score_queryset, output_field=IntegerField())) \
+        .order_by('-search_score', '-id')
+
+
+# 问卷被删除时索引随之级联删除，不需要处理。只更新了其他字段的保存(update_fields中没有标题)不需要重建
+def is_title_saved(update_fields):
+    return update_fields is None or 'title' in update_fields
+
+
+@receiver(post_save, sender=Questionnaire)
+def reindex_questionnaire(sender, instance, update_fields=None, **kwargs):
+    if is_title_saved(update_fields):
+        schedule_reindex(instance.id)
+
+
+@receiver(post_save, sender=Question)
+def reindex_question(sender, instance, update_fields=None, **kwargs):
+    if is_title_saved(update_fields):
+        schedule_reindex(instance.questionnaire_id)
+
+
+@receiver(post_delete, sender=Question)
+def reindex_deleted_question(sender, instance, **kwargs):
+    schedule_reindex(instance.questionnaire_id)
+
+
+@receiver(post_save, sender=Option)
+def reindex_option(sender, instance, update_fields=None, **kwargs):
+    # 创建选项时传入的题目已缓存在实例上，不再查询。
+    # 选项不注册删除信号，级联删除时保留快速删除；删除选项的视图自己登记重建
+    if is_title_saved(update_fields):
+        schedule_reindex(instance.question.questionnaire_id)
@@ -1,7 +1,18 @@
+from django.db import transaction
 from rest_framework import serializers
-
-from questionnaire.models import Questionnaire, Question, Option, AnswerSheet, AnswerDetail, QuestionOptionLogicRelation
-from questionnaire.template_create import Template
+from rest_framework.reverse import reverse
+
+from questionnaire.models import Questionnaire, Question, Option, AnswerSheet, AnswerDetail, QuestionOptionLogicRelation, \
+    BackgroundJob, QuestionnaireTemplate
+from questionnaire.counter import schedule_sheet_count
+from questionnaire.definition_cache import get_question_list_data
+from questionnaire.logic import get_logic_graph
+from questionnaire.nested_update import apply_question_list, apply_question_option_list
+from questionnaire.ordering import RANK_GAP, ORDER_FIELD_LIST, number
+from questionnaire.prefetch import QuestionnaireBundle, get_percent, get_percent_string
+from questionnaire.quota import get_option_limit_dic, reset_changed_option_quota, reset_quota
+from questionnaire.report import ReportBundle
+from questionnaire.template_create import Blueprint, get_builtin_blueprint, get_template_blueprint, materialize
 from user_info.serializers import UserDescSerializer
 
 
@@ -74,27 +85,32 @@ class OptionNestSerializer(serializers.ModelSerializer):
         return instance.question.ordering
 
     def get_related_logic_question(self, instance):
-        question_list = Question.objects.filter(logic_option_list__option_id=instance.id)
+        bundle = self.context.get('bundle')
+        if bundle is not None:
+            question_list = bundle.get_related_logic_question(instance.id)
+        else:
+            question_list = Question.objects.filter(logic_option_list__option_id=instance.id)
         return QuestionBaseSerializer(question_list, many=True).data
 
     def get_answer_num(self, option):
+        bundle = self.context.get('bundle')
+        if bundle is not None:
+            return bundle.statistics.option_num(option.id)
         return option.get_answer_num()
 
+    # 选项被选次数，以及该题所有作答明细数
+    def get_option_num_and_total(self, instance):
+        bundle = self.context.get('bundle')
+        if bundle is not None:
+            return (bundle.statistics.option_num(instance.id),
+                    bundle.statistics.question_detail_num(instance.question_id))
+        return instance.get_answer_num(), instance.question.get_answer_detail_num()
+
     def get_percent(self, instance):
-        option_num = instance.answer_detail_list.count()
-        total = instance.question.answer_detail_list.count()
-        if total != 0:
-            return int(option_num / total * 100 * 100) / 100
-        else:
-            return 0
+        return get_percent(*self.get_option_num_and_total(instance))
 
     def get_percent_string(self, instance):
-        option_num = instance.answer_detail_list.count()
-        total = instance.question.answer_detail_list.count()
-        if total != 0:
-            return format(option_num / total * 100, '.2f') + "%"
-        else:
-            return '0.00%'
+        return get_percent_string(*self.get_option_num_and_total(instance))
 
     class Meta:
         model = Option
@@ -109,6 +125,9 @@ class QuestionSerializer(serializers.ModelSerializer):
     answer_num = serializers.SerializerMethodField(read_only=True)
 
     def get_answer_num(self, question):
+        bundle = self.context.get('bundle')
+        if bundle is not None:
+            return bundle.statistics.question_answer_num(question.id)
         return question.get_answer_num()
 
     class Meta:
@@ -120,38 +139,29 @@ class QuestionSerializer(serializers.ModelSerializer):
         if option_list_data is not None:
             validated_data.pop('option_list')
 
-        question = Question.objects.create(**validated_data)
+        # 在一个事务中创建题目和选项，搜索索引在提交后只重建一次
+        with transaction.atomic():
+            question = Question.objects.create(**validated_data)
 
-        if option_list_data is not None:
-            for option in option_list_data:
-                option['id'] = None
-                Option.objects.create(question=question, **option)
+            if option_list_data is not None:
+                for index, option in enumerate(option_list_data):
+                    option['id'] = None
+                    Option.objects.create(question=question, rank=(index + 1) * RANK_GAP, **option)
         return question
 
     def update(self, instance, validated_data):
-        option_list_data = validated_data.get('option_list')
-        if option_list_data is not None:
-            validated_data.pop('option_list')
-            reserve_options_list = []
-            for option_data in option_list_data:
-                op_id = option_data.get('id')
-                # 如果选项ID存在，说明该选项是被更新的，保留。
-                if op_id is not None:
-                    option_instance = Option.objects.get(id=op_id)
-                    reserve_options_list.append(option_data.pop('id'))
-                    super().update(option_instance, option_data)
-                # 如果选项ID不存在，说明该选项是要创建的，保留
-                else:
-                    opt = Option.objects.create(question_id=instance.id, **option_data)
-                    reserve_options_list.append(opt.id)
-            # 删除那些不在此次PUT json中的数据
-            all_option = Option.objects.filter(question_id=instance.id)
-            for option in all_option:
-                if option.id not in reserve_options_list:
-                    option.delete()
-        # 更新非嵌套的内容
-        super().update(instance, validated_data)
-
+        option_list_data = validated_data.pop('option_list', None)
+        option_queryset = Option.objects.filter(question_id=instance.id)
+        with transaction.atomic():
+            # 更新非嵌套的内容。保存会写入整行，冗余计数要在这之后重新计算
+            super().update(instance, validated_data)
+            if option_list_data is not None:
+                # 选项与现有选项比较后批量新建、更新和删除；PATCH时不删除
+                limit_dic = get_option_limit_dic(option_queryset)
+                apply_question_option_list(instance.id, option_list_data, self.partial)
+                instance.refresh_from_db(fields=['answer_count'])
+                # 只重新初始化限额设置被修改的选项的计数
+                reset_changed_option_quota(limit_dic, option_queryset)
         return instance
 
 
@@ -161,63 +171,89 @@ class QuestionNestSerializer(QuestionSerializer):
     relate_logic_option = serializers.SerializerMethodField(read_only=True)
 
     def get_relate_logic_option(self, instance):
-        option_list = Option.objects.filter(logic_question_list__question_id=instance.id)
+        bundle = self.context.get('bundle')
+        if bundle is not None:
+            option_list = bundle.get_relate_logic_option(instance.id)
+        else:
+            option_list = Option.objects.filter(logic_question_list__question_id=instance.id)
         return OptionBaseSerializer(option_list, many=True).data
 
 
 # QuestionNestSerializer，获取更多详细的信息。
 class QuestionnaireDetailSerializer(QuestionnaireBaseSerializer):
     question_list = serializers.SerializerMethodField(required=False)
+    # 创建问卷时使用的用户模板，不传则使用问卷类型对应的内置模板
+    template = serializers.PrimaryKeyRelatedField(queryset=QuestionnaireTemplate.objects.defer('question_list'),
+                                                  write_only=True, required=False)
 
     '''
         解析问卷。一次性传入，然后看题目的id是否存在。类似于题目选项的写法，难点是封装成一个递归函数
     '''
 
     def get_question_list(self, instance):
-        question_list = instance.question_list.all().order_by('ordering')
-        return QuestionNestSerializer(question_list, many=True).data
+        return get_question_list_data(instance, lambda: self.build_question_list(instance))
+
+    def build_question_list(self, instance):
+        # 批量加载题目、选项、逻辑和统计数据，查询数量不随题目数量增长
+        bundle = QuestionnaireBundle(instance)
+        return QuestionNestSerializer(bundle.question_list, many=True,
+                                      context=dict(self.context, bundle=bundle)).data
+
+    def validate_template(self, template):
+        # 只能使用自己的模板，别人的模板与不存在的模板返回同样的错误
+        request = self.context.get('request')
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_authenticated or template.author_id != user.id:
+            raise serializers.ValidationError('模板不存在')
+        return template
 
     def create(self, validated_data):
-        questionnaire = Questionnaire.objects.create(**validated_data)
-        questionnaire_type = questionnaire.type
-        template = Template()
-        if questionnaire_type == 'vote':
-            template.vote(questionnaire)
-        elif questionnaire_type == 'signup':
-            template.signup(questionnaire)
-        elif questionnaire_type == 'exam':
-            template.exam(questionnaire)
-        elif questionnaire_type == 'epidemic-check-in':
-            template.epidemic_check_in(questionnaire)
+        template = validated_data.pop('template', None)
+        if template is not None:
+            blueprint = get_template_blueprint(template)
+        else:
+            blueprint = get_builtin_blueprint(validated_data.get('type', 'normal'))
+        question_count = len(blueprint) if blueprint is not None else 0
+        with transaction.atomic():
+            questionnaire = Questionnaire.objects.create(question_count=question_count, **validated_data)
+            if blueprint is not None:
+                materialize(blueprint, questionnaire)
 
         return questionnaire
 
-    def update(self, instance, validated_data):
-        question_list_data = validated_data.get('question_list')
-        question_class = QuestionSerializer()
+    def to_internal_value(self, data):
+        validated_data = super().to_internal_value(data)
+        # question_list是只读的方法字段，整体保存问卷时单独校验
+        question_list_data = data.get('question_list') if self.instance is not None else None
         if question_list_data is not None:
-            validated_data.pop('question_list')
-            reverse_question_list = []
-            for question_data in question_list_data:
-                question_id = question_data.get('id')
-                # 如果题目ID存在，说明该题目是要被更新的
-                if question_id is not None:
-                    question = Question.objects.get(id=question_id)
-                    reverse_question_list.append(question_data.pop('id'))
-                    # 因为question下面还有一层option需要处理，所以不能用原生的super().update方法
-                    question_class.update(question, question_data)
-                # 如果题目ID不存在，说明要新建一个题目
-                else:
-                    print(question_data)
-                    question = question_class.create(question_data)
-                    reverse_question_list.append(question.id)
-            # 删除那些不在此次PUT的但保留在数据库中的question实体
-            all_question = Question.objects.filter(questionnaire_id=instance.id)
-            for question in all_question:
-                if question.id not in reverse_question_list:
-                    question.delete()
-        # 更新非嵌套的内容
-        super().update(instance, validated_data)
+            if not isinstance(question_list_data, list):
+                raise serializers.ValidationError({'question_list': '题目列表应为数组'})
+            question_serializer = QuestionNestSerializer(data=[
+                dict(question_data, questionnaire=self.instance.id) if isinstance(question_data, dict) else question_data
+                for question_data in question_list_data
+            ], many=True)
+            if not question_serializer.is_valid():
+                raise serializers.ValidationError({'question_list': question_serializer.errors})
+            validated_data['question_list'] = question_serializer.validated_data
+        return validated_data
+
+    def update(self, instance, validated_data):
+        validated_data.pop('template', None)
+        question_list_data = validated_data.pop('question_list', None)
+        option_queryset = Option.objects.filter(question__questionnaire_id=instance.id)
+        limit = (instance.is_limit_answer, instance.limit_answer_number)
+        with transaction.atomic():
+            # 更新非嵌套的内容，问卷的保存同时更新版本和搜索索引。保存会写入整行，题目数要在这之后重新计算
+            super().update(instance, validated_data)
+            if limit != (instance.is_limit_answer, instance.limit_answer_number):
+                reset_quota(instance.id, ['questionnaire:%d' % instance.id])
+            if question_list_data is not None:
+                # 一次读出现有的题目和选项，比较后每张表批量新建、更新和删除；PATCH时不删除
+                limit_dic = get_option_limit_dic(option_queryset)
+                apply_question_list(instance.id, question_list_data, self.partial)
+                instance.refresh_from_db(fields=['question_count'])
+                # 只重新初始化限额设置被修改的选项的计数
+                reset_changed_option_quota(limit_dic, option_queryset)
         return instance
 
     class Meta:
@@ -235,6 +271,9 @@ class QuestionnaireListSerializer(QuestionnaireBaseSerializer):
 # 有关问卷提交的序列化器
 class AnswerDetailNestSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField(read_only=False, required=False)
+    # 这里只校验类型，题目和选项是否属于该问卷由AnswerSheetSerializer用一条查询统一校验
+    question = serializers.IntegerField(source='question_id')
+    option = serializers.IntegerField(source='option_id')
 
     class Meta:
         model = AnswerDetail
@@ -250,6 +289,26 @@ class AnswerSheetSerializer(serializers.ModelSerializer):
         model = AnswerSheet
         fields = '__all__'
 
+    def validate(self, attrs):
+        answer_list_data = attrs.get('answer_list')
+        if answer_list_data:
+            option_id_list = {answer['option_id'] for answer in answer_list_data}
+            option_question_dic = dict(Option.objects.filter(id__in=option_id_list,
+                                                             question__questionnaire=attrs['questionnaire'])
+                                       .values_list('id', 'question_id'))
+            for answer in answer_list_data:
+                if option_question_dic.get(answer['option_id']) != answer['question_id']:
+                    raise serializers.ValidationError(
+                        {'answer_list': '选项%d不属于该问卷的题目%d' % (answer['option_id'], answer['question_id'])})
+            # 按逻辑关联检查：实际没有显示的题目(例如改选了前面的选项后留下的作答)不能有作答
+            hidden_question_list = get_logic_graph(attrs['questionnaire']).get_hidden_question_list(answer_list_data)
+            if hidden_question_list:
+                raise serializers.ValidationError({
+                    'answer_list': '题目%s按逻辑关联没有显示，不能作答' % ', '.join(map(str, hidden_question_list)),
+                    'hidden_question_list': hidden_question_list,
+                })
+        return attrs
+
     def create(self, validated_data):
         answer_list_data = validated_data.get('answer_list', None)
         if answer_list_data is not None:
@@ -257,11 +316,16 @@ class AnswerSheetSerializer(serializers.ModelSerializer):
 
         answer_sheet = AnswerSheet.objects.create(**validated_data)
 
-        if answer_list_data is not None:
-            for answer_list_detail in answer_list_data:
-                answer_list_detail['id'] = None
-                AnswerDetail.objects.create(sheet=answer_sheet,
-                                            **answer_list_detail)
+        if answer_list_data:
+            AnswerDetail.objects.bulk_create([
+                AnswerDetail(sheet=answer_sheet,
+                             question_id=answer_list_detail['question_id'],
+                             option_id=answer_list_detail['option_id'],
+                             content=answer_list_detail.get('content'))
+                for answer_list_detail in answer_list_data
+            ])
+        schedule_sheet_count(answer_sheet, [(answer_list_detail['question_id'], answer_list_detail['option_id'])
+                                            for answer_list_detail in answer_list_data or []])
         return answer_sheet
 
 
@@ -300,31 +364,29 @@ class OptionReportSerializer(serializers.ModelSerializer):
     percent_string = serializers.SerializerMethodField()
 
     def get_number(self, instance):
-        return instance.answer_detail_list.count()
+        report = self.context.get('report')
+        if report is not None:
+            return report.statistics.option_num(instance.id)
+        return instance.get_answer_num()
+
+    # 选项被选次数，以及该题的作答人数
+    def get_option_num_and_total(self, instance):
+        report = self.context.get('report')
+        if report is not None:
+            return (report.statistics.option_num(instance.id),
+                    report.statistics.question_answer_num(instance.question_id))
+        return instance.get_answer_num(), instance.question.get_answer_num()
 
     def get_percent(self, instance):
-        option_num = instance.answer_detail_list.count()
-        total = instance.question.get_answer_num()
-        if total != 0:
-            return int(option_num / total * 100 * 100) / 100
-        else:
-            return 0
-        # total = AnswerSheet.objects.filter(question_id=instance.question_id). \
-        #     values('ordering').distinct().count()
-        # if total != 0:
-        #     return int(instance.answer_list.count() / total * 100 * 100) / 100
-        # else:
-        #     return 0
+        return get_percent(*self.get_option_num_and_total(instance))
 
     def get_percent_string(self, instance):
-        option_num = instance.answer_detail_list.count()
-        total = instance.question.get_answer_num()
-        if total != 0:
-            return format(option_num / total * 100, '.2f') + "%"
-        else:
-            return '0.00%'
+        return get_percent_string(*self.get_option_num_and_total(instance))
 
     def get_answer_list(self, instance):
+        report = self.context.get('report')
+        if report is not None:
+            return report.get_answer_list(instance.id)
         answer_list = instance.answer_detail_list.all()
         return AnswerDetailReportSerializer(answer_list, many=True).data
 
@@ -338,11 +400,18 @@ class QuestionReportSerializer(QuestionBaseSerializer):
     number = serializers.SerializerMethodField()
 
     def get_number(self, instance):
+        report = self.context.get('report')
+        if report is not None:
+            return report.statistics.question_answer_num(instance.id)
         return instance.get_answer_num()
 
     def get_option_list(self, instance):
-        option_list = instance.option_list.all().order_by('ordering')
-        return OptionReportSerializer(option_list, many=True).data
+        if 'report' in self.context:
+            # 选项已按序号预取
+            option_list = instance.option_list.all()
+        else:
+            option_list = number(list(instance.option_list.all().order_by(*ORDER_FIELD_LIST)))
+        return OptionReportSerializer(option_list, many=True, context=self.context).data
 
     class Meta:
         model = Question
@@ -353,8 +422,10 @@ class QuestionnaireReportSerializer(QuestionnaireBaseSerializer):
     question_list = serializers.SerializerMethodField()
 
     def get_question_list(self, instance):
-        question_list = instance.question_list.all().order_by('ordering')
-        return QuestionReportSerializer(question_list, many=True).data
+        # 计数和百分比由GROUP BY一次算出，作答明细由一条联表查询读出
+        report = ReportBundle(instance)
+        return QuestionReportSerializer(report.question_list, many=True,
+                                        context=dict(self.context, report=report)).data
 
     class Meta:
         model = Questionnaire
@@ -379,7 +450,7 @@ class QuestionSignUPSerializer(serializers.ModelSerializer):
     option_list = serializers.SerializerMethodField()
 
     def get_option_list(self, instance):
-        option_list = instance.option_list.all().order_by('ordering')
+        option_list = number(list(instance.option_list.all().order_by(*ORDER_FIELD_LIST)))
         return OptionSignUPSerializer(option_list, many=True).data
 
     class Meta:
@@ -397,7 +468,7 @@ class QuestionnaireSignUPSerializer(QuestionnaireBaseSerializer):
         return 0
 
     def get_question_list(self, instance):
-        question_list = instance.question_list.all().order_by('ordering')
+        question_list = number(list(instance.question_list.all().order_by(*ORDER_FIELD_LIST)))
         return QuestionSignUPSerializer(question_list, many=True).data
 
     class Meta:
@@ -410,3 +481,35 @@ class QuestionOptionLogicRelationSerializer(serializers.ModelSerializer):
     class Meta:
         model = QuestionOptionLogicRelation
         fields = '__all__'
+
+
+# 有关问卷模板的序列化器
+class QuestionnaireTemplateSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(read_only=True)
+    author = UserDescSerializer(read_only=True)
+
+    def validate_question_list(self, value):
+        try:
+            Blueprint(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return value
+
+    class Meta:
+        model = QuestionnaireTemplate
+        fields = '__all__'
+
+
+# 有关后台任务的序列化器
+class BackgroundJobSerializer(serializers.ModelSerializer):
+    download_url = serializers.SerializerMethodField()
+
+    def get_download_url(self, instance):
+        # 清除任务没有结果文件
+        if instance.status != 'done' or not instance.file:
+            return None
+        return reverse('backgroundjob-download', args=[instance.pk], request=self.context.get('request'))
+
+    class Meta:
+        model = BackgroundJob
+        exclude = ['file', 'answer_stamp']
@@ -1,72 +1,191 @@
-from questionnaire.models import Option, Question
-
-
-class Template:
-
-    def create_option(self, question, option_title_list):
-        for ordering in range(len(option_title_list)):
-            option = Option.objects.create(
-                title=option_title_list[ordering],
-                ordering=ordering + 1,
-                question_id=question.id
-            )
-            option.save()
-
-    def create_question(self, title, ordering, type, instance):
-        question = Question.objects.create(
-            title=title,
-            questionnaire_id=instance.id,
-            type=type,
-            ordering=ordering
-        )
-        question.save()
-        if type == 'completion':
-            option = Option.objects.create(
-                title='填空题小空',
-                ordering='1',
-                question_id=question.id,
-            )
-            option.save()
-        elif type == 'position':
-            option = Option.objects.create(
-                title='定位题小空',
-                ordering='1',
-                question_id=question.id,
-            )
-            option.save()
-        return question
-
-    def vote(self, instance):
-        question = self.create_question("投票单选择题", 1, "single-choice", instance)
-        question.is_show_result = True
-        question.save()
-        option_title_list = ["第一个选项", "第二个选项"]
-        self.create_option(question, option_title_list)
-
-    def signup(self, instance):
-        self.create_question("姓名", 1, "completion", instance)
-        self.create_question("手机号", 2, "completion", instance)
-        question = self.create_question("报名单选题", 3, "single-choice", instance)
-        option_title_list = ["第一个选项", "第二个选项"]
-        self.create_option(question, option_title_list)
-
-    def exam(self, instance):
-        self.create_question("姓名", 1, "completion", instance)
-        self.create_question("学号", 2, "completion", instance)
-
-    def epidemic_check_in(self, instance):
-        self.create_question("姓名", 1, "completion", instance)
-        self.create_question("学号", 2, "completion", instance)
-        temp_question = self.create_question("体温范围", 3, "single-choice", instance)
-        self.create_option(temp_question, ['正常(37.2°及以下)',
-                                           '37.3-38',
-                                           '38.1-38.5',
-                                           '38.6-39',
-                                           '39.1-40'
-                                           ]
-                           )
-        is_high_risk_question = self.create_question("有无去过高风险地区", 4, "single-choice", instance)
-        self.create_option(is_high_risk_question, ['无', '有'])
-        is_health = self.create_question("有无新冠症状", 5, "single-choice", instance)
-        self.create_option(is_health, ['无', '有'])
-        self.create_question("定位题", 6, "position", instance)
+from functools import lru_cache
+
+from django.db import transaction
+
+from questionnaire.clone import BULK_BATCH_SIZE, bulk_create_id_list
+from questionnaire.models import Question, Option, QuestionOptionLogicRelation, QuestionnaireTemplate
+from questionnaire.ordering import RANK_GAP, ORDER_FIELD_LIST
+
+'''
+    问卷模板。模板是一份题目蓝图(数据)，内置模板按问卷类型登记在TEMPLATE_DIC中，
+    用户模板保存在QuestionnaireTemplate表中。蓝图格式：
+        [
+            {
+                'title': '题目标题', 'type': 'single-choice', ...其他题目字段,
+                'option_list': ['选项标题', {'title': '选项标题', ...其他选项字段}, ...],
+                # 显示条件：第几题(从0开始)的第几个选项被选中时显示该题
+                'logic_option_list': [[题目下标, 选项下标], ...],
+            },
+            ...
+        ]
+    填空题和定位题没有给出选项时，自动添加一个小空。
+    蓝图解析一次后缓存在内存中，生成问卷时题目、选项、逻辑关联各一条批量INSERT。
+'''
+
+TEMPLATE_DIC = {
+    'vote': [
+        {'title': '投票单选择题', 'type': 'single-choice', 'is_show_result': True,
+         'option_list': ['第一个选项', '第二个选项']},
+    ],
+    'signup': [
+        {'title': '姓名', 'type': 'completion'},
+        {'title': '手机号', 'type': 'completion'},
+        {'title': '报名单选题', 'type': 'single-choice', 'option_list': ['第一个选项', '第二个选项']},
+    ],
+    'exam': [
+        {'title': '姓名', 'type': 'completion'},
+        {'title': '学号', 'type': 'completion'},
+    ],
+    'epidemic-check-in': [
+        {'title': '姓名', 'type': 'completion'},
+        {'title': '学号', 'type': 'completion'},
+        {'title': '体温范围', 'type': 'single-choice',
+         'option_list': ['正常(37.2°及以下)', '37.3-38', '38.1-38.5', '38.6-39', '39.1-40']},
+        {'title': '有无去过高风险地区', 'type': 'single-choice', 'option_list': ['无', '有']},
+        {'title': '有无新冠症状', 'type': 'single-choice', 'option_list': ['无', '有']},
+        {'title': '定位题', 'type': 'position'},
+    ],
+}
+
+DEFAULT_OPTION_DIC = {
+    'completion': '填空题小空',
+    'position': '定位题小空',
+}
+
+# 蓝图中允许出现的字段，序号、排序键、所属问卷和作答计数由生成时决定
+QUESTION_FIELD_LIST = ['title', 'content', 'type', 'order_type', 'is_must_answer', 'is_show_result',
+                       'is_limit_answer', 'limit_answer_number', 'is_scoring', 'question_score', 'answer']
+OPTION_FIELD_LIST = ['title', 'content', 'is_limit_answer', 'limit_answer_number', 'is_answer_choice', 'score',
+                     'answer', 'is_attr_limit', 'attr_limit_type', 'validator_regex', 'is_must_answer']
+
+QUESTION_TYPE_LIST = [choice[0] for choice in Question.TYPE_IN_CHOICES]
+
+
+class Blueprint:
+    '''
+        解析并校验过的蓝图。格式不正确时抛出ValueError。
+    '''
+
+    def __init__(self, data):
+        if not isinstance(data, list):
+            raise ValueError('模板应为题目列表')
+        self.question_list = []
+        self.option_list_list = []
+        self.logic_list = []
+        for question_index, question_data in enumerate(data):
+            if not isinstance(question_data, dict) or not question_data.get('title'):
+                raise ValueError('第%d题缺少标题' % (question_index + 1))
+            if question_data.get('type') not in QUESTION_TYPE_LIST:
+                raise ValueError('第%d题的题目类型不正确' % (question_index + 1))
+            question_dic = {field: question_data[field] for field in QUESTION_FIELD_LIST if field in question_data}
+            question_dic['ordering'] = question_index + 1
+            question_dic['rank'] = (question_index + 1) * RANK_GAP
+            self.question_list.append(question_dic)
+
+            option_data_list = question_data.get('option_list')
+            if not option_data_list and question_data['type'] in DEFAULT_OPTION_DIC:
+                option_data_list = [DEFAULT_OPTION_DIC[question_data['type']]]
+            option_list = []
+            for option_index, option_data in enumerate(option_data_list or []):
+                if isinstance(option_data, str):
+                    option_data = {'title': option_data}
+                if not isinstance(option_data, dict) or not option_data.get('title'):
+                    raise ValueError('第%d题第%d个选项缺少标题' % (question_index + 1, option_index + 1))
+                option_dic = {field: option_data[field] for field in OPTION_FIELD_LIST if field in option_data}
+                option_dic['ordering'] = option_index + 1
+                option_dic['rank'] = (option_index + 1) * RANK_GAP
+                option_list.append(option_dic)
+            self.option_list_list.append(option_list)
+
+            for logic in question_data.get('logic_option_list') or []:
+                if not isinstance(logic, (list, tuple)) or len(logic) != 2 or \
+                        not all(isinstance(index, int) for index in logic):
+                    raise ValueError('第%d题的逻辑关联应为[题目下标, 选项下标]' % (question_index + 1))
+                self.logic_list.append((question_index, tuple(logic)))
+
+        for question_index, (option_question_index, option_index) in self.logic_list:
+            if not 0 <= option_question_index < len(self.option_list_list) or \
+                    not 0 <= option_index < len(self.option_list_list[option_question_index]):
+                raise ValueError('第%d题的逻辑关联指向了不存在的选项' % (question_index + 1))
+
+    def __len__(self):
+        return len(self.question_list)
+
+
+BUILTIN_BLUEPRINT_DIC = {questionnaire_type: Blueprint(data) for questionnaire_type, data in TEMPLATE_DIC.items()}
+
+
+def get_builtin_blueprint(questionnaire_type):
+    return BUILTIN_BLUEPRINT_DIC.get(questionnaire_type)
+
+
+@lru_cache(maxsize=256)
+def load_template_blueprint(template_id, version):
+    # 以模板修改时间作为版本，模板被修改后自然用新的键重新解析
+    data = QuestionnaireTemplate.objects.filter(pk=template_id).values_list('question_list', flat=True).get()
+    return Blueprint(data)
+
+
+def get_template_blueprint(template):
+    return load_template_blueprint(template.id, template.modify_date)
+
+
+@transaction.atomic
+def materialize(blueprint, questionnaire):
+    '''
+        按蓝图为新建的问卷生成题目、选项和逻辑关联。
+        批量插入不触发信号，问卷应与此在同一事务中创建，搜索索引由问卷保存时登记的提交回调重建。
+    '''
+    question_id_list = bulk_create_id_list(
+        Question,
+        [Question(questionnaire_id=questionnaire.id, **question_dic) for question_dic in blueprint.question_list],
+        'questionnaire_id', [questionnaire.id]
+    )
+    option_list = []
+    option_position_list = []
+    for question_index, (question_id, option_dic_list) in enumerate(zip(question_id_list,
+                                                                       blueprint.option_list_list)):
+        for option_index, option_dic in enumerate(option_dic_list):
+            option_list.append(Option(question_id=question_id, **option_dic))
+            option_position_list.append((question_index, option_index))
+    if blueprint.logic_list:
+        option_id_list = bulk_create_id_list(Option, option_list, 'question_id', question_id_list)
+        option_id_dic = dict(zip(option_position_list, option_id_list))
+        QuestionOptionLogicRelation.objects.bulk_create([
+            QuestionOptionLogicRelation(question_id=question_id_list[question_index],
+                                        option_id=option_id_dic[option_position])
+            for question_index, option_position in blueprint.logic_list
+        ], batch_size=BULK_BATCH_SIZE)
+    else:
+        Option.objects.bulk_create(option_list, batch_size=BULK_BATCH_SIZE)
+
+
+def dump_blueprint(questionnaire_id):
+    '''
+        把已有问卷的题目、选项和逻辑关联导出为蓝图。
+    '''
+    question_list = list(Question.objects.filter(questionnaire_id=questionnaire_id).order_by(*ORDER_FIELD_LIST))
+    question_index_dic = {question.id: index for index, question in enumerate(question_list)}
+    option_position_dic = {}
+    data = []
+    option_list_dic = {}
+    for option in Option.objects.filter(question__questionnaire_id=questionnaire_id).order_by(*ORDER_FIELD_LIST):
+        option_list_dic.setdefault(option.question_id, []).append(option)
+    for question in question_list:
+        option_data_list = []
+        for option_index, option in enumerate(option_list_dic.get(question.id, [])):
+            option_position_dic[option.id] = [question_index_dic[question.id], option_index]
+            option_data = {field: getattr(option, field) for field in OPTION_FIELD_LIST}
+            if option_data['score'] is not None:
+                option_data['score'] = str(option_data['score'])
+            option_data_list.append(option_data)
+        question_data = {field: getattr(question, field) for field in QUESTION_FIELD_LIST}
+        question_data['option_list'] = option_data_list
+        question_data['logic_option_list'] = []
+        data.append(question_data)
+    for question_id, option_id in QuestionOptionLogicRelation.objects.filter(
+            question__questionnaire_id=questionnaire_id,
+            option__question__questionnaire_id=questionnaire_id
+    ).order_by('id').values_list('question_id', 'option_id'):
+        data[question_index_dic[question_id]]['logic_option_list'].append(option_position_dic[option_id])
+    return data
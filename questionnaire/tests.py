@@ -1,3 +1,699 @@
+import os
+import shutil
+import tempfile
+from unittest import mock, skipUnless
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from MoyuBackend.db_router import RoutingState, get_replica_alias, replica_down_dic, routing_state
+from questionnaire.archive import get_archive_path, iter_archive_detail
+from questionnaire.clone import clone_questionnaire, clone_question
+from questionnaire.counter import reconcile
+from questionnaire.jobs import PURGE_HANDLER_DIC, iter_purge_chunk, start_purge, claim_job, run_job, enqueue, \
+    get_job_path
+from questionnaire.models import Questionnaire, Question, Option, AnswerSheet, AnswerDetail, \
+    QuestionOptionLogicRelation, BackgroundJob
+from questionnaire.ordering import RANK_GAP, get_rank, move
+from questionnaire.prefetch import QuestionnaireBundle
+from questionnaire.search import reindex
+from questionnaire.serializers import QuestionNestSerializer
+
+
+class QuestionnaireDetailQueryTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='author', password='moyu123456')
+
+    def build_questionnaire(self, question_num):
+        questionnaire = Questionnaire.objects.create(title='问卷', content='', author=self.user)
+        sheet = AnswerSheet.objects.create(questionnaire=questionnaire)
+        last_option = None
+        for ordering in range(1, question_num + 1):
+            question = Question.objects.create(questionnaire=questionnaire, title='题目%d' % ordering,
+                                               type='single-choice', ordering=ordering)
+            option_list = [Option.objects.create(question=question, title='选项%d' % i, ordering=i)
+                           for i in (1, 2)]
+            AnswerDetail.objects.create(sheet=sheet, question=question, option=option_list[0])
+            if last_option is not None:
+                QuestionOptionLogicRelation.objects.create(question=question, option=last_option)
+            last_option = option_list[0]
+        reconcile(questionnaire.id)
+        questionnaire.refresh_from_db()
+        return questionnaire
+
+    def get_detail_query_num(self, questionnaire):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/questionnaire/%d/' % questionnaire.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['question_list']), questionnaire.get_question_num())
+        return len(context.captured_queries)
+
+    def test_query_num_is_constant(self):
+        small = self.get_detail_query_num(self.build_questionnaire(2))
+        large = self.get_detail_query_num(self.build_questionnaire(20))
+        self.assertEqual(small, large)
+
+    def test_bundle_matches_per_instance_serialization(self):
+        questionnaire = self.build_questionnaire(5)
+        question_list = questionnaire.question_list.all().order_by('ordering')
+        expected = QuestionNestSerializer(question_list, many=True).data
+        bundle = QuestionnaireBundle(questionnaire)
+        actual = QuestionNestSerializer(bundle.question_list, many=True, context={'bundle': bundle}).data
+        self.assertEqual(expected, actual)
+
+
+class NestedUpdateTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='author', password='moyu123456')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.questionnaire = Questionnaire.objects.create(title='问卷', content='', author=self.user)
+        self.question_list = []
+        for ordering in (1, 2, 3):
+            question = Question.objects.create(questionnaire=self.questionnaire, title='题目%d' % ordering,
+                                               type='single-choice', ordering=ordering, rank=ordering * 1024)
+            for i in (1, 2):
+                Option.objects.create(question=question, title='选项%d' % i, ordering=i, rank=i * 1024)
+            self.question_list.append(question)
+
+    def get_url(self):
+        return '/api/questionnaire/%d/' % self.questionnaire.id
+
+    def get_question_data(self, question, **kwargs):
+        return dict({'id': question.id, 'title': question.title, 'type': question.type}, **kwargs)
+
+    def test_put_without_question_list_keeps_questions(self):
+        response = self.client.put(self.get_url(), {'title': '新标题', 'content': '备注'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Question.objects.filter(questionnaire=self.questionnaire).count(), 3)
+        self.assertEqual(Option.objects.filter(question__questionnaire=self.questionnaire).count(), 6)
+
+    def test_put_with_question_list_replaces_questions(self):
+        first, second, third = self.question_list
+        question_list = [self.get_question_data(third), self.get_question_data(first, title='改过的题目')]
+        response = self.client.put(self.get_url(), {'title': '问卷', 'content': '备注', 'question_list': question_list},
+                                   format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(Question.objects.filter(questionnaire=self.questionnaire).order_by('ordering')
+                              .values_list('id', 'title', 'ordering')),
+                         [(third.id, third.title, 1), (first.id, '改过的题目', 2)])
+        self.assertFalse(Option.objects.filter(question=second).exists())
+
+    def test_patch_partial_list_deletes_nothing(self):
+        first, second, third = self.question_list
+        question_list = [
+            self.get_question_data(second, title='改过的题目', option_list=[{'title': '新选项', 'ordering': 1}]),
+            {'title': '新题目', 'type': 'single-choice'},
+        ]
+        response = self.client.patch(self.get_url(), {'question_list': question_list}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(Question.objects.filter(questionnaire=self.questionnaire).order_by('ordering')
+                              .values_list('title', 'ordering')),
+                         [('题目1', 1), ('改过的题目', 2), ('题目3', 3), ('新题目', 4)])
+        option_title_list = Option.objects.filter(question=second).order_by('ordering').values_list('title', flat=True)
+        self.assertEqual(list(option_title_list), ['选项1', '选项2', '新选项'])
+
+    def test_foreign_question_id_is_rejected(self):
+        other = Questionnaire.objects.create(title='别人的问卷', content='', author=self.user)
+        foreign = Question.objects.create(questionnaire=other, title='别的题目', type='single-choice', ordering=1)
+        question_list = [self.get_question_data(question) for question in self.question_list]
+        question_list.append(self.get_question_data(foreign, title='改过的题目'))
+        response = self.client.put(self.get_url(), {'title': '问卷', 'content': '备注', 'question_list': question_list},
+                                   format='json')
+        self.assertEqual(response.status_code, 400)
+        foreign.refresh_from_db()
+        self.assertEqual(foreign.title, '别的题目')
+        self.assertEqual(Question.objects.filter(questionnaire=self.questionnaire).count(), 3)
+
+
+class CloneTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='author', password='moyu123456')
+        self.questionnaire = Questionnaire.objects.create(title='问卷', content='', author=self.user)
+        # 题目的创建顺序与显示顺序不同，复制时新旧id的对应不能依赖显示顺序
+        self.question_dic = {}
+        for ordering in (3, 1, 2):
+            question = Question.objects.create(questionnaire=self.questionnaire, title='题目%d' % ordering,
+                                               type='single-choice', ordering=ordering, rank=ordering * 1024)
+            for i in (2, 1):
+                Option.objects.create(question=question, title='题目%d选项%d' % (ordering, i), ordering=i,
+                                      rank=i * 1024)
+            self.question_dic[ordering] = question
+        # 题目2在题目1选第一个选项时显示，题目3在题目2选第二个选项时显示
+        QuestionOptionLogicRelation.objects.create(question=self.question_dic[2],
+                                                   option=self.get_option(self.question_dic[1], 1))
+        QuestionOptionLogicRelation.objects.create(question=self.question_dic[3],
+                                                   option=self.get_option(self.question_dic[2], 2))
+
+    def get_option(self, question, i):
+        return Option.objects.get(question=question, title='%s选项%d' % (question.title, i))
+
+    def get_relation_title_set(self, questionnaire_id):
+        return set(QuestionOptionLogicRelation.objects.filter(question__questionnaire_id=questionnaire_id)
+                   .values_list('option__question__questionnaire_id', 'option__title', 'question__title'))
+
+    def test_clone_questionnaire_maps_ids(self):
+        old_question_id_set = {question.id for question in self.question_dic.values()}
+        new = clone_questionnaire(Questionnaire.objects.get(pk=self.questionnaire.id))
+        self.assertNotEqual(new.id, self.questionnaire.id)
+        self.assertEqual(new.question_count, 3)
+
+        question_list = list(Question.objects.filter(questionnaire=new).order_by('rank'))
+        self.assertEqual([question.title for question in question_list], ['题目1', '题目2', '题目3'])
+        self.assertFalse(old_question_id_set & {question.id for question in question_list})
+        for question in question_list:
+            self.assertEqual(set(Option.objects.filter(question=question).values_list('title', flat=True)),
+                             {'%s选项1' % question.title, '%s选项2' % question.title})
+        # 逻辑关联指向新问卷中的题目和选项
+        self.assertEqual(self.get_relation_title_set(new.id), {
+            (new.id, '题目1选项1', '题目2'),
+            (new.id, '题目2选项2', '题目3'),
+        })
+        self.assertEqual(self.get_relation_title_set(self.questionnaire.id), {
+            (self.questionnaire.id, '题目1选项1', '题目2'),
+            (self.questionnaire.id, '题目2选项2', '题目3'),
+        })
+
+    def test_clone_question_copies_logic(self):
+        original = self.question_dic[2]
+        new = clone_question(Question.objects.get(pk=original.id))
+        self.assertEqual(list(Question.objects.filter(questionnaire=self.questionnaire).order_by('rank')
+                              .values_list('id', 'ordering')),
+                         [(self.question_dic[1].id, 1), (original.id, 2), (new.id, 3), (self.question_dic[3].id, 4)])
+        new_option_dic = {option.title: option.id for option in Option.objects.filter(question=new)}
+        self.assertEqual(set(new_option_dic), {'题目2选项1', '题目2选项2'})
+        # 新题目的显示条件与原题目相同，由新题目选项出发的逻辑关联指向新选项
+        self.assertTrue(QuestionOptionLogicRelation.objects.filter(
+            question=new, option=self.get_option(self.question_dic[1], 1)).exists())
+        self.assertTrue(QuestionOptionLogicRelation.objects.filter(
+            question=self.question_dic[3], option_id=new_option_dic['题目2选项2']).exists())
+        self.assertEqual(QuestionOptionLogicRelation.objects.count(), 4)
+
+
+class OrderingTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='author', password='moyu123456')
+        self.questionnaire = Questionnaire.objects.create(title='问卷', content='', author=self.user)
+
+    def create_question_list(self, rank_list):
+        return [Question.objects.create(questionnaire=self.questionnaire, title='题目%d' % index, type='single-choice',
+                                        ordering=index + 1, rank=rank)
+                for index, rank in enumerate(rank_list)]
+
+    def get_order(self):
+        return list(Question.objects.filter(questionnaire=self.questionnaire).order_by('rank')
+                    .values_list('id', 'rank', 'ordering'))
+
+    def test_insert_takes_midpoint(self):
+        first, second = self.create_question_list([RANK_GAP, 2 * RANK_GAP])
+        self.assertEqual(get_rank(Question, self.questionnaire.id, 1), RANK_GAP // 2)
+        self.assertEqual(get_rank(Question, self.questionnaire.id, 2), RANK_GAP * 3 // 2)
+        self.assertEqual(get_rank(Question, self.questionnaire.id), 3 * RANK_GAP)
+        # 只读取邻居，其余行不变
+        self.assertEqual(self.get_order(), [(first.id, RANK_GAP, 1), (second.id, 2 * RANK_GAP, 2)])
+
+    def test_renormalize_when_no_gap(self):
+        first, second, third = self.create_question_list([1, 2, 3])
+        self.assertEqual(get_rank(Question, self.questionnaire.id, 2), RANK_GAP * 3 // 2)
+        self.assertEqual(self.get_order(), [(first.id, RANK_GAP, 1), (second.id, 2 * RANK_GAP, 2),
+                                            (third.id, 3 * RANK_GAP, 3)])
+
+    def test_move_keeps_ordering_in_sync(self):
+        first, second, third = self.create_question_list([RANK_GAP, 2 * RANK_GAP, 3 * RANK_GAP])
+        move(Question, self.questionnaire.id, {third.id: 1})
+        self.assertEqual([(pk, ordering) for pk, rank, ordering in self.get_order()],
+                         [(third.id, 1), (first.id, 2), (second.id, 3)])
+        self.assertEqual(Question.objects.get(pk=first.id).rank, RANK_GAP)
+
+    def test_move_renormalizes_when_no_gap(self):
+        first, second, third = self.create_question_list([1, 2, 3])
+        move(Question, self.questionnaire.id, {third.id: 2})
+        self.assertEqual(self.get_order(), [(first.id, RANK_GAP, 1), (third.id, 2 * RANK_GAP, 2),
+                                            (second.id, 3 * RANK_GAP, 3)])
+
+
+    def test_delete_renumbers_ordering(self):
+        first, second, third = self.create_question_list([RANK_GAP, 2 * RANK_GAP, 3 * RANK_GAP])
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(client.delete('/api/question/%d/' % first.id).status_code, 204)
+        self.assertEqual([(pk, ordering) for pk, rank, ordering in self.get_order()], [(second.id, 1), (third.id, 2)])
+
+
+class BatchMutationTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='author', password='moyu123456')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.questionnaire = Questionnaire.objects.create(title='问卷', content='', author=self.user)
+        self.question_list = [
+            Question.objects.create(questionnaire=self.questionnaire, title='题目%d' % ordering,
+                                    type='single-choice', ordering=ordering, rank=ordering * RANK_GAP)
+            for ordering in (1, 2, 3)
+        ]
+
+    def get_title_list(self):
+        return list(Question.objects.filter(questionnaire=self.questionnaire).order_by('rank')
+                    .values_list('title', flat=True))
+
+    def test_batch_update(self):
+        first, second, third = self.question_list
+        response = self.client.patch('/api/question/batch/', [
+            {'id': first.id, 'title': '改过的题目1'},
+            {'id': third.id, 'title': '改过的题目3'},
+        ], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([question['title'] for question in response.data], ['改过的题目1', '改过的题目3'])
+        self.assertEqual(self.get_title_list(), ['改过的题目1', '题目2', '改过的题目3'])
+
+    def test_batch_update_is_all_or_nothing(self):
+        first, second, third = self.question_list
+        for item_list in (
+            [{'id': first.id, 'title': '改过的题目1'}, {'id': third.id + 100, 'title': '不存在的题目'}],
+            [{'id': first.id, 'title': '改过的题目1'}, {'id': second.id, 'type': '不存在的类型'}],
+            [{'id': first.id, 'title': '改过的题目1'}, {'id': second.id, 'questionnaire': self.questionnaire.id}],
+            [{'id': first.id, 'title': '改过的题目1'}, {'id': first.id, 'title': '重复的id'}],
+        ):
+            response = self.client.patch('/api/question/batch/', item_list, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(self.get_title_list(), ['题目1', '题目2', '题目3'])
+
+    def test_batch_destroy_is_all_or_nothing(self):
+        first, second, third = self.question_list
+        response = self.client.delete('/api/question/batch/', {'id_list': [first.id, third.id + 100]},
+                                      format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, [{'id': first.id, 'deleted': True}, {'id': third.id + 100, 'deleted': False}])
+        self.assertEqual(self.get_title_list(), ['题目1', '题目2', '题目3'])
+
+        response = self.client.delete('/api/question/batch/', {'id_list': [first.id, third.id]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(Question.objects.filter(questionnaire=self.questionnaire)
+                              .values_list('title', 'ordering')), [('题目2', 1)])
+        self.assertEqual(Questionnaire.objects.get(pk=self.questionnaire.id).question_count, 1)
+
+
+class AnswerOnceTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='author', password='moyu123456')
+        self.respondent = User.objects.create_user(username='respondent', password='moyu123456')
+        self.client = APIClient()
+        self.client.force_authenticate(self.respondent)
+        self.questionnaire = Questionnaire.objects.create(title='问卷', content='', author=self.user,
+                                                          status='shared', is_only_answer_once=True)
+        self.question = Question.objects.create(questionnaire=self.questionnaire, title='题目',
+                                                type='single-choice', ordering=1, rank=RANK_GAP)
+        self.option = Option.objects.create(question=self.question, title='选项', ordering=1, rank=RANK_GAP)
+
+    def submit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/answer/', {
+                'questionnaire': self.questionnaire.id,
+                'answer_list': [{'question': self.question.id, 'option': self.option.id, 'content': ''}],
+            }, format='json')
+
+    def test_second_submission_is_rejected(self):
+        self.assertEqual(self.submit().status_code, 201)
+        response = self.submit()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['message'], '您已经回答过此问卷')
+        self.assertEqual(AnswerSheet.objects.filter(questionnaire=self.questionnaire).count(), 1)
+        self.assertEqual(Questionnaire.objects.get(pk=self.questionnaire.id).answer_count, 1)
+
+    def test_concurrent_submission_is_rejected_by_constraint(self):
+        # 两个请求同时通过了是否回答过的检查，第二个插入违反唯一约束
+        self.assertEqual(self.submit().status_code, 201)
+        with mock.patch('questionnaire.views.has_answered', return_value=False):
+            response = self.submit()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['message'], '您已经回答过此问卷')
+        self.assertEqual(AnswerSheet.objects.filter(questionnaire=self.questionnaire).count(), 1)
+        self.assertEqual(Questionnaire.objects.get(pk=self.questionnaire.id).answer_count, 1)
+
+    def test_constraint_ignores_empty_respondent(self):
+        AnswerSheet.objects.create(questionnaire=self.questionnaire)
+        AnswerSheet.objects.create(questionnaire=self.questionnaire)
+        AnswerSheet.objects.create(questionnaire=self.questionnaire, once_respondent=self.respondent)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            AnswerSheet.objects.create(questionnaire=self.questionnaire, once_respondent=self.respondent)
+
+
+class AnsweredQuestionnaireTestCase(TestCase):
+    # 两道单选题，三张答卷各回答两道题；另有一份问卷的答卷不应受影响
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        setting = self.settings(MEDIA_ROOT=media_root)
+        setting.enable()
+        self.addCleanup(setting.disable)
+
+        self.user = User.objects.create_user(username='author', password='moyu123456')
+        self.questionnaire = self.create_questionnaire(3)
+        self.other = self.create_questionnaire(1)
+
+    def create_questionnaire(self, sheet_num):
+        questionnaire = Questionnaire.objects.create(title='问卷', content='', author=self.user, status='shared')
+        option_list = []
+        for ordering in (1, 2):
+            question = Question.objects.create(questionnaire=questionnaire, title='题目%d' % ordering,
+                                               type='single-choice', ordering=ordering, rank=ordering * RANK_GAP)
+            option_list.append([Option.objects.create(question=question, title='选项%d' % i, ordering=i,
+                                                      rank=i * RANK_GAP) for i in (1, 2)])
+        for index in range(sheet_num):
+            sheet = AnswerSheet.objects.create(questionnaire=questionnaire, respondent=self.user, ip='127.0.0.1')
+            for question_option_list in option_list:
+                option = question_option_list[index % 2]
+                AnswerDetail.objects.create(sheet=sheet, question_id=option.question_id, option=option,
+                                            content='填空%d' % index)
+        reconcile(questionnaire.id)
+        questionnaire.refresh_from_db()
+        return questionnaire
+
+    def get_answer_row_list(self, questionnaire):
+        return list(AnswerDetail.objects.filter(sheet__questionnaire=questionnaire).order_by('id')
+                    .values_list('id', 'sheet_id', 'question_id', 'option_id', 'content'))
+
+    def get_count(self, questionnaire):
+        return (Questionnaire.objects.get(pk=questionnaire.id).answer_count,
+                list(Question.objects.filter(questionnaire=questionnaire).order_by('id')
+                     .values_list('answer_count', flat=True)),
+                list(Option.objects.filter(question__questionnaire=questionnaire).order_by('id')
+                     .values_list('answer_count', flat=True)))
+
+
+class PurgeTest(AnsweredQuestionnaireTestCase):
+
+    def test_purge_in_chunks(self):
+        other_row_list = self.get_answer_row_list(self.other)
+        # 先分段删除作答明细(6行)，再分段删除答卷(3行)
+        self.assertEqual(list(iter_purge_chunk(self.questionnaire.id, chunk_size=2)), [2, 2, 2, 2, 1])
+        self.assertFalse(AnswerSheet.objects.filter(questionnaire=self.questionnaire).exists())
+        self.assertEqual(self.get_answer_row_list(self.other), other_row_list)
+
+    def test_small_purge_runs_inline(self):
+        job = start_purge(self.questionnaire, 'purge-answer', self.user)
+        self.assertEqual(job.status, 'done')
+        self.assertEqual((job.progress, job.total), (9, 9))
+        self.assertEqual(self.get_count(self.questionnaire), (0, [0, 0], [0, 0, 0, 0]))
+        self.assertFalse(Questionnaire.objects.get(pk=self.questionnaire.id).is_purging)
+        self.assertEqual(self.get_count(self.other), (1, [1, 1], [1, 0, 1, 0]))
+
+    def test_large_purge_is_queued_once(self):
+        with mock.patch('questionnaire.jobs.PURGE_INLINE_LIMIT', 0):
+            job = start_purge(self.questionnaire, 'purge-answer', self.user)
+            self.assertEqual(job.status, 'pending')
+            self.assertTrue(Questionnaire.objects.get(pk=self.questionnaire.id).is_purging)
+            # 未完成的清除任务只登记一个
+            self.assertEqual(start_purge(self.questionnaire, 'archive-answer', self.user).id, job.id)
+        self.assertEqual(BackgroundJob.objects.filter(questionnaire=self.questionnaire).count(), 1)
+
+        self.assertTrue(claim_job(job))
+        job = run_job(job)
+        self.assertEqual(job.status, 'done')
+        self.assertFalse(AnswerSheet.objects.filter(questionnaire=self.questionnaire).exists())
+        self.assertFalse(Questionnaire.objects.get(pk=self.questionnaire.id).is_purging)
+
+    def test_failed_purge_clears_purging(self):
+        with mock.patch.dict(PURGE_HANDLER_DIC, {'purge-answer': mock.Mock(side_effect=RuntimeError)}):
+            job = start_purge(self.questionnaire, 'purge-answer', self.user)
+        self.assertEqual(job.status, 'failed')
+        self.assertFalse(Questionnaire.objects.get(pk=self.questionnaire.id).is_purging)
+        self.assertEqual(AnswerSheet.objects.filter(questionnaire=self.questionnaire).count(), 3)
+
+
+class ExportJobTest(AnsweredQuestionnaireTestCase):
+
+    def test_export_job_writes_file(self):
+        job = enqueue(self.questionnaire, 'export-csv', self.user)
+        self.assertTrue(claim_job(job))
+        job = run_job(job)
+        self.assertEqual(job.status, 'done')
+        self.assertTrue(os.path.exists(get_job_path(job)))
+
+    def test_deleted_questionnaire_fails_pending_job(self):
+        job = enqueue(self.questionnaire, 'export-csv', self.user)
+        # 外键置空，worker读到的任务没有问卷
+        self.questionnaire.delete()
+        job = BackgroundJob.objects.get(pk=job.id)
+        self.assertIsNone(job.questionnaire_id)
+        self.assertTrue(claim_job(job))
+        job = run_job(job)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.file, '')
+        self.assertEqual(BackgroundJob.objects.get(pk=job.id).status, 'failed')
+
+
+class ArchiveTest(AnsweredQuestionnaireTestCase):
+
+    def get_report(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get('/api/questionnaire/%d/report/' % self.questionnaire.id)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_archive_round_trip(self):
+        row_list = self.get_answer_row_list(self.questionnaire)
+        sheet_list = list(AnswerSheet.objects.filter(questionnaire=self.questionnaire).order_by('id')
+                          .values_list('id', 'respondent_id', 'started_time', 'modified_time', 'ip'))
+        count = self.get_count(self.questionnaire)
+        report = self.get_report()
+
+        job = start_purge(self.questionnaire, 'archive-answer', self.user)
+        self.assertEqual(job.status, 'done')
+        questionnaire = Questionnaire.objects.get(pk=self.questionnaire.id)
+        self.assertTrue(questionnaire.is_archived)
+        self.assertFalse(questionnaire.is_purging)
+        self.assertFalse(AnswerSheet.objects.filter(questionnaire=self.questionnaire).exists())
+        # 计数保持不变，报告改为读取归档文件，统计和答卷内容相同
+        self.assertEqual(self.get_count(self.questionnaire), count)
+        self.assertEqual([row[:5] for row in iter_archive_detail(self.questionnaire.id)],
+                         [(detail_id, content, sheet_id, question_id, option_id)
+                          for detail_id, sheet_id, question_id, option_id, content in row_list])
+        self.assertEqual(self.get_report()['question_list'], report['question_list'])
+
+        job = start_purge(self.questionnaire, 'restore-answer', self.user)
+        self.assertEqual(job.status, 'done')
+        questionnaire = Questionnaire.objects.get(pk=self.questionnaire.id)
+        self.assertFalse(questionnaire.is_archived)
+        self.assertFalse(questionnaire.is_purging)
+        # 按原id写回，归档文件删除
+        self.assertEqual(self.get_answer_row_list(self.questionnaire), row_list)
+        self.assertEqual(list(AnswerSheet.objects.filter(questionnaire=self.questionnaire).order_by('id')
+                              .values_list('id', 'respondent_id', 'started_time', 'modified_time', 'ip')),
+                         sheet_list)
+        self.assertEqual(self.get_count(self.questionnaire), count)
+        self.assertFalse(os.path.exists(get_archive_path(self.questionnaire.id)))
+
+    def test_archived_questionnaire_rejects_answers(self):
+        start_purge(self.questionnaire, 'archive-answer', self.user)
+        question = Question.objects.filter(questionnaire=self.questionnaire).first()
+        response = APIClient().post('/api/answer/', {
+            'questionnaire': self.questionnaire.id,
+            'answer_list': [{'question': question.id, 'option': question.option_list.first().id, 'content': ''}],
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(AnswerSheet.objects.filter(questionnaire=self.questionnaire).exists())
+
+    def test_missing_archive_returns_conflict(self):
+        start_purge(self.questionnaire, 'archive-answer', self.user)
+        os.remove(get_archive_path(self.questionnaire.id))
+        client = APIClient()
+        client.force_authenticate(self.user)
+        path = '/api/questionnaire/%d/' % self.questionnaire.id
+        question_id_list = list(Question.objects.filter(questionnaire=self.questionnaire).values_list('id', flat=True))
+        response_list = [
+            client.get(path + 'report/'),
+            client.get(path + 'export-xls/?file_type=csv'),
+            client.put(path + 'cross-analysis/', {'question_x_list': question_id_list[:1],
+                                                  'question_y_list': question_id_list[1:]}, format='json'),
+        ]
+        for response in response_list:
+            self.assertEqual(response.status_code, 409)
+            self.assertIn('message', response.data)
+        # 判断是否回答过时按没有归档的答卷人处理
+        response = client.put('/api/answer/check_answer/', {'id': self.questionnaire.id}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.data['has_answer'])
+
+    def test_clone_resets_archive_flag(self):
+        start_purge(self.questionnaire, 'archive-answer', self.user)
+        new = clone_questionnaire(Questionnaire.objects.get(pk=self.questionnaire.id))
+        self.assertFalse(new.is_archived)
+        self.assertFalse(new.is_purging)
+        self.assertEqual(new.answer_count, 0)
+
+
+class SortTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='author', password='moyu123456')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.questionnaire_list = [Questionnaire.objects.create(title='问卷%d' % index, content='', author=self.user,
+                                                                answer_count=index) for index in range(3)]
+
+    def test_sort_by_keyword(self):
+        response = self.client.put('/api/questionnaire/sort/?page_size=2', {'keyword': '-answer_num'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.data['results']],
+                         [self.questionnaire_list[2].id, self.questionnaire_list[1].id])
+
+    def test_unknown_or_missing_keyword_is_rejected(self):
+        for data in ({'keyword': 'title'}, {'keyword': '--create_date'}, {}):
+            response = self.client.put('/api/questionnaire/sort/?page_size=2', data, format='json')
+            self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/user/author/questionnaire/', {'ordering': 'password'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_user_list_is_not_paginated(self):
+        response = self.client.get('/api/user/', {'page_size': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(response.data, list)
+        response = self.client.get('/api/user/author/questionnaire/', {'page_size': 2})
+        self.assertEqual(len(response.data['results']), 2)
+
+
+class SearchTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='author', password='moyu123456')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_questionnaire(self, title, question_title='', option_title=''):
+        questionnaire = Questionnaire.objects.create(title=title, content='', author=self.user)
+        question = Question.objects.create(questionnaire=questionnaire, title=question_title, type='single-choice',
+                                           ordering=1, rank=RANK_GAP)
+        Option.objects.create(question=question, title=option_title, ordering=1, rank=RANK_GAP)
+        reindex(questionnaire.id)
+        return questionnaire
+
+    def search(self, keyword, query=''):
+        response = self.client.put('/api/questionnaire/search/' + query, {'keyword': keyword}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_rank_by_source(self):
+        option = self.create_questionnaire('问卷', option_title='宿舍满意度')
+        title = self.create_questionnaire('宿舍满意度调查')
+        question = self.create_questionnaire('问卷', question_title='宿舍满意度')
+        self.assertEqual([item['id'] for item in self.search('满意度')], [title.id, question.id, option.id])
+
+    def test_grams_from_different_sources_do_not_match(self):
+        # “宿舍”在标题中，“舍满”和“满意”只出现在选项中，整个搜索词没有出现在任何一段文字里
+        self.create_questionnaire('宿舍', option_title='舍满意')
+        matched = self.create_questionnaire('问卷', option_title='宿舍满意度')
+        self.assertEqual([item['id'] for item in self.search('宿舍满意')], [matched.id])
+
+    def test_ranked_results_are_paginated(self):
+        id_list = [self.create_questionnaire('课程反馈%d' % index).id for index in range(5)]
+        result_id_list = []
+        data = self.search('课程', '?page_size=2')
+        while True:
+            self.assertLessEqual(len(data['results']), 2)
+            result_id_list.extend(item['id'] for item in data['results'])
+            if data['next'] is None:
+                break
+            response = self.client.put(data['next'], {'keyword': '课程'}, format='json')
+            data = response.data
+        # 得分相同时按id从大到小
+        self.assertEqual(result_id_list, id_list[::-1])
+
+
+class SearchReindexTest(TransactionTestCase):
+    # TestCase把测试包在事务中，请求本身没有事务时的重建次数只能在真正提交的情况下检查
+
+    def test_nested_create_reindexes_once(self):
+        user = User.objects.create_user(username='author', password='moyu123456')
+        client = APIClient()
+        client.force_authenticate(user)
+        questionnaire = Questionnaire.objects.create(title='问卷', content='', author=user)
+        with mock.patch('questionnaire.search.reindex', wraps=reindex) as patched:
+            response = client.post('/api/question/', {
+                'questionnaire': questionnaire.id, 'title': '题目', 'type': 'single-choice', 'ordering': 1,
+                'option_list': [{'title': '宿舍%d' % index, 'ordering': index} for index in range(1, 4)],
+            }, format='json')
+        self.assertEqual(response.status_code, 201)
+        patched.assert_called_once_with(questionnaire.id)
+        response = client.put('/api/questionnaire/search/', {'keyword': '宿舍3'}, format='json')
+        self.assertEqual([item['id'] for item in response.data], [questionnaire.id])
+
+
+@skipUnless(get_replica_alias() == 'replica', '需要配置只读副本，使用--settings=MoyuBackend.test_settings运行')
+class DatabaseRouterTest(TransactionTestCase):
+    # 事务中的读取留在主库，而TestCase把每个测试包在事务中，所以这里使用TransactionTestCase。
+    # 没有配置副本时整个类被跳过，但测试运行前仍会检查这里列出的别名
+    databases = {'default', 'replica'} if get_replica_alias() == 'replica' else {'default'}
+
+    def setUp(self):
+        cache.clear()
+        replica_down_dic.clear()
+        self.user = User.objects.create_user(username='author', password='moyu123456')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.questionnaire = Questionnaire.objects.create(title='问卷', content='备注', author=self.user)
+
+    def request(self, method, path, data=None):
+        # 返回 (响应, 主库上的SQL条数, 副本上的SQL条数)
+        with CaptureQueriesContext(connections['default']) as default, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = getattr(self.client, method)(path, data, format='json')
+        return response, len(default.captured_queries), len(replica.captured_queries)
+
+    def test_read_view_uses_replica(self):
+        response, default_num, replica_num = self.request('get', '/api/questionnaire/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(default_num, 0)
+        self.assertGreater(replica_num, 0)
+
+    def test_write_goes_to_default(self):
+        state = RoutingState()
+        state.alias = 'replica'
+        token = routing_state.set(state)
+        try:
+            self.assertEqual(Questionnaire.objects.all().db, 'replica')
+            with CaptureQueriesContext(connections['replica']) as replica:
+                Questionnaire.objects.create(title='新问卷', content='备注', author=self.user)
+            self.assertEqual(len(replica.captured_queries), 0)
+            # 同一请求写过主库之后，读取也留在主库
+            self.assertEqual(Questionnaire.objects.all().db, 'default')
+        finally:
+            routing_state.reset(token)
+
+    def test_read_after_write_sticks_to_default(self):
+        response, default_num, replica_num = self.request(
+            'patch', '/api/questionnaire/%d/' % self.questionnaire.id, {'title': '新标题'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(replica_num, 0)
+        response, default_num, replica_num = self.request('get', '/api/questionnaire/')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(default_num, 0)
+        self.assertEqual(replica_num, 0)
+        self.assertEqual(response.data[0]['title'], '新标题')
+
+    def test_dead_replica_falls_back_to_default(self):
+        with CaptureQueriesContext(connections['default']) as default, \
+                CaptureQueriesContext(connections['replica']) as replica, \
+                mock.patch.object(connections['replica'], 'ensure_connection', side_effect=OperationalError):
+            response = self.client.get('/api/questionnaire/')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(len(default.captured_queries), 0)
+        self.assertEqual(len(replica.captured_queries), 0)
+        self.assertIn('replica', replica_down_dic)
+
+
 # from questionnaire.models import Questionnaire
 #
 # request = {'data':{'question_x_list':[59],'question_y_list':[60]}}
@@ -0,0 +1,24 @@
+from django.utils import timezone
+
+from questionnaire.models import Questionnaire
+
+'''
+    问卷的版本号取自问卷的修改时间。题目、选项等发生变化时调用touch_questionnaire更新修改时间，
+    以版本号为键的缓存在所有进程中同时失效，不需要逐个删除缓存。
+'''
+
+
+def get_version(questionnaire):
+    return questionnaire.modify_date.strftime('%Y%m%d%H%M%S%f')
+
+
+def touch_questionnaire(questionnaire_id):
+    Questionnaire.objects.filter(pk=questionnaire_id).update(modify_date=timezone.now())
+
+
+def touch_questionnaire_of_question(question_id):
+    Questionnaire.objects.filter(question_list__id=question_id).update(modify_date=timezone.now())
+
+
+def touch_questionnaire_list(questionnaire_id_list):
+    Questionnaire.objects.filter(pk__in=questionnaire_id_list).update(modify_date=timezone.now())
@@ -1,12 +1,10 @@
 import random
-from datetime import datetime
+from collections import defaultdict
 
 import django_filters
-import pytz
-import xlwt
-from django.db import transaction
-from django.db.models import F, Count
-from django.http import HttpResponse, JsonResponse
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import JsonResponse, FileResponse
 from django.utils import timezone
 from django_filters import BaseInFilter, CharFilter
 from django_filters.rest_framework import DjangoFilterBackend, FilterSet
@@ -15,10 +13,28 @@ from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from questionnaire.models import Questionnaire, Question, Option, AnswerSheet, QuestionOptionLogicRelation
+from questionnaire.archive import ArchiveMissing, check_archive, has_answer_sheet, get_archived_respondent_set
+from questionnaire.clone import BULK_BATCH_SIZE, clone_questionnaire, clone_question
+from questionnaire.counter import remove_sheet_count, refresh_question_count, \
+    refresh_question_answer_count, refresh_question_list_answer_count
+from questionnaire.cross_analysis import CrossTable
+from questionnaire.export import EXPORT_WRITER_DIC, export_response
+from questionnaire.grading import get_answer_key
+from questionnaire.jobs import JOB_HANDLER_DIC, JOB_EXTENSION_DIC, enqueue, get_job_path, start_purge
+from questionnaire.logic import LogicGraph, get_logic_graph
+from questionnaire.models import Questionnaire, Question, Option, AnswerSheet, QuestionOptionLogicRelation, \
+    BackgroundJob, QuestionnaireTemplate
+from questionnaire.ordering import get_rank, get_moved_rank, move, renumber, reorder
+from questionnaire.pagination import QuestionnaireCursorPagination, get_sort_field
+from questionnaire.quota import QuotaExceeded, acquire_quota, seed_quota, release_quota, reset_quota, \
+    get_option_limit_dic, reset_changed_option_quota
+from questionnaire.rollup import TIMELINE_UNIT_LIST, get_timeline, parse_time
+from questionnaire.search import get_match_queryset, schedule_reindex, search
 from questionnaire.serializers import QuestionnaireDetailSerializer, QuestionnaireListSerializer, OptionSerializer, \
     QuestionSerializer, AnswerSheetSerializer, QuestionnaireReportSerializer, QuestionnaireSignUPSerializer, \
-    QuestionBaseSerializer, OptionBaseSerializer, QuestionNestSerializer, QuestionOptionLogicRelationSerializer
+    QuestionOptionLogicRelationSerializer, BackgroundJobSerializer, QuestionnaireTemplateSerializer
+from questionnaire.template_create import dump_blueprint
+from questionnaire.version import touch_questionnaire, touch_questionnaire_of_question, touch_questionnaire_list
 
 
 class CreateListModelMixin(object):
@@ -30,13 +46,120 @@ class CreateListModelMixin(object):
         return super(CreateListModelMixin, self).get_serializer(*args, **kwargs)
 
 
+class BatchMutationMixin(object):
+    '''
+        批量修改和删除：PATCH <资源>/batch/ 传入 [{"id": id, ...要修改的字段}, ...]，
+        DELETE <资源>/batch/ 传入 {"id_list": [id, ...]}。
+        全部操作先一起校验，任意一项不通过时都不执行，返回400和每一项的结果；
+        通过后在一个事务中用批量SQL执行，返回每一项的结果。各视图集在perform_batch_update/destroy中处理关联的计数和版本。
+    '''
+    # 批量修改时不允许改动的字段(所属上级和嵌套字段)
+    batch_readonly_field_list = []
+
+    @action(detail=False, methods=['patch', 'delete'],
+            url_path='batch', url_name='batch')
+    def batch(self, request):
+        if request.method == 'DELETE':
+            return self.batch_destroy(request)
+        return self.batch_update(request)
+
+    def get_batch_instance_dic(self, id_list):
+        # id不是整数或者重复时返回None
+        if not all(isinstance(pk, int) and not isinstance(pk, bool) for pk in id_list) \
+                or len(set(id_list)) != len(id_list):
+            return None
+        return self.get_queryset().in_bulk(id_list)
+
+    def batch_update(self, request):
+        item_list = request.data
+        if not isinstance(item_list, list) or not item_list or not all(isinstance(item, dict) for item in item_list):
+            return Response({"message": "批量修改应为非空的对象数组"}, status.HTTP_400_BAD_REQUEST)
+        instance_dic = self.get_batch_instance_dic([item.get('id') for item in item_list])
+        if instance_dic is None:
+            return Response({"message": "每一项都应带有不重复的id"}, status.HTTP_400_BAD_REQUEST)
+
+        result_list = []
+        serializer_list = []
+        for item in item_list:
+            instance = instance_dic.get(item['id'])
+            data = {field: value for field, value in item.items() if field != 'id'}
+            readonly_field_list = [field for field in data if field in self.batch_readonly_field_list]
+            if instance is None:
+                errors = {'id': ['不存在']}
+            elif readonly_field_list:
+                errors = {field: ['不支持批量修改'] for field in readonly_field_list}
+            else:
+                serializer = self.get_serializer(instance, data=data, partial=True)
+                errors = None if serializer.is_valid() else serializer.errors
+                serializer_list.append(serializer)
+            result_list.append({'id': item['id'], 'errors': errors})
+        if any(result['errors'] for result in result_list):
+            return Response(result_list, status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            self.perform_batch_update(serializer_list)
+        # 重新读取，返回更新后的数据
+        instance_dic = self.get_queryset().in_bulk(list(instance_dic))
+        return Response([self.get_serializer(instance_dic[item['id']]).data for item in item_list])
+
+    def apply_batch_update(self, serializer_list, exclude_field_list=()):
+        '''
+            把校验后的数据写入实例，一条批量UPDATE写入所有修改过的字段，返回修改过的字段集合。
+        '''
+        model = self.get_queryset().model
+        field_set = set()
+        for serializer in serializer_list:
+            for field, value in serializer.validated_data.items():
+                if field not in exclude_field_list:
+                    setattr(serializer.instance, field, value)
+                    field_set.add(field)
+        if not field_set:
+            return field_set
+        # bulk_update不会自动更新auto_now字段
+        if any(field.name == 'modify_date' for field in model._meta.concrete_fields):
+            now = timezone.now()
+            for serializer in serializer_list:
+                serializer.instance.modify_date = now
+            field_set.add('modify_date')
+        model.objects.bulk_update([serializer.instance for serializer in serializer_list], sorted(field_set),
+                                  batch_size=BULK_BATCH_SIZE)
+        return field_set
+
+    def perform_batch_update(self, serializer_list):
+        self.apply_batch_update(serializer_list)
+
+    def batch_destroy(self, request):
+        id_list = request.data.get('id_list') if isinstance(request.data, dict) else None
+        if not isinstance(id_list, list) or not id_list:
+            return Response({"message": "id_list应为非空数组"}, status.HTTP_400_BAD_REQUEST)
+        instance_dic = self.get_batch_instance_dic(id_list)
+        if instance_dic is None:
+            return Response({"message": "id_list中应为不重复的id"}, status.HTTP_400_BAD_REQUEST)
+        result_list = [{'id': pk, 'deleted': pk in instance_dic} for pk in id_list]
+        if len(instance_dic) != len(id_list):
+            return Response(result_list, status.HTTP_400_BAD_REQUEST)
+        with transaction.atomic():
+            self.perform_batch_destroy(list(instance_dic.values()))
+        return Response(result_list)
+
+    def perform_batch_destroy(self, instance_list):
+        self.get_queryset().model.objects.filter(pk__in=[instance.pk for instance in instance_list]).delete()
+
+
 class CharInFilter(BaseInFilter, CharFilter):
     pass
 
 
 class QuestionnaireFilter(FilterSet):
     status = CharInFilter(field_name='status', lookup_expr='in')
-    title = django_filters.CharFilter(field_name='title', lookup_expr='icontains')
+    title = django_filters.CharFilter(method='filter_title')
+
+    # 先用搜索索引找出标题包含全部二元组的问卷，只在这些问卷上做包含判断
+    def filter_title(self, queryset, name, value):
+        match_queryset = get_match_queryset(value, source_list=['title'])
+        if match_queryset is not None:
+            queryset = queryset.filter(id__in=match_queryset.values('questionnaire_id'))
+        return queryset.filter(title__icontains=value)
 
     class Meta:
         model = Questionnaire
@@ -44,8 +167,9 @@ class QuestionnaireFilter(FilterSet):
 
 
 class QuestionnaireViewSet(viewsets.ModelViewSet):
-    queryset = Questionnaire.objects.annotate(answer_num=Count('answer_sheet_list'))
+    queryset = Questionnaire.objects.select_related('author')
     serializer_class = QuestionnaireDetailSerializer
+    pagination_class = QuestionnaireCursorPagination
     # permission_classes = [IsSelfOrReadOnly]
 
     filter_backends = [DjangoFilterBackend]
@@ -67,9 +191,23 @@ class QuestionnaireViewSet(viewsets.ModelViewSet):
         else:
             return QuestionnaireDetailSerializer
 
+    def handle_exception(self, exc):
+        # 报告、导出、交叉分析等读取归档文件的接口，文件丢失时返回409，不再是500
+        if isinstance(exc, ArchiveMissing):
+            return Response({"message": "问卷的答卷归档文件不存在，请联系管理员恢复"}, status.HTTP_409_CONFLICT)
+        return super().handle_exception(exc)
+
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
+    def destroy(self, request, *args, **kwargs):
+        # 彻底删除：先分段清除答卷再删除问卷，答卷多时由后台任务执行，返回202和任务进度
+        creator = request.user if request.user.is_authenticated else None
+        job = start_purge(self.get_object(), 'purge-questionnaire', creator)
+        if job.status == 'done':
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response(BackgroundJobSerializer(job, context={'request': request}).data, status.HTTP_202_ACCEPTED)
+
     @action(detail=True, methods=['get'],
             url_path='fill_or_preview', url_name='fill_or_preview')
     def fill_or_preview(self, request, pk=None):
@@ -86,12 +224,12 @@ class QuestionnaireViewSet(viewsets.ModelViewSet):
                 return Response({"message": "需要用户登陆后才可查看具体内容"},
                                 status.HTTP_401_UNAUTHORIZED)
             else:
-                question_list = list(instance.question_list.all())
+                # 题目列表来自缓存(或现场生成)，按id排序后再用用户id打乱，同一用户每次看到的顺序相同
+                serializer_data = serializer.data
+                question_list = sorted(serializer_data['question_list'], key=lambda question: question['id'])
                 random.seed(request.user.id)
                 random.shuffle(question_list)
-                qs = QuestionNestSerializer(question_list, many=True).data
-                serializer_data = serializer.data
-                serializer_data['question_list'] = qs
+                serializer_data['question_list'] = question_list
             return Response(serializer_data)
         return Response(serializer.data)
 
@@ -100,6 +238,10 @@ class QuestionnaireViewSet(viewsets.ModelViewSet):
             url_path='status', url_name='status')
     def set_status(self, request, pk=None):
         instance = Questionnaire.objects.get(pk=pk)
+        if instance.is_purging:
+            return Response({"message": "问卷正在清除答卷，请稍后再操作"}, status.HTTP_400_BAD_REQUEST)
+        if instance.is_archived and request.data.get('status') == 'shared':
+            return Response({"message": "问卷的答卷已归档，请先恢复答卷再发布"}, status.HTTP_400_BAD_REQUEST)
         instance.status = request.data.get('status')
 
         if instance.status == 'shared':
@@ -119,37 +261,12 @@ class QuestionnaireViewSet(viewsets.ModelViewSet):
             问卷信息：置空分享状态（关闭）、初次分享和最近分享时间，创建时间改变
             问题信息：修改对应的问卷id，需要获取新的问卷ID做替换
             选项信息：同上
+            逻辑关联：按新旧id的对应关系指向新的题目和选项
         """
         old_qn_pk = request.data.get('id')
 
-        questionnaire_obj = Questionnaire.objects.get(pk=old_qn_pk)
-        questionnaire_obj.pk = None
-        questionnaire_obj.create_date = timezone.now()
-        questionnaire_obj.first_shared_date = None
-        questionnaire_obj.last_shared_date = None
-        questionnaire_obj.modify_date = timezone.now()
-        questionnaire_obj.status = 'closed'
-        questionnaire_obj.title = questionnaire_obj.title + '_副本'
-        questionnaire_obj.save()
-
-        question_list = list(Question.objects.filter(questionnaire_id=old_qn_pk))
-        new_qn_pk = questionnaire_obj.pk
-
-        for question in question_list:
-            old_q_pk = question.pk
-
-            question.pk = None
-            question.modify_date = timezone.now()
-            question.questionnaire_id = new_qn_pk
-            question.save()
-
-            new_q_pk = question.pk
-            option_list = list(Option.objects.filter(question_id=old_q_pk))
-
-            for option in option_list:
-                option.pk = None
-                option.question_id = new_q_pk
-                option.save()
+        # 题目、选项、逻辑关联各一条批量插入，逻辑关联指向复制出的新题目和新选项
+        questionnaire_obj = clone_questionnaire(Questionnaire.objects.get(pk=old_qn_pk))
 
         serializer = QuestionnaireDetailSerializer(questionnaire_obj, context={'request': request})
         return Response(serializer.data)
@@ -167,7 +284,11 @@ class QuestionnaireViewSet(viewsets.ModelViewSet):
         if user.is_authenticated:
             keyword = request.data.get('keyword')
             questionnaire_list = self.queryset.exclude(status='deleted') \
-                .filter(author=user).order_by(keyword)
+                .filter(author=user).order_by(get_sort_field(keyword))
+            page = self.paginate_queryset(questionnaire_list)
+            if page is not None:
+                serializers = QuestionnaireListSerializer(page, context={'request': request}, many=True)
+                return self.get_paginated_response(serializers.data)
             serializers = QuestionnaireListSerializer(questionnaire_list, context={'request': request}, many=True)
             return Response(serializers.data, status.HTTP_200_OK)
         else:
@@ -179,8 +300,15 @@ class QuestionnaireViewSet(viewsets.ModelViewSet):
         user = request.user
         if user.is_authenticated:
             keyword = request.data.get('keyword')
-            questionnaire_list = Questionnaire.objects.exclude(status='deleted') \
-                .filter(author=user).filter(title__icontains=keyword)
+            # 按问卷标题、题目和选项的内容搜索，结果按匹配得分排序；搜索词中没有文字时返回全部问卷
+            questionnaire_list = self.queryset.exclude(status='deleted').filter(author=user)
+            match_list = search(questionnaire_list, keyword, author=user)
+            if match_list is not None:
+                questionnaire_list = match_list
+            page = self.paginate_queryset(questionnaire_list)
+            if page is not None:
+                serializers = QuestionnaireListSerializer(page, context={'request': request}, many=True)
+                return self.get_paginated_response(serializers.data)
             serializers = QuestionnaireListSerializer(questionnaire_list, context={'request': request}, many=True)
             return Response(serializers.data, status.HTTP_200_OK)
         else:
@@ -194,13 +322,14 @@ class QuestionnaireViewSet(viewsets.ModelViewSet):
         pk = request.data.get('id')
         questionnaire = Questionnaire.objects.get(id=pk)
 
-        # 删除该问卷名下的所有答卷
-        answer_list = AnswerSheet.objects.filter(questionnaire=questionnaire)
-        answer_list.delete()
-        # questionnaire.answer_num = 0
+        # 分段删除该问卷名下的所有答卷，答卷多时由后台任务执行，purge_job为清除任务及其进度
+        creator = request.user if request.user.is_authenticated else None
+        job = start_purge(questionnaire, 'purge-answer', creator)
+        questionnaire.refresh_from_db()
 
-        serializers = QuestionnaireDetailSerializer(questionnaire, context={'request': request})
-        return Response(serializers.data, status.HTTP_200_OK)
+        data = QuestionnaireDetailSerializer(questionnaire, context={'request': request}).data
+        data['purge_job'] = BackgroundJobSerializer(job, context={'request': request}).data
+        return Response(data, status.HTTP_200_OK)
 
     # 获取指定id问卷的分析内容
     @action(detail=True, methods=['get'],
@@ -208,8 +337,7 @@ class QuestionnaireViewSet(viewsets.ModelViewSet):
             serializer_class=QuestionnaireReportSerializer)
     def report(self, request, pk=None):
         questionnaire = Questionnaire.objects.get(id=pk)
-        count = AnswerSheet.objects.filter(questionnaire=questionnaire).count()
-        if count == 0:
+        if not has_answer_sheet(questionnaire):
             no_answer_message = '此问卷暂时还没有答卷，请先回收答卷'
             return Response({'message': no_answer_message},
                             status.HTTP_400_BAD_REQUEST)
@@ -220,69 +348,94 @@ class QuestionnaireViewSet(viewsets.ModelViewSet):
             return Response(serializer.data,
                             status.HTTP_200_OK)
 
-    # 导出excel
+    # 导出excel，流式输出，file_type可选xlsx(默认)或csv
     @action(detail=True, methods=['get'],
             url_path='export-xls', url_name='export-xls')
     def export_xls(self, request, pk=None):
-        response = HttpResponse(content_type='application/ms-excel')
-        response['Content-Disposition'] = 'attachment; filename=' + 'Questionnaire_' + str(pk) + '.xls'
-        workbook = xlwt.Workbook(encoding='utf-8')
-        worksheet = workbook.add_sheet('origin_data')
-        font_style = xlwt.XFStyle()
-
-        # 确定额外的信息
-        columns = ['respondent__username', 'modified_time']
-        trans_dic = {'respondent__username': '用户名', 'modified_time': '提交答题时间'}
-        # 获取答卷表单，确定顺序不变
-        answer_list = AnswerSheet.objects.filter(questionnaire_id=pk).order_by('modified_time')
-        ans_list = answer_list.values_list('respondent__username', 'modified_time')
-
-        # 首先填写额外的信息
-
-        for col_num in range(len(columns)):
-            row_num = 0
-            worksheet.write(row_num, col_num, trans_dic[columns[col_num]], font_style)
-            row_num += 1
-            for ans in ans_list:
-                data = ans[col_num]
-                if isinstance(data, datetime):
-                    data = data.astimezone(pytz.timezone('Asia/Shanghai')).strftime(
-                        '%Y-%m-%d %H:%M:%S')
-                worksheet.write(row_num, col_num, data, font_style)
-                row_num = row_num + 1
-
-        col_num = len(columns)
-
-        question_list = Question.objects.filter(questionnaire_id=pk).order_by('ordering')
-        question_type_dic = {'multiple-choice': '多选题', 'single-choice': '单选题', 'completion': '填空题',
-                             'scoring': '评分题'}
-
-        option_pos_dic = {}
-        for question in question_list:
-            option_list = Option.objects.filter(question=question).order_by('ordering')
-            for option in option_list:
-                column_str = ''.join([str(question.ordering), '.',
-                                      question.title, ':', option.title, '[',
-                                      question_type_dic.get(question.type, '未知题目类型'), ']'])
-                worksheet.write(0, col_num, column_str, font_style)
-                option_pos_dic[option.pk] = col_num
-                # option_pos_dic.update({option.pk, col_num})
-                col_num = col_num + 1
-        # 一行行填写答案
-        row_num = 1
-        for answer in answer_list:
-            answer_detail_list = answer.answer_detail_list.all()
-            for answer_detail in answer_detail_list:
-                if answer_detail.content:
-                    worksheet.write(row_num, option_pos_dic.get(answer_detail.option.id),
-                                    answer_detail.content, font_style)
-                else:
-                    worksheet.write(row_num, option_pos_dic.get(answer_detail.option.id),
-                                    1, font_style)
-            row_num += 1
+        file_type = request.query_params.get('file_type', 'xlsx')
+        if file_type not in EXPORT_WRITER_DIC:
+            return Response({"message": "不支持的导出格式"}, status.HTTP_400_BAD_REQUEST)
+        check_archive(pk)
+        return export_response(pk, file_type)
+
+    # 在后台生成导出文件或分析报告，答卷没有变化时直接复用之前的结果
+    @action(detail=True, methods=['post'],
+            url_path='jobs', url_name='jobs')
+    def jobs(self, request, pk=None):
+        questionnaire = Questionnaire.objects.get(pk=pk)
+        job_type = request.data.get('type')
+        if job_type not in JOB_HANDLER_DIC:
+            return Response({"message": "不支持的任务类型"}, status.HTTP_400_BAD_REQUEST)
+        if job_type == 'report' and not has_answer_sheet(questionnaire):
+            return Response({'message': '此问卷暂时还没有答卷，请先回收答卷'},
+                            status.HTTP_400_BAD_REQUEST)
+        creator = request.user if request.user.is_authenticated else None
+        job = enqueue(questionnaire, job_type, creator)
+        serializer = BackgroundJobSerializer(job, context={'request': request})
+        if job.status == 'done':
+            return Response(serializer.data, status.HTTP_200_OK)
+        return Response(serializer.data, status.HTTP_202_ACCEPTED)
+
+    # 归档(POST)或恢复(DELETE)问卷的答卷。归档后答卷从在线表移到按列存放的文件中，报告、导出和交叉分析照常可用；
+    # 答卷多时由后台任务执行，返回202和任务进度
+    @action(detail=True, methods=['post', 'delete'],
+            url_path='archive', url_name='archive')
+    def archive(self, request, pk=None):
+        questionnaire = Questionnaire.objects.get(pk=pk)
+        if request.method == 'POST':
+            if questionnaire.status == 'shared':
+                return Response({"message": "问卷正在发布中，请先关闭问卷再归档"}, status.HTTP_400_BAD_REQUEST)
+            # 上次归档在删除阶段失败时问卷已标记为归档、在线表还有答卷，可以再次归档继续删除
+            if questionnaire.is_archived and \
+                    not AnswerSheet.objects.filter(questionnaire_id=questionnaire.id).exists():
+                return Response({"message": "问卷的答卷已归档"}, status.HTTP_400_BAD_REQUEST)
+            job_type = 'archive-answer'
+        else:
+            if not questionnaire.is_archived:
+                return Response({"message": "问卷的答卷没有归档"}, status.HTTP_400_BAD_REQUEST)
+            job_type = 'restore-answer'
+        creator = request.user if request.user.is_authenticated else None
+        job = start_purge(questionnaire, job_type, creator)
+        serializer = BackgroundJobSerializer(job, context={'request': request})
+        if job.status == 'done':
+            return Response(serializer.data, status.HTTP_200_OK)
+        return Response(serializer.data, status.HTTP_202_ACCEPTED)
+
+    # 把问卷的题目、选项和逻辑关联保存为模板，之后创建问卷时可以传入template使用
+    @action(detail=True, methods=['post'],
+            url_path='save-template', url_name='save-template')
+    def save_template(self, request, pk=None):
+        user = request.user
+        if not user.is_authenticated:
+            return Response({"message": "仅登录用户可保存模板"}, status=status.HTTP_401_UNAUTHORIZED)
+        questionnaire = Questionnaire.objects.get(pk=pk)
+        template = QuestionnaireTemplate.objects.create(title=request.data.get('title') or questionnaire.title,
+                                                        author=user, type=questionnaire.type,
+                                                        question_list=dump_blueprint(questionnaire.id))
+        serializer = QuestionnaireTemplateSerializer(template, context={'request': request})
+        return Response(serializer.data, status.HTTP_201_CREATED)
 
-        workbook.save(response)
-        return response
+    # 问卷的逻辑关联图：题目的显示条件、条件选项所属的题目，以及形成循环的题目
+    @action(detail=True, methods=['get'],
+            url_path='logic', url_name='logic')
+    def logic(self, request, pk=None):
+        questionnaire = Questionnaire.objects.get(pk=pk)
+        return Response(get_logic_graph(questionnaire).to_data())
+
+    # 答卷时间线：每小时或每天的答卷数和平均答题用时，只读取汇总行。start、end为可选的时间范围
+    @action(detail=True, methods=['get'],
+            url_path='timeline', url_name='timeline')
+    def timeline(self, request, pk=None):
+        questionnaire = Questionnaire.objects.get(pk=pk)
+        unit = request.query_params.get('unit', 'day')
+        if unit not in TIMELINE_UNIT_LIST:
+            return Response({"message": "unit应为hour或day"}, status.HTTP_400_BAD_REQUEST)
+        try:
+            start = parse_time(request.query_params.get('start'))
+            end = parse_time(request.query_params.get('end'))
+        except ValueError as e:
+            return Response({"message": str(e)}, status.HTTP_400_BAD_REQUEST)
+        return Response(get_timeline(questionnaire.id, unit, start, end))
 
     # 交叉分析接口
     @action(detail=True, methods=['put'],
@@ -291,41 +444,8 @@ class QuestionnaireViewSet(viewsets.ModelViewSet):
         question_x_list = request.data['question_x_list']
         question_y_list = request.data['question_y_list']
         questionnaire = Questionnaire.objects.get(id=pk)
-        answer_sheet_list = AnswerSheet.objects.filter(questionnaire=questionnaire)
-        cross_table = {'table_list': []}
-        for pk_x in question_x_list:
-            for pk_y in question_y_list:
-                question_x = Question.objects.get(pk=pk_x)
-                question_y = Question.objects.get(pk=pk_y)
-                question_x_data = QuestionBaseSerializer(question_x).data
-                question_y_data = QuestionBaseSerializer(question_y).data
-                table = {}
-                cross_table['table_list'].append(table)
-                table['question_x'] = question_x_data
-                table['question_y'] = question_y_data
-                table['option_x_list'] = []
-                option_y_list_obj = question_y.option_list.all()
-                option_x_list = table['option_x_list'] = OptionBaseSerializer(question_x.option_list.all(),
-                                                                              many=True).data
-
-                answer_sheet_question_y = answer_sheet_list.filter(answer_detail_list__question_id=question_y.id)
-
-                for option_x in option_x_list:
-                    option_x['option_y_list'] = OptionBaseSerializer(option_y_list_obj,
-                                                                     many=True).data
-                    option_x_id = option_x['id']
-                    answer_sheet_x = answer_sheet_list.filter(answer_detail_list__option__id=option_x_id)
-                    option_x['num'] = (answer_sheet_x & answer_sheet_question_y).count()
-                    for option_y in option_x['option_y_list']:
-                        option_y_id = option_y['id']
-                        answer_sheet_y = answer_sheet_list.filter(answer_detail_list__option__id=option_y_id)
-                        option_y['num'] = (answer_sheet_x & answer_sheet_y).count()
-                        if option_x['num'] != 0:
-                            option_y['percent'] = int(option_y['num'] / option_x['num'] * 100 * 100) / 100
-                        else:
-                            option_y['percent'] = 0
-
-                        option_y['percent_string'] = format(option_y['percent'], '.2f') + "%"
+        # 三元组只查询一次，列联表在内存中计数
+        cross_table = CrossTable(questionnaire.id, question_x_list, question_y_list).build()
 
         response = JsonResponse(cross_table)
         response.status_code = 200
@@ -348,63 +468,72 @@ class QuestionnaireViewSet(viewsets.ModelViewSet):
     #
 
 
-class QuestionViewSet(CreateListModelMixin, viewsets.ModelViewSet):
+class QuestionViewSet(CreateListModelMixin, BatchMutationMixin, viewsets.ModelViewSet):
     queryset = Question.objects.all()
     serializer_class = QuestionSerializer
+    batch_readonly_field_list = ['questionnaire', 'option_list']
     # permission_classes = [IsSelfOrReadOnly]
 
     '''
-        删除之前更新list，使其ordering-1。 删除问题的同时，选项也该被删除。
-        如果更新时，其实例的ordering改变了，那么就找出被交换的另一方，进行属性更新
-        创建之前，所有在这之后的实例的ordering+1
-        如果复制问题，新的问题出现在原问题的下面，其余问题的ordering+1
+        题目的顺序由排序键rank决定(见ordering.py)，ordering为题目的位置。
+        创建、移动和复制题目时只给这一道题目写入前后两道题目之间的rank，其余题目的rank不变；
+        之后把位置有变化的题目的ordering写回。
     '''
 
     def perform_destroy(self, instance):
-        question_list = Question.objects.filter(questionnaire_id=instance.questionnaire_id). \
-            filter(ordering__gte=instance.ordering)
-        question_list.update(ordering=F('ordering') - 1)
-
         instance.delete()
+        renumber(Question, instance.questionnaire_id)
+        refresh_question_count(instance.questionnaire_id)
+        touch_questionnaire(instance.questionnaire_id)
 
     def perform_update(self, serializer):
-        # 此时instance还是老的，还未更新
-        old_ordering = serializer.instance.ordering
-        # 此时的instance中的数据已经被更新了
-        instance = serializer.save()
-        new_ordering = instance.ordering
-        if old_ordering != new_ordering:
-            if old_ordering < new_ordering:
-                question_list = Question.objects.filter(questionnaire_id=instance.questionnaire_id). \
-                    filter(ordering__lte=new_ordering).filter(ordering__gt=old_ordering). \
-                    exclude(id=instance.id)
-                question_list.update(ordering=F('ordering') - 1)
-
-            else:
-                question_list = Question.objects.filter(questionnaire_id=instance.questionnaire_id). \
-                    filter(ordering__lt=old_ordering).filter(ordering__gte=new_ordering). \
-                    exclude(id=instance.id)
-                question_list.update(ordering=F('ordering') + 1)
+        # 此时instance还是老的，ordering为移动到的位置
+        rank = get_moved_rank(Question, serializer.instance, serializer.validated_data.get('ordering'))
+        if rank is None:
+            instance = serializer.save()
+        else:
+            instance = serializer.save(rank=rank)
+        if 'ordering' in serializer.validated_data:
+            renumber(Question, instance.questionnaire_id)
+            instance.refresh_from_db(fields=['ordering'])
+        touch_questionnaire(instance.questionnaire_id)
 
     def perform_create(self, serializer):
         ordering = serializer.validated_data.get('ordering', None)
-        if ordering is not None:
-            instance = serializer.save()
-            questionnaire_id = instance.questionnaire_id
-            ordering = instance.ordering
-            question_list = Question.objects.filter(questionnaire_id=questionnaire_id). \
-                filter(ordering__gte=ordering).exclude(id=instance.id)
-            question_list.update(ordering=F('ordering') + 1)
-        else:
-            questionnaire = serializer.validated_data.get('questionnaire', None)
-            first_question = Question.objects.filter(questionnaire=questionnaire). \
-                order_by('-ordering').first()
-            if first_question is None:
-                max_ordering = 0
-            else:
-                max_ordering = first_question.ordering
-            max_ordering = max_ordering + 1
-            serializer.save(ordering=max_ordering)
+        questionnaire = serializer.validated_data.get('questionnaire', None)
+        rank = get_rank(Question, questionnaire.id, ordering)
+        instance = serializer.save(rank=rank, ordering=ordering or 0)
+        renumber(Question, instance.questionnaire_id)
+        instance.refresh_from_db(fields=['ordering'])
+        refresh_question_count(instance.questionnaire_id)
+        touch_questionnaire(instance.questionnaire_id)
+
+    def perform_batch_update(self, serializer_list):
+        # 序号按问卷分组后一起移动，只写移动的题目
+        field_set = self.apply_batch_update(serializer_list, exclude_field_list=['ordering'])
+        move_batch(Question, serializer_list, 'questionnaire_id')
+        questionnaire_id_set = {serializer.instance.questionnaire_id for serializer in serializer_list}
+        if 'title' in field_set:
+            # 批量更新不触发信号
+            for questionnaire_id in questionnaire_id_set:
+                schedule_reindex(questionnaire_id)
+        touch_questionnaire_list(questionnaire_id_set)
+
+    def perform_batch_destroy(self, instance_list):
+        super().perform_batch_destroy(instance_list)
+        questionnaire_id_set = {instance.questionnaire_id for instance in instance_list}
+        for questionnaire_id in questionnaire_id_set:
+            renumber(Question, questionnaire_id)
+            refresh_question_count(questionnaire_id)
+        touch_questionnaire_list(questionnaire_id_set)
+
+    @action(detail=False, methods=['put'],
+            url_path='reorder', url_name='reorder')
+    def reorder(self, request):
+        '''
+            拖动排序后一次提交整个问卷的题目顺序：{"questionnaire": 问卷id, "id_list": [题目id, ...]}
+        '''
+        return reorder_response(Question, request.data.get('questionnaire'), request.data.get('id_list'))
 
     @action(detail=False, methods=['post'],
             url_path='copy', url_name='copy')
@@ -412,108 +541,154 @@ class QuestionViewSet(CreateListModelMixin, viewsets.ModelViewSet):
 
         old_q_pk = request.data.get('id')
 
-        question = Question.objects.get(id=old_q_pk)
-        question.pk = None
-
-        question_list = Question.objects.filter(questionnaire_id=question.questionnaire_id). \
-            filter(ordering__gt=question.ordering)
-        question_list.update(ordering=F('ordering') + 1)
-        question.ordering = question.ordering + 1
-        question.modify_date = timezone.now()
-        question.save()
-
-        new_q_pk = question.pk
-        option_list = list(Option.objects.filter(question_id=old_q_pk))
-
-        for option in option_list:
-            option.pk = None
-            option.question_id = new_q_pk
-            option.save()
+        question = clone_question(Question.objects.get(id=old_q_pk))
+        refresh_question_count(question.questionnaire_id)
+        touch_questionnaire(question.questionnaire_id)
 
         serializer = QuestionSerializer(question, context={'request': request})
         return Response(serializer.data)
 
 
-class OptionViewSet(CreateListModelMixin, viewsets.ModelViewSet):
+class OptionViewSet(CreateListModelMixin, BatchMutationMixin, viewsets.ModelViewSet):
     queryset = Option.objects.all()
     serializer_class = OptionSerializer
+    batch_readonly_field_list = ['question']
 
     # permission_classes = [IsSelfOrReadOnly]
 
     def perform_destroy(self, instance):
-        option_list = Option.objects.filter(question_id=instance.question_id). \
-            filter(ordering__gte=instance.ordering)
-        option_list.update(ordering=F('ordering') - 1)
         instance.delete()
+        renumber(Option, instance.question_id)
+        # 选项的作答明细被级联删除，题目的答题人数重新计算
+        refresh_question_answer_count(instance.question_id)
+        touch_questionnaire_of_question(instance.question_id)
+        # 选项没有删除信号
+        schedule_reindex(instance.question.questionnaire_id)
 
     def perform_update(self, serializer):
-        old_ordering = serializer.instance.ordering
-        instance = serializer.save()
-        new_ordering = instance.ordering
-        if old_ordering != new_ordering:
-            exchanged_option = Option.objects.filter(question_id=instance.question_id). \
-                exclude(id=instance.id).get(ordering=new_ordering)
-            exchanged_option.ordering = old_ordering
-            exchanged_option.save()
+        limit = (serializer.instance.is_limit_answer, serializer.instance.limit_answer_number)
+        rank = get_moved_rank(Option, serializer.instance, serializer.validated_data.get('ordering'))
+        if rank is None:
+            instance = serializer.save()
+        else:
+            instance = serializer.save(rank=rank)
+        if 'ordering' in serializer.validated_data:
+            renumber(Option, instance.question_id)
+            instance.refresh_from_db(fields=['ordering'])
+        if limit != (instance.is_limit_answer, instance.limit_answer_number):
+            reset_quota(instance.question.questionnaire_id, ['option:%d' % instance.id])
+        touch_questionnaire_of_question(instance.question_id)
 
     def perform_create(self, serializer):
-        instance = serializer.save()
-        question_id = instance.question_id
-        ordering = instance.ordering
-        option_list = Question.objects.filter(question_id=question_id). \
-            filter(ordering__gte=ordering).exclude(id=instance.id)
-        option_list.update(ordering=F('ordering') + 1)
+        question = serializer.validated_data['question']
+        instance = serializer.save(rank=get_rank(Option, question.id, serializer.validated_data['ordering']))
+        renumber(Option, question.id)
+        instance.refresh_from_db(fields=['ordering'])
+        touch_questionnaire_of_question(instance.question_id)
+
+    def perform_batch_update(self, serializer_list):
+        option_queryset = Option.objects.filter(id__in=[serializer.instance.id for serializer in serializer_list])
+        limit_dic = get_option_limit_dic(option_queryset)
+        field_set = self.apply_batch_update(serializer_list, exclude_field_list=['ordering'])
+        move_batch(Option, serializer_list, 'question_id')
+        questionnaire_id_set = set(Question.objects.filter(
+            id__in={serializer.instance.question_id for serializer in serializer_list}
+        ).values_list('questionnaire_id', flat=True))
+        if 'is_limit_answer' in field_set or 'limit_answer_number' in field_set:
+            reset_changed_option_quota(limit_dic, option_queryset)
+        if 'title' in field_set:
+            for questionnaire_id in questionnaire_id_set:
+                schedule_reindex(questionnaire_id)
+        touch_questionnaire_list(questionnaire_id_set)
+
+    def perform_batch_destroy(self, instance_list):
+        question_id_set = {instance.question_id for instance in instance_list}
+        questionnaire_id_set = set(Question.objects.filter(id__in=question_id_set)
+                                   .values_list('questionnaire_id', flat=True))
+        super().perform_batch_destroy(instance_list)
+        for question_id in question_id_set:
+            renumber(Option, question_id)
+        # 选项的作答明细被级联删除，题目的答题人数重新计算
+        refresh_question_list_answer_count(question_id_set)
+        touch_questionnaire_list(questionnaire_id_set)
+        for questionnaire_id in questionnaire_id_set:
+            schedule_reindex(questionnaire_id)
+
+    @action(detail=False, methods=['put'],
+            url_path='reorder', url_name='reorder')
+    def reorder(self, request):
+        '''
+            拖动排序后一次提交整道题目的选项顺序：{"question": 题目id, "id_list": [选项id, ...]}
+        '''
+        return reorder_response(Option, request.data.get('question'), request.data.get('id_list'))
+
+
+def move_batch(model, serializer_list, parent_field):
+    # 批量修改中带有ordering的项按上级分组，每组一起移动
+    position_dic_dic = defaultdict(dict)
+    for serializer in serializer_list:
+        if 'ordering' in serializer.validated_data:
+            position_dic = position_dic_dic[getattr(serializer.instance, parent_field)]
+            position_dic[serializer.instance.id] = serializer.validated_data['ordering']
+    for parent_id, position_dic in position_dic_dic.items():
+        move(model, parent_id, position_dic)
+
+
+def reorder_response(model, parent_id, id_list):
+    try:
+        parent_id = int(parent_id)
+        id_list = [int(pk) for pk in id_list]
+    except (TypeError, ValueError):
+        return Response({"message": "排序参数不正确"}, status.HTTP_400_BAD_REQUEST)
+    try:
+        reorder(model, parent_id, id_list)
+    except ValueError:
+        return Response({"message": "排序列表与现有内容不一致"}, status.HTTP_400_BAD_REQUEST)
+    if model is Question:
+        touch_questionnaire(parent_id)
+    else:
+        touch_questionnaire_of_question(parent_id)
+    return Response([{'id': pk, 'ordering': index + 1} for index, pk in enumerate(id_list)])
 
 
 class AnswerSheetViewSet(CreateListModelMixin, viewsets.ModelViewSet):
     queryset = AnswerSheet.objects.all()
     serializer_class = AnswerSheetSerializer
 
-    @transaction.atomic(durable=True)
     def create(self, request, *args, **kwargs):
-        # 锁住限额的问题，直到事务结束，下一个事务进来无法获取会卡在这里，达成了阻塞并发的目的
-        questionnaire = Questionnaire.objects.select_for_update().get(pk=request.data['questionnaire'])
-
-        # 判断问题是否限额
-        if questionnaire.is_limit_answer:
-            total_questionnaire_answer_num = questionnaire.get_answer_num()
-            delta = questionnaire.limit_answer_number - total_questionnaire_answer_num
-            if delta <= 0:
-                return Response({"message": "限额已满！无法提交！"},
-                                status=status.HTTP_400_BAD_REQUEST)
-
-        # 判断选项是否限额
-        answer_list = request.data['answer_list']
-        print(answer_list)
-        for answer in answer_list:
-            # 锁住限额的问题，直到事务结束，下一个事务进来无法获取会卡在这里，达成了阻塞并发的目的
-            option = Option.objects.select_for_update().get(pk=answer['option'])
-            if option.is_limit_answer:
-                delta = option.limit_answer_number - option.get_answer_num()
-                if delta <= 0:
-                    return Response({"message": "限额已满！无法提交！"},
-                                    status=status.HTTP_400_BAD_REQUEST)
-        # 数据更新
+        questionnaire = Questionnaire.objects.get(pk=request.data['questionnaire'])
+        if questionnaire.is_purging:
+            return Response({"message": "问卷正在清除答卷，请稍后再提交"}, status=status.HTTP_400_BAD_REQUEST)
+        if questionnaire.is_archived:
+            return Response({"message": "问卷的答卷已归档，不再接受新的答卷"}, status=status.HTTP_400_BAD_REQUEST)
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
-        if self.request.user.is_authenticated:
-            serializer.save(respondent=self.request.user)
-        else:
-            serializer.save()
+        # 只允许回答一次的问卷，先按(问卷, 答卷人)索引判断是否已经回答过；匿名提交无法识别答卷人，不做限制
+        user = self.request.user
+        once_respondent = user if questionnaire.is_only_answer_once and user.is_authenticated else None
+        if once_respondent is not None and has_answered(questionnaire.id, user):
+            return Response({"message": "您已经回答过此问卷"}, status=status.HTTP_400_BAD_REQUEST)
+
+        answer_list = [{'option': answer['option_id'], 'content': answer.get('content')}
+                       for answer in serializer.validated_data.get('answer_list') or []]
+        # 还没有的限额计数行在提交事务之外创建
+        seed_quota(questionnaire, answer_list)
+        error_message = self.save_answer(serializer, questionnaire, answer_list, once_respondent)
+        if error_message is not None:
+            return Response({"message": error_message}, status=status.HTTP_400_BAD_REQUEST)
+        # 计数在提交事务完成后已更新；响应在事务之外生成，不占用任何行锁
+        questionnaire.refresh_from_db(fields=['answer_count'])
 
         questionnaire_data = QuestionnaireDetailSerializer(questionnaire, context={'request': request}).data
         headers = self.get_success_headers(serializer.data)
 
-        # 如果为考试题，看是否进行评测
+        # 如果为考试题，看是否进行评测。标准答案按问卷版本缓存，评判只做集合和字典查找
         if questionnaire.type == 'exam':
+            answer_key = get_answer_key(questionnaire)
             question_list = questionnaire_data['question_list']
-            questionnaire_data['is_show_answer_detail'] = False
             # 如果里面存在评测题，显示答案详情让用户回答
-            for question in question_list:
-                if question['is_scoring']:
-                    questionnaire_data['is_show_answer_detail'] = True
-                    break
+            questionnaire_data['is_show_answer_detail'] = answer_key.has_scoring_question()
             # 显示问题详情。
             if questionnaire_data['is_show_answer_detail']:
                 # 判断是否乱序
@@ -526,105 +701,150 @@ class AnswerSheetViewSet(CreateListModelMixin, viewsets.ModelViewSet):
                         random.seed(request.user.id)
                         random.shuffle(question_list)
                 # 判断每一个题目的得分，每个选项是否回答过
-                if questionnaire_data['is_show_answer_detail']:
-                    answer_list = request.data['answer_list']
-                    questionnaire_data['total_score'] = 0
-                    questionnaire_data['user_get_score'] = 0
-                    questionnaire_data['total_score_question_cnt'] = 0
-                    questionnaire_data['user_get_score_question_cnt'] = 0
-                    for question in question_list:
-                        # 如果是参与评分
-                        if question['is_scoring']:  # 判断用户是否答了这道题
-                            option_list = question['option_list']
-                            # 默认回答正确,获得所有分数
-                            question['is_user_answer_right'] = True
-                            question['user_get_score'] = question['question_score']
-                            questionnaire_data['total_score'] += question['question_score']
-                            questionnaire_data['user_get_score'] += question['question_score']
-                            questionnaire_data['total_score_question_cnt'] += 1
-                            questionnaire_data['user_get_score_question_cnt'] += 1
-                            for option in option_list:
-                                # 默认没有回答过
-                                option['is_user_answer'] = False
-                                index = 0
-                                for answer in answer_list:
-                                    if str(answer['option']) == str(option['id']):
-                                        # 如果回答过
-                                        option['is_user_answer'] = True
-                                        if question['type'] == 'single-choice':
-                                            question['answer_ordering'] = option['ordering']
-                                        content = answer.get('content', None)
-                                        option['user_answer_content'] = content
-                                        del answer_list[index]
-                                        # 跳出循环即可
-                                        break
-                                    index += 1
-                                if question['is_user_answer_right']:
-                                    # 如果是选择题，需要看每个选项。如果选项被选了，但不是正确答案或者选项没被选，但是是正确选项，回答错误。
-                                    if question['type'] == 'single-choice' or question['type'] == 'multiple-choice':
-                                        if ((option['is_answer_choice'] and (not option['is_user_answer'])) or
-                                                ((not option['is_answer_choice']) and option['is_user_answer'])):
-                                            question['is_user_answer_right'] = False
-                                            question['user_get_score'] = 0
-                                            questionnaire_data['user_get_score'] -= question['question_score']
-                                            questionnaire_data['user_get_score_question_cnt'] -= 1
-                                    # 如果是填空题，很简单，首先看用户是否回答过，如果有有，那再看只用看用户的回答是否和答案相同
-                                    elif question['type'] == 'completion':
-                                        if (not option['is_user_answer']) or \
-                                                option['answer'] != option['user_answer_content']:
-                                            question['is_user_answer_right'] = False
-                                            question['user_get_score'] = 0
-                                            questionnaire_data['user_get_score'] -= question['question_score']
-                                            questionnaire_data['user_get_score_question_cnt'] -= 1
-
-                            question['option_list'] = option_list
-                total = questionnaire_data['total_score_question_cnt']
-                get_score_cnt = questionnaire_data['user_get_score_question_cnt']
-                questionnaire_data['correct_rate'] = format(get_score_cnt / total * 100, '.2f') + "%"
-                questionnaire_data['question_list'] = question_list
+                answer_key.grade(questionnaire_data, answer_list)
 
         return Response(questionnaire_data, status=status.HTTP_201_CREATED, headers=headers)
 
+    @transaction.atomic(durable=True)
+    def save_answer(self, serializer, questionnaire, answer_list, once_respondent):
+        '''
+            占用名额并保存答卷，失败时回滚事务并返回错误信息。
+        '''
+        # 判断问卷和选项是否限额。只有设置了限额时才对计数行做条件更新(行锁持续到事务结束)，
+        # 没有限额的问卷提交之间互不阻塞
+        try:
+            acquire_quota(questionnaire, answer_list)
+        except QuotaExceeded:
+            transaction.set_rollback(True)
+            return '限额已满！无法提交！'
+
+        # 数据更新。并发的重复提交违反唯一约束，在保存点内回滚
+        user = self.request.user
+        try:
+            with transaction.atomic():
+                if user.is_authenticated:
+                    serializer.save(respondent=user, once_respondent=once_respondent)
+                else:
+                    serializer.save()
+        except IntegrityError:
+            transaction.set_rollback(True)
+            return '您已经回答过此问卷'
+
+        # 最后一条语句：加锁重新检查清除状态，行锁只持有到紧接着的提交。
+        # start_purge设置标记的UPDATE会等待这里的锁，标记生效之后的提交都在这里回滚，
+        # 归档和清除任务读到的答卷不会再增加
+        is_purging = Questionnaire.objects.select_for_update().filter(pk=questionnaire.id) \
+            .values_list('is_purging', flat=True).get()
+        if is_purging:
+            transaction.set_rollback(True)
+            return '问卷正在清除答卷，请稍后再提交'
+        return None
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            remove_sheet_count(instance)
+            release_quota(instance)
+            instance.delete()
+
     @action(detail=False, methods=['put'],
             url_path='check_answer', url_name='check_answer',
             serializer_class=QuestionnaireSignUPSerializer)
     def check_answer(self, request):
+        '''
+            当前用户是否回答过问卷。传入id返回 {"has_answer": 是否回答过}；
+            传入id_list返回 {"has_answer_dic": {问卷id: 是否回答过}}，一条查询判断多个问卷。
+        '''
         user = request.user
-        has_answer = False
-        pk = request.data['id']
-        questionnaire = Questionnaire.objects.get(id=pk)
         if not user.is_authenticated:
             return Response({"message": "用户首先应该登录"}, status=status.HTTP_401_UNAUTHORIZED)
-        respondent_id_list = list(questionnaire.answer_sheet_list.values("respondent").distinct())
-        for respondent in respondent_id_list:
-            if user.id == respondent["respondent"]:
-                has_answer = True
-                break
-        if has_answer:
-            return Response({"has_answer": True}, status=status.HTTP_200_OK)
-        else:
-            return Response({"has_answer": False}, status=status.HTTP_200_OK)
-
-
-class QuestionOptionLogicRelationViewSet(CreateListModelMixin, viewsets.ModelViewSet):
+        id_list = request.data.get('id_list')
+        if id_list is not None:
+            try:
+                id_list = [int(pk) for pk in id_list]
+            except (TypeError, ValueError):
+                return Response({"message": "id_list应为问卷id数组"}, status.HTTP_400_BAD_REQUEST)
+            answered_id_set = get_answered_id_set(id_list, user)
+            return Response({"has_answer_dic": {pk: pk in answered_id_set for pk in id_list}},
+                            status=status.HTTP_200_OK)
+        pk = int(request.data['id'])
+        return Response({"has_answer": pk in get_answered_id_set([pk], user)}, status=status.HTTP_200_OK)
+
+
+def has_answered(questionnaire_id, user):
+    # 走(问卷, 答卷人)索引，找到一条即返回。只查在线表，提交答卷时使用(已归档的问卷不接受答卷)
+    return AnswerSheet.objects.filter(questionnaire_id=questionnaire_id, respondent=user).exists()
+
+
+def get_answered_id_set(questionnaire_id_list, user):
+    # 答卷已归档的问卷查找归档文件中的答卷人
+    answered_id_set = set(AnswerSheet.objects.filter(questionnaire_id__in=questionnaire_id_list, respondent=user)
+                          .values_list('questionnaire_id', flat=True).distinct())
+    for questionnaire_id in Questionnaire.objects.filter(id__in=questionnaire_id_list, is_archived=True) \
+            .values_list('id', flat=True):
+        # 归档文件丢失时按没有回答过处理，不影响整个列表
+        try:
+            respondent_set = get_archived_respondent_set(questionnaire_id)
+        except ArchiveMissing:
+            continue
+        if user.id in respondent_set:
+            answered_id_set.add(questionnaire_id)
+    return answered_id_set
+
+
+class QuestionOptionLogicRelationViewSet(CreateListModelMixin, BatchMutationMixin, viewsets.ModelViewSet):
     queryset = QuestionOptionLogicRelation.objects.all()
     serializer_class = QuestionOptionLogicRelationSerializer
 
+    # 逻辑关联变化后更新问卷版本号，已缓存的题目列表随之失效
+    def perform_create(self, serializer):
+        instance = serializer.save()
+        relation_list = instance if isinstance(instance, list) else [instance]
+        for question_id in {relation.question_id for relation in relation_list}:
+            touch_questionnaire_of_question(question_id)
+
+    def perform_update(self, serializer):
+        old_question_id = serializer.instance.question_id
+        instance = serializer.save()
+        for question_id in {old_question_id, instance.question_id}:
+            touch_questionnaire_of_question(question_id)
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        touch_questionnaire_of_question(instance.question_id)
+
+    def perform_batch_update(self, serializer_list):
+        # 原来和修改后的题目所在的问卷都要更新版本号
+        question_id_set = {serializer.instance.question_id for serializer in serializer_list}
+        self.apply_batch_update(serializer_list)
+        question_id_set.update(serializer.instance.question_id for serializer in serializer_list)
+        touch_questionnaire_list(Question.objects.filter(id__in=question_id_set).values('questionnaire_id'))
+
+    def perform_batch_destroy(self, instance_list):
+        super().perform_batch_destroy(instance_list)
+        touch_questionnaire_list(Question.objects.filter(id__in={instance.question_id for instance in instance_list})
+                                 .values('questionnaire_id'))
+
     @transaction.atomic
     @action(detail=False, methods=['put'],
             url_path='edit', url_name='edit')
     def edit(self, request):
         question_id = request.data['question_id']
         relation_list = request.data['relation_list']
+        # 整体替换该题目选项出发的逻辑关联：一条DELETE加一条批量INSERT
         QuestionOptionLogicRelation.objects.filter(
             option__question_id=question_id
         ).delete()
         if relation_list:
-            for relation in relation_list:
-                obj = QuestionOptionLogicRelation.objects.create(option_id=relation['option'],
-                                                                 question_id=relation['question'])
-                obj.save()
+            QuestionOptionLogicRelation.objects.bulk_create([
+                QuestionOptionLogicRelation(option_id=relation['option'], question_id=relation['question'])
+                for relation in relation_list
+            ])
         questionnaire = Questionnaire.objects.get(question_list__id=question_id)
+        if LogicGraph(questionnaire.id).cycle_question_list:
+            transaction.set_rollback(True)
+            return Response({"message": "逻辑关联形成了循环，题目将无法显示"}, status.HTTP_400_BAD_REQUEST)
+        touch_questionnaire(questionnaire.id)
+        questionnaire.refresh_from_db(fields=['modify_date'])
         questionnaire_data = QuestionnaireDetailSerializer(questionnaire, context={'request': request}).data
         return Response(questionnaire_data, status.HTTP_200_OK)
 
@@ -632,9 +852,15 @@ class QuestionOptionLogicRelationViewSet(CreateListModelMixin, viewsets.ModelVie
             url_path='delete_list', url_name='delete_list')
     def delete_list(self, request):
         delete_list = request.data['delete_list']
-        for obj_data in delete_list:
-            obj = QuestionOptionLogicRelation.objects.get(question=obj_data['question'], option=obj_data['option'])
-            obj.delete()
+        if delete_list:
+            # 一条DELETE删除全部给出的(题目, 选项)关联
+            condition = Q()
+            for obj_data in delete_list:
+                condition |= Q(question_id=obj_data['question'], option_id=obj_data['option'])
+            QuestionOptionLogicRelation.objects.filter(condition).delete()
+            for questionnaire_id in Question.objects.filter(id__in={obj_data['question'] for obj_data in delete_list}) \
+                    .values_list('questionnaire_id', flat=True).distinct():
+                touch_questionnaire(questionnaire_id)
         return Response(status.HTTP_200_OK)
 
     @action(detail=False, methods=['put'],
@@ -644,11 +870,53 @@ class QuestionOptionLogicRelationViewSet(CreateListModelMixin, viewsets.ModelVie
         type = request.data['type']
         if type == 'questionnaire':
             QuestionOptionLogicRelation.objects.filter(
-                option__questionnaire_id=id
+                option__question__questionnaire_id=id
             ).delete()
+            touch_questionnaire(id)
         if type == 'question':
             QuestionOptionLogicRelation.objects.filter(
                 option__question_id=id
             ).delete()
+            touch_questionnaire_of_question(id)
 
         return Response(status.HTTP_200_OK)
+
+
+class QuestionnaireTemplateViewSet(viewsets.ModelViewSet):
+    queryset = QuestionnaireTemplate.objects.all()
+    serializer_class = QuestionnaireTemplateSerializer
+
+    # 只能看到和修改自己的模板
+    def get_queryset(self):
+        user = self.request.user
+        if user.is_authenticated:
+            return QuestionnaireTemplate.objects.filter(author=user)
+        return QuestionnaireTemplate.objects.none()
+
+    def perform_create(self, serializer):
+        serializer.save(author=self.request.user)
+
+
+class BackgroundJobViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = BackgroundJob.objects.all()
+    serializer_class = BackgroundJobSerializer
+
+    # 只能看到自己问卷的任务；问卷已被删除的任务(彻底删除问卷)由发起人查看
+    def get_queryset(self):
+        user = self.request.user
+        if user.is_authenticated:
+            return BackgroundJob.objects.filter(Q(questionnaire__author=user) |
+                                                Q(questionnaire__isnull=True, creator=user))
+        return BackgroundJob.objects.none()
+
+    @action(detail=True, methods=['get'],
+            url_path='download', url_name='download')
+    def download(self, request, pk=None):
+        job = self.get_object()
+        if job.status != 'done':
+            return Response({"message": "任务尚未完成"}, status.HTTP_400_BAD_REQUEST)
+        if not job.file:
+            return Response({"message": "该任务没有结果文件"}, status.HTTP_400_BAD_REQUEST)
+        # 问卷被删除后questionnaire_id为空，文件名使用任务id
+        filename = 'Questionnaire_job_%d.%s' % (job.id, JOB_EXTENSION_DIC[job.type])
+        return FileResponse(open(get_job_path(job), 'rb'), as_attachment=True, filename=filename)
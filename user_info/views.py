@@ -10,6 +10,7 @@ from rest_framework.permissions import AllowAny, IsAuthenticatedOrReadOnly
 from rest_framework.response import Response
 
 from questionnaire.models import Questionnaire
+from questionnaire.pagination import QuestionnaireCursorPagination, get_sort_field
 from questionnaire.serializers import QuestionnaireListSerializer, QuestionnaireDetailSerializer
 from user_info.permissions import IsSelfOrReadOnly
 from user_info.serializers import UserRegisterSerializer
@@ -31,22 +32,33 @@ class UserViewSet(viewsets.ModelViewSet):
         return super().get_permissions()
 
     @action(detail=True, methods=['get'],
-            url_path='questionnaire', url_name='questionnaire')
+            url_path='questionnaire', url_name='questionnaire',
+            pagination_class=QuestionnaireCursorPagination)
     def questionnaire(self, request, username=None):
         queryset = User.objects.get(username=username).questionnaire_list.exclude(status='deleted')
-        serializer_context = {
-            'request': request,
-        }
-        serializer = QuestionnaireListSerializer(queryset, many=True, context=serializer_context)
-        return Response(serializer.data)
+        return self.get_questionnaire_list_response(request, queryset)
 
     @action(detail=True, methods=['get'],
-            url_path='recycle', url_name='recycle')
+            url_path='recycle', url_name='recycle',
+            pagination_class=QuestionnaireCursorPagination)
     def recycle(self, request, username=None):
-        queryset = User.objects.get(username=username).questionnaire_list.filter(status='deleted')
+        queryset = User.objects.get(username=username).questionnaire_list.filter(status='deleted', is_purging=False)
+        return self.get_questionnaire_list_response(request, queryset)
+
+    # 问卷列表可以用ordering参数指定排序(与问卷sort接口相同的关键字)，带cursor或page_size参数时分页。
+    # 分页只用于这两个问卷列表，用户列表不分页
+    def get_questionnaire_list_response(self, request, queryset):
+        queryset = queryset.select_related('author')
+        keyword = request.query_params.get('ordering')
+        if keyword:
+            queryset = queryset.order_by(get_sort_field(keyword))
         serializer_context = {
             'request': request,
         }
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = QuestionnaireListSerializer(page, many=True, context=serializer_context)
+            return self.get_paginated_response(serializer.data)
         serializer = QuestionnaireListSerializer(queryset, many=True, context=serializer_context)
         return Response(serializer.data)
 